@@ -0,0 +1,59 @@
+import os
+import gzip
+import errno
+import cPickle as pickle
+
+import config
+
+# The input/output data and the output chunks of the old stopped jobs, moved
+# out of mongo by Database.archive_job : one gzipped pickle file per job in
+# a local directory, the job document only keeps the name of its archive
+class JobArchive(object):
+
+    def __init__(self, directory=None):
+        self.directory = directory if directory is not None else config.ARCHIVE_DIRECTORY
+
+    def get_filename(self, name):
+        return os.path.join(self.directory, name)
+
+    # returns the name of the archive
+    def write(self, job_id, content):
+        name = "%s.pkl.gz" % (job_id,)
+        filename = self.get_filename(name)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # an archive is always complete : it is written in a temporary file first
+        tmp_filename = filename + ".tmp"
+        fd = gzip.open(tmp_filename, "wb")
+        try:
+            pickle.dump(content, fd, pickle.HIGHEST_PROTOCOL)
+        finally:
+            fd.close()
+        os.rename(tmp_filename, filename)
+        return name
+
+    # None if there is no such archive (e.g written by another host)
+    def read(self, name):
+        try:
+            fd = gzip.open(self.get_filename(name), "rb")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return pickle.load(fd)
+        finally:
+            fd.close()
+
+    def delete(self, name):
+        try:
+            os.remove(self.get_filename(name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+def make_job_archive(directory=None):
+    directory = directory if directory is not None else config.ARCHIVE_DIRECTORY
+    if directory is None:
+        return None
+    return JobArchive(directory)
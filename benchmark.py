@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+# Measures the launch rate of jobs, the ingestion rate of their output,
+# the latency of Database.find and the latency from submission to RUNNING.
+# Results are written as json, to be compared from one version to another.
+#
+#   python benchmark.py --output bench.json                # against mongod on localhost
+#   python benchmark.py --in-process --output bench.json   # against mongomock
+
+import os
+import sys
+import json
+import time
+import select
+import socket
+import shutil
+import datetime
+import tempfile
+import threading
+
+import pymongo
+
+import config
+from db import Database, JobModel, CommandModel, MODEL_CLASSES, iter_find
+from blobstore import LocalBlobStore
+from process import MultipleProcessesManager, ProcessManager
+from scheduler import Scheduler
+from experiments_server import Interface
+
+BENCHMARK_DATABASE = "ExperimentsBenchmark"
+
+def get_percentiles(values, percentiles=(50, 90, 99)):
+    values = sorted(values)
+    result = {}
+    for percentile in percentiles:
+        index = min(len(values) - 1, int(len(values) * percentile / 100.))
+        result["p%d" % (percentile,)] = values[index]
+    result["max"] = values[-1]
+    result["mean"] = sum(values) / len(values)
+    return result
+
+def wait_for(condition, timeout, interval=0.001):
+    start = time.time()
+    while not condition():
+        if time.time() - start > timeout:
+            raise RuntimeError("timeout")
+        time.sleep(interval)
+
+class Server(object):
+    # a server (Interface + event loop thread) on a fresh database
+
+    def __init__(self, mongo_db, directory, max_concurrency):
+        for model_cls in MODEL_CLASSES:
+            mongo_db[model_cls.__name__].drop()
+        self.database = Database(mongo_db, blob_store=LocalBlobStore(os.path.join(directory, "blobs")))
+        self.database.ensure_indexes(MODEL_CLASSES)
+        self.multiple_processes_manager = MultipleProcessesManager()
+        # SIGCHLD wakes up the event loop, as in experiments_server.py
+        self.multiple_processes_manager.install_sigchld_handler()
+        self.scheduler = Scheduler(self.multiple_processes_manager, "benchmark",
+                                   max_concurrency=max_concurrency)
+        self.interface = Interface(self.database, self.multiple_processes_manager, self.scheduler)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.multiple_processes_manager.run_event_loop,
+                                       args=(self.database, self.stop_event),
+                                       kwargs={"scheduler": self.scheduler})
+        self.thread.daemon = True
+        self.thread.start()
+
+    # same as the newjob action of the client
+    def submit(self, args, cwd):
+        job_model = JobModel(CommandModel(args, cwd=cwd))
+        job_model._id = self.database.insert(job_model)
+        self.interface.new_process(job_model)
+        return job_model._id
+
+    def count(self, state):
+        return self.database.count(JobModel, {"state": state})
+
+    def stop(self):
+        self.stop_event.set()
+        self.multiple_processes_manager.wakeup()
+        self.thread.join()
+        self.multiple_processes_manager.abandon_processes()
+
+def benchmark_launch_rate(mongo_db, directory, nb_jobs, max_concurrency):
+    server = Server(mongo_db, directory, max_concurrency)
+    try:
+        start = time.time()
+        for i in xrange(nb_jobs):
+            server.submit(["true"], directory)
+        submitted = time.time()
+        wait_for(lambda: server.count(JobModel.STOPPED) == nb_jobs, timeout=60 + nb_jobs)
+        stopped = time.time()
+    finally:
+        server.stop()
+    return {
+        "jobs": nb_jobs,
+        "max_concurrency": server.scheduler.max_concurrency,
+        "submitted_per_second": nb_jobs / (submitted - start),
+        "completed_per_second": nb_jobs / (stopped - start),
+    }
+
+def benchmark_submit_to_running_latency(mongo_db, directory, nb_jobs):
+    server = Server(mongo_db, directory, max_concurrency=1)
+    latencies = []
+    try:
+        for i in xrange(nb_jobs):
+            start = time.time()
+            job_id = server.submit(["sleep", "0.05"], directory)
+            wait_for(lambda: server.database.find_one(JobModel, job_id).state != JobModel.NOT_YET_STARTED,
+                     timeout=10)
+            latencies.append(time.time() - start)
+            wait_for(lambda: server.database.find_one(JobModel, job_id).state == JobModel.STOPPED,
+                     timeout=10)
+    finally:
+        server.stop()
+    result = get_percentiles(latencies)
+    result["jobs"] = nb_jobs
+    return result
+
+def benchmark_output_ingestion(directory, nb_lines):
+    program = "import sys\nfor i in xrange(%d): sys.stdout.write('line %%d of the output of the job\\n' %% i)\n" % (nb_lines,)
+    job_model = JobModel(CommandModel([sys.executable, "-c", program], cwd=directory))
+    process = ProcessManager(job_model)
+    start = time.time()
+    process.start_and_update_state()
+    nb_bytes, nb_received_lines = 0, 0
+    while not process.output_closed:
+        select.select(process.filenos(), [], [], 1)
+        for stream in process.STREAMS:
+            for data in process.get_available_output(stream):
+                nb_bytes += len(data)
+                nb_received_lines += data.count("\n")
+    duration = time.time() - start
+    process.check_if_alive_and_update_state()
+    process.close()
+    assert nb_received_lines == nb_lines
+    return {
+        "lines": nb_lines,
+        "lines_per_second": nb_lines / duration,
+        "megabytes_per_second": nb_bytes / duration / 1e6,
+    }
+
+def benchmark_find_latency(mongo_db, sizes, repeat):
+    results = []
+    database = Database(mongo_db)
+    for size in sizes:
+        for model_cls in MODEL_CLASSES:
+            mongo_db[model_cls.__name__].drop()
+        database.ensure_indexes(MODEL_CLASSES)
+        now = datetime.datetime.now()
+        job_models = []
+        for i in xrange(size):
+            job_model = JobModel(CommandModel(["train", "--seed=%d" % (i,)]), 
+                                 (now - datetime.timedelta(minutes=i), now), state=JobModel.STOPPED)
+            job_model.output_data["stdout"] = "x" * 1000
+            job_models.append(job_model)
+        database.insert_many(job_models)
+        ids = [job_model._id for job_model in job_models]
+
+        params = {"state": JobModel.STOPPED}
+        sort = [("datetime_from", 1), ("datetime_to", 1)]
+        list_durations, find_one_durations, page_durations = [], [], []
+        for i in xrange(repeat):
+            start = time.time()
+            nb = sum(1 for job_model in iter_find(database, JobModel, params, JobModel.SUMMARY_FIELDS, sort=sort))
+            list_durations.append(time.time() - start)
+            assert nb == size
+
+            start = time.time()
+            database.find(JobModel, params, JobModel.SUMMARY_FIELDS, sort=sort, limit=20)
+            page_durations.append(time.time() - start)
+
+            start = time.time()
+            database.find_one(JobModel, ids[(i * 7919) % size])
+            find_one_durations.append(time.time() - start)
+        results.append({
+            "collection_size": size,
+            "list_all_summaries_seconds": get_percentiles(list_durations),
+            "first_page_seconds": get_percentiles(page_durations),
+            "find_one_seconds": get_percentiles(find_one_durations),
+        })
+    return results
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmarks of the job launch rate and the output ingestion')
+    parser.add_argument('--mongo-host', default=config.MONGO_HOST)
+    parser.add_argument('--mongo-port', default=config.MONGO_PORT, type=int)
+    parser.add_argument('--in-process', action="store_true", help="use mongomock instead of a mongod")
+    parser.add_argument('--jobs', default=200, type=int)
+    parser.add_argument('--latency-jobs', default=50, type=int)
+    parser.add_argument('--max-concurrency', default=None, type=int)
+    parser.add_argument('--lines', default=200000, type=int)
+    parser.add_argument('--sizes', default=[100, 1000, 10000], type=int, nargs="*")
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--output', help="json file, stdout by default")
+    args = parser.parse_args()
+
+    if args.in_process:
+        import mongomock
+        import db
+        db.DATABASE_TYPES += (mongomock.Database,)
+        client = mongomock.MongoClient()
+        backend = "mongomock"
+    else:
+        client = pymongo.MongoClient(args.mongo_host, args.mongo_port)
+        backend = "mongod %s" % (client.server_info()["version"],)
+    mongo_db = client[BENCHMARK_DATABASE]
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = {
+            "launch_rate": benchmark_launch_rate(mongo_db, directory, args.jobs, args.max_concurrency),
+            "submit_to_running_latency_seconds": benchmark_submit_to_running_latency(mongo_db, directory, args.latency_jobs),
+            "output_ingestion": benchmark_output_ingestion(directory, args.lines),
+            "find_latency": benchmark_find_latency(mongo_db, args.sizes, args.repeat),
+        }
+    finally:
+        client.drop_database(BENCHMARK_DATABASE)
+        shutil.rmtree(directory)
+
+    report = {
+        "date": datetime.datetime.now().isoformat(),
+        "hostname": socket.gethostname(),
+        "backend": backend,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print output
+    else:
+        with open(args.output, "w") as fd:
+            fd.write(output)
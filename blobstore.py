@@ -0,0 +1,173 @@
+import os
+import time
+import datetime
+import hashlib
+import shutil
+import tempfile
+
+import config
+
+BLOCK_SIZE = 1 << 20
+
+# content hash of a file, read block by block
+def hash_file(filename, block_size=BLOCK_SIZE):
+    h = hashlib.sha1()
+    size = 0
+    with open(filename, "rb") as fd:
+        while True:
+            block = fd.read(block_size)
+            if not block:
+                break
+            h.update(block)
+            size += len(block)
+    return h.hexdigest(), size
+
+# what is stored in the job documents instead of the content of a file
+def make_blob_reference(key, size, filename):
+    return {"blob": key, "size": size, "filename": filename}
+
+def is_blob_reference(value):
+    return isinstance(value, dict) and "blob" in value
+
+# Blobs are identified by the hash of their content, a content
+# stored several times (e.g same input file for many jobs) is stored once
+class BlobStore(object):
+
+    # store the content of the file if needed and return a reference to it
+    def put_file(self, filename, name=None):
+        key, size = hash_file(filename)
+        if not self.exists(key):
+            self.store(key, filename)
+        return make_blob_reference(key, size, name if name is not None else filename)
+
+    # read at most size bytes from offset, used to stream blobs through Pyro
+    def read(self, key, offset, size=BLOCK_SIZE):
+        fd = self.open(key)
+        try:
+            fd.seek(offset)
+            return fd.read(size)
+        finally:
+            fd.close()
+
+    # write the content of the blob to the file filename
+    def get_file(self, key, filename):
+        with open(filename, "wb") as fd:
+            for block in self.iter_blocks(key):
+                fd.write(block)
+
+    def iter_blocks(self, key, block_size=BLOCK_SIZE):
+        fd = self.open(key)
+        try:
+            while True:
+                block = fd.read(block_size)
+                if not block:
+                    break
+                yield block
+        finally:
+            fd.close()
+
+    def exists(self, key):
+        raise NotImplementedError()
+
+    def store(self, key, filename):
+        raise NotImplementedError()
+
+    def open(self, key):
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    # the keys of the blobs stored at least min_age seconds ago
+    def iter_keys(self, min_age=0):
+        raise NotImplementedError()
+
+
+class GridFSBlobStore(BlobStore):
+
+    def __init__(self, db, collection="blobs"):
+        # imported here : the client uses this module without pymongo
+        import gridfs
+        self.gridfs = gridfs
+        self.fs = gridfs.GridFS(db, collection)
+        self.files = db[collection].files
+
+    def exists(self, key):
+        return self.fs.exists(key)
+
+    def store(self, key, filename):
+        with open(filename, "rb") as fd:
+            try:
+                self.fs.put(fd, _id=key, chunk_size=BLOCK_SIZE / 4)
+            except self.gridfs.errors.FileExists:
+                # stored in the meantime by someone else
+                pass
+
+    def open(self, key):
+        return self.fs.get(key)
+
+    def delete(self, key):
+        self.fs.delete(key)
+
+    def iter_keys(self, min_age=0):
+        # the upload dates of GridFS are in UTC
+        limit = datetime.datetime.utcnow() - datetime.timedelta(seconds=min_age)
+        for data in self.files.find({"uploadDate": {"$lte": limit}}, {"_id": True}):
+            yield data["_id"]
+
+
+# one file per blob in directory, mainly for tests
+class LocalBlobStore(BlobStore):
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[0:2], key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def store(self, key, filename):
+        path = self.path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        # copy then rename, a blob is never seen partially written
+        fd_dst, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd_dst, "wb") as dst, open(filename, "rb") as src:
+            shutil.copyfileobj(src, dst, BLOCK_SIZE)
+        os.rename(tmp_path, path)
+
+    def open(self, key):
+        return open(self.path(key), "rb")
+
+    def delete(self, key):
+        os.remove(self.path(key))
+
+    # the temporary files of store() are not in the sub directories
+    def iter_keys(self, min_age=0):
+        limit = time.time() - min_age
+        for prefix in os.listdir(self.directory):
+            directory = os.path.join(self.directory, prefix)
+            if not os.path.isdir(directory):
+                continue
+            for key in os.listdir(directory):
+                if os.path.getmtime(os.path.join(directory, key)) <= limit:
+                    yield key
+
+
+def make_blob_store(mongo_db, backend=None, directory=None):
+    backend = backend if backend is not None else config.BLOB_STORE
+    if backend == "gridfs":
+        return GridFSBlobStore(mongo_db)
+    elif backend == "local":
+        return LocalBlobStore(directory if directory is not None else config.BLOB_STORE_DIRECTORY)
+    elif backend is None:
+        return None
+    else:
+        raise ValueError("unknown blob store : %s" % (backend,))
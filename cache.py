@@ -0,0 +1,111 @@
+import json
+import hashlib
+import datetime
+
+import config
+from db import Model, JobModel, WriteBatch, decompress_value, get_value_size
+from blobstore import is_blob_reference
+
+# seconds between two evictions
+EVICTION_INTERVAL = 60
+
+# hash of what determines the result of a job : command, working directory
+# and content of the input files (input_data must be already stored)
+def get_cache_key(job_model):
+    h = hashlib.sha1()
+    h.update(json.dumps([job_model.command_model.args, job_model.command_model.cwd]))
+    for name in sorted(job_model.input_data.keys()):
+        value = job_model.input_data[name]
+        if is_blob_reference(value):
+            content_hash = value["blob"]
+        else:
+            content_hash = hashlib.sha1(decompress_value(value)).hexdigest()
+        h.update(json.dumps([name, content_hash]))
+    return h.hexdigest()
+
+def get_output_size(job_model):
+    size = 0
+    for value in job_model.output_data.values():
+        size += value["size"] if is_blob_reference(value) else get_value_size(value)
+    return size
+
+# the successful job whose output is reused, its _id is the cache key
+class ResultCacheModel(Model):
+
+    INDEXES = [
+        [("created", 1)],
+    ]
+
+    def __init__(self, key, job_id, size):
+        Model.__init__(self)
+        self._id = key
+        self.job_id = job_id
+        self.size = size
+        self.created = datetime.datetime.now()
+
+
+class ResultCache(object):
+
+    def __init__(self, database, max_age=None, max_size=None):
+        self.database = database
+        self.max_age = max_age if max_age is not None else config.RESULT_CACHE_MAX_AGE
+        self.max_size = max_size if max_size is not None else config.RESULT_CACHE_MAX_SIZE
+        self.last_eviction = None
+        # cache key -> job model of the entries stored in a WriteBatch not flushed yet
+        self.pending = {}
+
+    # the stopped job with the same cache key as job_model, None if there is none
+    def lookup(self, job_model):
+        if job_model.cache_key in self.pending:
+            return self.pending[job_model.cache_key]
+        entry = self.database.find_one(ResultCacheModel, job_model.cache_key)
+        if entry is None or self.is_expired(entry):
+            return None
+        cached_job_model = self.database.find_one(JobModel, entry.job_id)
+        if cached_job_model is not None and getattr(cached_job_model, "archive", None) is not None:
+            if not self.database.restore_job(cached_job_model._id):
+                return None
+            cached_job_model = self.database.find_one(JobModel, entry.job_id)
+        if cached_job_model is None or cached_job_model.state == JobModel.NOT_YET_STARTED:
+            self.database.remove(ResultCacheModel, {"_id": entry._id})
+            return None
+        # its STOPPED state is not written yet (e.g stored by another worker)
+        if cached_job_model.state != JobModel.STOPPED:
+            return None
+        return cached_job_model
+
+    # database can be the WriteBatch in which the job itself is saved : 
+    # the entry is written after the job
+    def store(self, job_model, nb_stdout_bytes=0, database=None):
+        database = database if database is not None else self.database
+        entry = ResultCacheModel(job_model.cache_key, job_model._id,
+                                 get_output_size(job_model) + nb_stdout_bytes)
+        database.save(entry)
+        if isinstance(database, WriteBatch):
+            key = entry._id
+            self.pending[key] = job_model
+            database.add_flush_callback(lambda: self.pending.pop(key, None))
+        now = datetime.datetime.now()
+        if self.last_eviction is None or (now - self.last_eviction).total_seconds() > EVICTION_INTERVAL:
+            self.evict()
+            self.last_eviction = now
+
+    def is_expired(self, entry):
+        if self.max_age is None:
+            return False
+        return (datetime.datetime.now() - entry.created).total_seconds() > self.max_age
+
+    def evict(self):
+        if self.max_age is not None:
+            limit = datetime.datetime.now() - datetime.timedelta(seconds=self.max_age)
+            self.database.remove(ResultCacheModel, {"created": {"$lt": limit}})
+        if self.max_size is not None:
+            # newest first, everything after max_size is evicted
+            total_size = 0
+            evicted = []
+            for entry in self.database.find_iter(ResultCacheModel, {}, {"size": True}, sort=[("created", -1)]):
+                total_size += entry.size
+                if total_size > self.max_size:
+                    evicted.append(entry._id)
+            if len(evicted):
+                self.database.remove(ResultCacheModel, {"_id": {"$in": evicted}})
@@ -0,0 +1,106 @@
+# storage of the stdout of new jobs :
+#   "chunks" : each new slice of output is inserted in the OutputChunkModel
+#              collection, the job document itself is not rewritten
+#   "inline" : the output is concatenated to job_model.output_data["stdout"]
+#              and the whole job document is saved again
+STDOUT_STORAGE = "chunks"
+# in "inline" mode a job switches to "chunks" when its stdout is bigger than 
+# this number of bytes
+INLINE_STDOUT_MAX_SIZE = 1024 * 1024
+# maximum number of bytes of output read from a stream of a process in
+# one iteration of the event loop, the rest stays in the pipe
+OUTPUT_BUFFER_SIZE = 1024 * 1024
+
+# the output files of the running jobs are checked every this number of
+# seconds (None to disable) : the blocks of this number of bytes which 
+# changed are stored as output chunks (stream "file:<name>")
+OUTPUT_FILES_SNAPSHOT_INTERVAL = 30
+OUTPUT_FILES_SNAPSHOT_BLOCK_SIZE = 1024 * 1024
+# maximum number of bytes of output files read by an iteration of the event
+# loop, a bigger snapshot continues at the next iterations
+OUTPUT_FILES_SNAPSHOT_MAX_SIZE = 8 * 1024 * 1024
+
+# maximum number of jobs running at the same time, None means the number of cores
+MAX_CONCURRENT_JOBS = None
+
+# maximum number of running jobs per category, e.g {"gpu": 1}
+CATEGORY_LIMITS = {}
+
+# cores (list of ids) and memory (bytes) given to the jobs declaring resources
+# (CommandModel.cores/memory), None for all the cores of the server and all 
+# the memory of the host
+RESOURCE_CPUS = None
+RESOURCE_MEMORY = None
+# writable cgroup v2 directory in which a cgroup is created per job to limit
+# its memory and cores, rlimits and the affinity are used when it does not exist
+CGROUP_ROOT = "/sys/fs/cgroup/experiments"
+
+# storage of the input/output files of jobs, content addressed and deduplicated :
+#   "gridfs" : in the GridFS of the mongo database
+#   "local"  : in the directory BLOB_STORE_DIRECTORY
+#   None     : the content is stored inline in the job document
+BLOB_STORE = "gridfs"
+BLOB_STORE_DIRECTORY = "blobs"
+# the blobs referenced by no job are deleted by the "gcblobs" client action,
+# except the ones stored less than this number of seconds ago (their job may 
+# not be saved yet)
+BLOB_GC_MIN_AGE = 24 * 3600
+
+# compression of the stdout and of the content of the files stored in the 
+# job documents and of the output chunks : "zlib", "bz2" or None. The 
+# documents stored before can be compressed with the "compress" client action
+COMPRESSION = "zlib"
+# strings smaller than this number of bytes are not compressed
+COMPRESSION_MIN_SIZE = 256
+
+# documents returned by Database.find_one kept in memory by the server 
+# (see DocumentCache) : maximum number of documents (0 to disable) and 
+# maximum total size in bytes
+DOCUMENT_CACHE_MAX_ENTRIES = 1000
+DOCUMENT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# index the terms (words) of the stdout/stderr and of the input/output files 
+# of the jobs, to find jobs by content (see search.py)
+SEARCH_INDEX = True
+# only the first bytes of each data and the first distinct terms are indexed
+SEARCH_INDEX_MAX_SIZE = 16 * 1024 * 1024
+SEARCH_INDEX_MAX_TERMS = 100000
+
+# how experiments_server.py handles the requests of the clients :
+#   "threads"   : one thread per client, the processes are managed by another thread
+#   "multiplex" : the requests and the processes are watched by the same event loop,
+#                 the requests are handled by a pool of SERVER_REQUEST_THREADS threads
+#                 and the database writes of the loop by another thread
+SERVER_MODE = "threads"
+SERVER_REQUEST_THREADS = 8
+
+# mongo database shared by the server and the workers
+MONGO_HOST = "localhost"
+MONGO_PORT = 27017
+MONGO_DATABASE = "Test"
+
+# seconds between two heartbeats of a worker
+WORKER_HEARTBEAT_INTERVAL = 10
+# a worker without heartbeat for this number of seconds is considered dead,
+# its unfinished jobs are put back in the queue
+WORKER_DEAD_AFTER = 60
+
+# the stopped jobs are archived this number of seconds after they stopped or 
+# were last restored (None to only archive with the "archive" client action) :
+# their input/output data and output chunks are moved to a gzipped file per 
+# job in ARCHIVE_DIRECTORY, on the host of the server (None to disable), and
+# restored when they are read (see archive.py)
+ARCHIVE_AFTER = None
+ARCHIVE_DIRECTORY = "archives"
+# seconds between two archiving passes of the server, done by batches of 
+# this number of jobs in a thread of the server
+ARCHIVE_INTERVAL = 3600
+ARCHIVE_BATCH_SIZE = 100
+
+# reuse the output of a successful job with the same command, cwd and 
+# input files instead of running it again (see cache.py)
+RESULT_CACHE = False
+# results older than this number of seconds are evicted, None for no limit
+RESULT_CACHE_MAX_AGE = 30 * 24 * 3600
+# the oldest results are evicted when their total size (bytes) is above, None for no limit
+RESULT_CACHE_MAX_SIZE = None
@@ -3,19 +3,58 @@
 from util import (default_value, get_formatted_list, 
     get_formatted_element, DatetimeRange)
 import os
+import bz2
+import zlib
+import time
+import math
+import datetime
+import itertools
+import threading
 import cPickle as pickle
+import config
 import pymongo
+from pymongo import InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteMany
 from copy import deepcopy
+from collections import OrderedDict
 
+from metrics import Metrics, Timer
+from blobstore import is_blob_reference
+
+from bson import BSON
 from bson.objectid import ObjectId
+from bson.binary import Binary
+
+# the mongo databases a Database can use, benchmark.py adds the one of
+# mongomock (an in-process stand-in for mongo)
+DATABASE_TYPES = (pymongo.database.Database,)
+
+# cursors not used for this number of seconds are closed
+CURSOR_TIMEOUT = 600
 
 class Database(object):
-    def __init__(self, db):
-        assert isinstance(db, pymongo.database.Database)
+    def __init__(self, db, blob_store=None, archive=None):
+        assert isinstance(db, DATABASE_TYPES)
         self.db = db
+        # where the input/output files of jobs are stored, None for inline
+        self.blob_store = blob_store
+        # where the data of the old jobs are moved (see archive_job), None to disable
+        self.archive = archive
+        self.cursors = {}
+        self.cursors_lock = threading.Lock()
+        self.metrics = Metrics()
+        # documents returned by find_one, None when disabled
+        self.document_cache = None
+        if config.DOCUMENT_CACHE_MAX_ENTRIES:
+            self.document_cache = DocumentCache(config.DOCUMENT_CACHE_MAX_ENTRIES,
+                                                config.DOCUMENT_CACHE_MAX_BYTES)
 
-    # proxy to mongo db find
+    # proxy to mongo db find, the second argument is the projection 
+    # (fields to fetch), limit and skip are done by mongo
     def find(self, model_cls, *args, **kwargs):
+        return list(self.find_iter(model_cls, *args, **kwargs))
+
+    # same as find, the models are built one by one while iterating
+    def find_iter(self, model_cls, *args, **kwargs):
         assert issubclass(model_cls, Model)
         if "sort" in kwargs:
             sort_ = kwargs["sort"]
@@ -25,51 +64,946 @@ class Database(object):
         models = self.db[model_cls.__name__].find(*args, **kwargs)
         if len(sort_):
             models = models.sort(sort_)
-        g = (model_cls.from_db(model_cls, data) 
-                for data in models) 
-        return list(g)
+        return (self.__loaded(model_cls.from_db(model_cls, data))
+                for data in models)
+
+    # Generators can not go through Pyro, open_cursor/next_batch/close_cursor 
+    # let a client iterate over the results of a find with constant memory 
+    # on both sides (see iter_find)
+    def open_cursor(self, model_cls, *args, **kwargs):
+        cursor = self.find_iter(model_cls, *args, **kwargs)
+        with self.cursors_lock:
+            self.__close_expired_cursors()
+            cursor_id = str(ObjectId())
+            self.cursors[cursor_id] = [cursor, time.time()]
+        return cursor_id
+
+    # the next models of the cursor, an empty list when there are no more models
+    def next_batch(self, cursor_id, size=100):
+        with self.cursors_lock:
+            cursor_and_time = self.cursors[cursor_id]
+            cursor_and_time[1] = time.time()
+        models = list(itertools.islice(cursor_and_time[0], size))
+        if len(models) == 0:
+            self.close_cursor(cursor_id)
+        return models
+
+    def close_cursor(self, cursor_id):
+        with self.cursors_lock:
+            self.cursors.pop(cursor_id, None)
+
+    def __close_expired_cursors(self):
+        now = time.time()
+        for cursor_id, (cursor, last_used) in self.cursors.items():
+            if now - last_used > CURSOR_TIMEOUT:
+                del self.cursors[cursor_id]
+
+    # create the indexes declared by the model classes (Model.INDEXES),
+    # mongo does nothing for the indexes which already exist
+    def ensure_indexes(self, model_classes):
+        for model_cls in model_classes:
+            for index in model_cls.INDEXES:
+                self.db[model_cls.__name__].create_index(index)
+
+    # how mongo executes a find : a short summary of the explain() of the query
+    def explain(self, model_cls, *args, **kwargs):
+        assert issubclass(model_cls, Model)
+        sort_ = kwargs.pop("sort", [])
+        cursor = self.db[model_cls.__name__].find(*args, **kwargs)
+        if len(sort_):
+            cursor = cursor.sort(sort_)
+        return get_explain_summary(cursor.explain())
+
+    # proxy to mongo db distinct : the distinct values of key 
+    # in the documents matching params
+    def distinct(self, model_cls, key, params=None):
+        assert issubclass(model_cls, Model)
+        return self.db[model_cls.__name__].distinct(key, params)
+
+    # proxy to mongo db count
+    def count(self, model_cls, *args, **kwargs):
+        assert issubclass(model_cls, Model)
+        return self.db[model_cls.__name__].find(*args, **kwargs).count()
+
     # proxy to mongo db find_one
+    # a cached document is used if it has still the same _version in mongo :
+    # only its _version is fetched instead of the whole document
     def find_one(self, model_cls, id_):
         assert issubclass(model_cls, Model)
 
-        result = self.db[model_cls.__name__].find_one(ObjectId(id_))
+        # models can also have ids which are not ObjectIds (e.g WorkerModel)
+        if not isinstance(id_, ObjectId) and ObjectId.is_valid(id_):
+            id_ = ObjectId(id_)
+        collection = self.db[model_cls.__name__]
+        key = (model_cls.__name__, id_)
+        if self.document_cache is not None:
+            cached = self.document_cache.get(key)
+            if cached is not None:
+                version, result = cached
+                current = collection.find_one({"_id": id_}, {"_version": True})
+                if current is not None and current.get("_version") == version:
+                    self.metrics.count("document_cache_hits")
+                    return self.__loaded(model_cls.from_db(model_cls, result))
+                self.document_cache.invalidate(key)
+            self.metrics.count("document_cache_misses")
+        result = collection.find_one({"_id": id_})
         if result is None:
             return None
-        return model_cls.from_db(model_cls, result)
+        if self.document_cache is not None and "_version" in result:
+            self.document_cache.put(key, result["_version"], result)
+        return self.__loaded(model_cls.from_db(model_cls, result))
+
+    def __invalidate(self, model_cls, id_=None):
+        if self.document_cache is None:
+            return
+        if id_ is None:
+            self.document_cache.invalidate_collection(model_cls.__name__)
+        else:
+            self.document_cache.invalidate((model_cls.__name__, id_))
+
+    def __loaded(self, object):
+        object.mark_saved()
+        return object
 
     # proxy to mongo db insert
     def insert(self, object):
         assert isinstance(object, Model)
-        return self.db[object.__class__.__name__].insert(object.to_db())
+        id_ = self.db[object.__class__.__name__].insert(get_versioned_document(object))
+        object.mark_saved()
+        return id_
+
+    # proxy to mongo db insert_many, returns the ids of the objects
+    def insert_many(self, objects):
+        if len(objects) == 0:
+            return []
+        assert all(isinstance(object, Model) for object in objects)
+        collection_name = objects[0].__class__.__name__
+        documents = [get_versioned_document(object) for object in objects]
+        ids = self.db[collection_name].insert_many(documents).inserted_ids
+        for object, id_ in zip(objects, ids):
+            object._id = id_
+            object.mark_saved()
+        return ids
 
     # proxy to mongo db save (= update of one object)
+    # if the object was loaded or saved by this Database, only the fields
+    # changed since then are sent, otherwise the whole document is replaced
+    # (only if it matches its save spec, see JobModel.get_save_spec)
     def save(self, object):
         assert object._id is not None
-        result = object.to_db()
-        return self.db[object.__class__.__name__].save(result)
+        collection = self.db[object.__class__.__name__]
+        spec = object.get_save_spec()
+        if object.has_snapshot():
+            update = object.get_update()
+            if len(update):
+                collection.update_one(spec, get_versioned_update(update))
+        elif len(spec) > 1:
+            collection.replace_one(spec, get_versioned_document(object))
+        else:
+            collection.save(get_versioned_document(object))
+        self.__invalidate(object.__class__, object._id)
+        object.mark_saved()
+        return object._id
 
     # proxy to mongo db drop = Delete all instances
     def drop(self, model_cls, *args, **kwargs):
         assert issubclass(model_cls, Model)
+        self.__invalidate(model_cls)
         return self.db[model_cls.__name__].drop(*args, **kwargs)
     #proxy to mongo db remove = remove some elements
     def remove(self, model_cls, *args, **kwargs):
         assert issubclass(model_cls, Model)
+        if len(args) and not isinstance(args[0], dict):
+            self.__invalidate(model_cls, args[0])
+        else:
+            self.__invalidate(model_cls)
         return self.db[model_cls.__name__].remove(*args, **kwargs)
+
+    # append a new slice of the output of a job (see OutputChunkModel), 
+    # the cost does not depend on the size of the output already stored
+    def append_output(self, chunk):
+        assert isinstance(chunk, OutputChunkModel)
+        return self.insert(chunk)
+
+    # store the chunk in place of the chunk of the same stream and index, 
+    # if any (e.g a block of an output file, see OutputFileSnapshot)
+    def put_output(self, chunk):
+        assert isinstance(chunk, OutputChunkModel)
+        self.db[OutputChunkModel.__name__].replace_one(
+                get_chunk_spec(chunk), get_versioned_document(chunk), upsert=True)
+
+    # remove the chunks of the stream from the chunk of index start
+    def truncate_output(self, job_id, stream, start=0):
+        self.db[OutputChunkModel.__name__].delete_many(get_truncate_output_spec(job_id, stream, start))
+
+    # reassemble the output of a job stored in "chunks" mode, as a list 
+    # of strings in the order they were produced, optionally only limit 
+    # chunks from the chunk of index start
+    def find_output(self, job_id, stream="stdout", start=0, limit=0):
+        chunks = self.db[OutputChunkModel.__name__].find(
+                {"job_id": ObjectId(job_id), "stream": stream, "index": {"$gte": start}},
+                {"data": True}, limit=limit).sort([("index", 1)])
+        return [get_bytes(decompress_value(chunk["data"])) for chunk in chunks]
+
+    # atomically take the next job of the queue (NOT_YET_STARTED and not 
+    # claimed) matching params for the worker, None if there is no such job
+    def claim_job(self, worker_id, params=None, sort=None):
+        spec = {"state": JobModel.NOT_YET_STARTED, "worker_id": None}
+        if params is not None:
+            spec.update(params)
+        data = self.db[JobModel.__name__].find_one_and_update(
+                spec, {"$set": {"worker_id": worker_id, "_version": new_version()}},
+                sort=sort, return_document=pymongo.ReturnDocument.AFTER)
+        if data is None:
+            return None
+        return self.__loaded(JobModel.from_db(JobModel, data))
+
+    # stops the job if no worker owns it (True), or asks the worker which
+    # claimed it to kill it (see Worker.find_kill_requests) : the worker 
+    # would overwrite the state when it starts the job
+    def request_kill(self, job_id):
+        collection = self.db[JobModel.__name__]
+        result = collection.update_one(
+                {"_id": job_id, "worker_id": None, "state": {"$ne": JobModel.STOPPED}},
+                {"$set": {"state": JobModel.STOPPED, "_version": new_version()}})
+        if result.matched_count == 0:
+            collection.update_one(
+                    {"_id": job_id, "worker_id": {"$ne": None}, "state": {"$ne": JobModel.STOPPED}},
+                    {"$set": {"kill_requested": True, "_version": new_version()}})
+        self.__invalidate(JobModel, job_id)
+        return result.matched_count == 1
+
+    # put back in the queue the unfinished jobs claimed by a worker,
+    # their partial output is removed. Returns the number of requeued jobs.
+    # The killed ones are stopped by the worker claiming them next
+    def requeue_jobs_of_worker(self, worker_id):
+        spec = {"worker_id": worker_id,
+                "state": {"$in": [JobModel.NOT_YET_STARTED, JobModel.RUNNING]}}
+        collection = self.db[JobModel.__name__]
+        job_ids = [data["_id"] for data in collection.find(spec, {"_id": True})]
+        if len(job_ids) == 0:
+            return 0
+        self.db[OutputChunkModel.__name__].remove({"job_id": {"$in": job_ids}})
+        self.db[SearchTermsModel.__name__].remove({"job_id": {"$in": job_ids}})
+        spec["_id"] = {"$in": job_ids}
+        result = collection.update_many(spec, {
+                "$set": {"state": JobModel.NOT_YET_STARTED, "worker_id": None,
+                         "datetime_from": None, "datetime_to": None,
+                         "output_data": {"stdout": ""}, "_version": new_version()}})
+        return result.modified_count
+
+    # the jobs depending on job_id do not wait for it anymore, 
+    # they can be claimed once they do not wait for any other job
+    def release_dependents(self, job_id):
+        self.db[JobModel.__name__].update_many(
+                *get_release_dependents_update(job_id))
+
+    # the queued jobs depending on job_id, which failed, are stopped without being 
+    # run, and so on for the jobs depending on them. Returns their ids
+    def cancel_dependents(self, job_id):
+        collection = self.db[JobModel.__name__]
+        cancelled = []
+        job_ids = [job_id]
+        while len(job_ids):
+            spec = {"depends_on": {"$in": job_ids}, 
+                    "state": JobModel.NOT_YET_STARTED, "worker_id": None}
+            job_ids = [data["_id"] for data in collection.find(spec, {"_id": True})]
+            if len(job_ids) == 0:
+                break
+            spec["_id"] = {"$in": job_ids}
+            now = datetime.datetime.now()
+            collection.update_many(spec, {"$set": {
+                "state": JobModel.STOPPED, "cancelled": True,
+                "datetime_from": now, "datetime_to": now, "_version": new_version()}})
+            cancelled.extend(job_ids)
+        for job_id in cancelled:
+            self.__invalidate(JobModel, job_id)
+        return cancelled
+
+    # for the jobs job_ids just inserted with the dependencies depends_on (e.g
+    # a sweep) : the parents which already succeeded are not waited for and 
+    # the jobs are cancelled if a parent already failed or does not exist,
+    # whatever the number of jobs. The parents which stop later release or 
+    # cancel the jobs themselves (see MultipleProcessesManager)
+    def resolve_dependencies(self, depends_on, job_ids):
+        if len(depends_on) == 0 or len(job_ids) == 0:
+            return
+        parents = self.find(JobModel, {"_id": {"$in": depends_on}},
+                            {"return_code": True, "state": True})
+        found_ids = set(parent._id for parent in parents)
+        unknown_ids = [id_ for id_ in depends_on if id_ not in found_ids]
+        stopped = [parent for parent in parents if parent.state == JobModel.STOPPED]
+        if len(unknown_ids) == 0 and len(stopped) == 0:
+            return
+        collection = self.db[JobModel.__name__]
+        spec = {"_id": {"$in": job_ids}, "state": JobModel.NOT_YET_STARTED, "worker_id": None}
+        if len(unknown_ids) == 0 and all(parent.has_succeeded() for parent in stopped):
+            collection.update_many(spec, {
+                "$pullAll": {"waiting_on": [parent._id for parent in stopped]},
+                "$set": {"_version": new_version()}})
+        else:
+            # nothing depends on the jobs yet : no cascade (see cancel_dependents)
+            now = datetime.datetime.now()
+            changes = {"state": JobModel.STOPPED, "cancelled": True,
+                       "datetime_from": now, "datetime_to": now, "_version": new_version()}
+            if len(unknown_ids):
+                changes["error"] = "unknown jobs it depends on : %s" % ", ".join(map(str, unknown_ids))
+            collection.update_many(spec, {"$set": changes})
+        for job_id in job_ids:
+            self.__invalidate(JobModel, job_id)
+
+    # False if the worker is not registered anymore
+    def update_heartbeat(self, worker_id, heartbeat):
+        result = self.db[WorkerModel.__name__].update_one(
+                {"_id": worker_id}, {"$set": {"heartbeat": heartbeat, "_version": new_version()}})
+        return result.matched_count == 1
+
+    # writes done through the batch are sent together by batch.flush()
+    # (see WriteBatch for worker_id)
+    def new_write_batch(self, ordered=True, worker_id=None):
+        return WriteBatch(self, ordered, worker_id)
+
+    # read a part of a blob of the blob store, a blob is streamed 
+    # by reading it part by part
+    def read_blob(self, key, offset, size):
+        assert self.blob_store is not None
+        return self.blob_store.read(key, offset, size)
+
+    # statistics of the jobs matching params, computed by mongo with
+    # aggregation pipelines : only the (small) result is returned
+    #   states     : {state: number of jobs}
+    #   categories : {category: {state: number of jobs}}
+    #   durations  : {category, None for all the jobs: {percentile: seconds}}
+    #                of the stopped jobs
+    #   throughput : [(hour, number of jobs stopped during the hour)]
+    def job_stats(self, params=None, percentiles=(50, 90, 99)):
+        collection = self.db[JobModel.__name__]
+        match = {"$match": params if params is not None else {}}
+
+        states = {}
+        for row in collection.aggregate([match, {"$group": {"_id": "$state", "count": {"$sum": 1}}}]):
+            states[row["_id"]] = row["count"]
+
+        categories = {}
+        for row in collection.aggregate([match, {"$unwind": "$command_model.categories"},
+                {"$group": {"_id": {"category": "$command_model.categories", "state": "$state"},
+                            "count": {"$sum": 1}}}]):
+            categories.setdefault(row["_id"]["category"], {})[row["_id"]["state"]] = row["count"]
+
+        durations = {None: self.__duration_percentiles(match, None, percentiles)}
+        for category in categories:
+            durations[category] = self.__duration_percentiles(match, category, percentiles)
+
+        throughput = []
+        for row in collection.aggregate([match, 
+                {"$match": {"state": JobModel.STOPPED, "datetime_to": {"$ne": None}}},
+                {"$group": {"_id": get_hour_key("$datetime_to"), "count": {"$sum": 1}}},
+                {"$sort": {"_id.year": 1, "_id.month": 1, "_id.day": 1, "_id.hour": 1}}]):
+            hour = row["_id"]
+            throughput.append((datetime.datetime(hour["year"], hour["month"], hour["day"], hour["hour"]), 
+                               row["count"]))
+
+        return {"states": states, "categories": categories, 
+                "durations": durations, "throughput": throughput}
+
+    # nearest rank percentiles of the durations (seconds) of the stopped jobs,
+    # mongo < 3.2 has no percentile operator : each percentile is the 
+    # duration at its rank in the sorted durations
+    def __duration_percentiles(self, match, category, percentiles):
+        collection = self.db[JobModel.__name__]
+        pipeline = [match, {"$match": {"state": JobModel.STOPPED, 
+                                       "datetime_from": {"$ne": None}, "datetime_to": {"$ne": None}}}]
+        if category is not None:
+            pipeline.append({"$match": {"command_model.categories": category}})
+        pipeline.append({"$project": {"duration": {"$subtract": ["$datetime_to", "$datetime_from"]}}})
+        count = list(collection.aggregate(pipeline + [{"$group": {"_id": None, "count": {"$sum": 1}}}]))
+        count = count[0]["count"] if len(count) else 0
+        if count == 0:
+            return {}
+        result = {}
+        for percentile in percentiles:
+            rank = max(int(math.ceil(percentile / 100. * count)) - 1, 0)
+            rows = list(collection.aggregate(pipeline + [{"$sort": {"duration": 1}}, 
+                                                         {"$skip": rank}, {"$limit": 1}],
+                                             allowDiskUse=True))
+            # the difference of two dates is in milliseconds
+            result[percentile] = rows[0]["duration"] / 1000. if len(rows) else None
+        return result
+
+    # move the input/output data and the output chunks of the stopped job to 
+    # the archive, a slim document stays in the collection until the job is 
+    # restored (see restore_job), with the keys of the blobs referenced by 
+    # the archive. Returns False if the job changed meanwhile
+    def archive_job(self, job_id):
+        assert self.archive is not None
+        collection = self.db[JobModel.__name__]
+        data = collection.find_one({"_id": job_id, "state": JobModel.STOPPED, "archive": {"$exists": False}},
+                                   {"input_data": True, "output_data": True, "_version": True})
+        if data is None:
+            return False
+        chunks = list(self.db[OutputChunkModel.__name__].find({"job_id": job_id}))
+        name = self.archive.write(job_id, {"input_data": data.get("input_data", {}), 
+                                           "output_data": data.get("output_data", {}), 
+                                           "chunks": chunks})
+        result = collection.update_one({"_id": job_id, "_version": data.get("_version")},
+                                       {"$unset": {"input_data": "", "output_data": ""},
+                                        "$set": {"archive": name, "archived_blobs": get_blob_keys(data),
+                                                 "_version": new_version()}})
+        self.__invalidate(JobModel, job_id)
+        if result.modified_count == 0:
+            self.archive.delete(name)
+            return False
+        self.db[OutputChunkModel.__name__].delete_many({"job_id": job_id})
+        return True
+
+    # archive at most limit jobs stopped before the date (default : 
+    # config.ARCHIVE_AFTER seconds ago) and not restored since. 
+    # Returns the number of archived jobs
+    def archive_old_jobs(self, before=None, limit=None):
+        if self.archive is None:
+            raise ValueError("archiving is disabled (config.ARCHIVE_DIRECTORY)")
+        if before is None:
+            if config.ARCHIVE_AFTER is None:
+                raise ValueError("no date given and no default age (config.ARCHIVE_AFTER)")
+            before = datetime.datetime.now() - datetime.timedelta(seconds=config.ARCHIVE_AFTER)
+        cursor = self.db[JobModel.__name__].find(
+                {"state": JobModel.STOPPED, "datetime_to": {"$lt": before}, 
+                 "archive": {"$exists": False}, "restored": {"$not": {"$gte": before}}},
+                {"_id": True}, limit=limit if limit is not None else 0)
+        return sum(1 for data in list(cursor) if self.archive_job(data["_id"]))
+
+    # put back in the collection what archive_job moved to the archive. The 
+    # job stays archived if its archive can not be read (e.g the archive is 
+    # on another host) : returns False
+    def restore_job(self, job_id):
+        data = self.db[JobModel.__name__].find_one({"_id": job_id}, {"archive": True})
+        if data is None or "archive" not in data:
+            return True
+        content = self.archive.read(data["archive"]) if self.archive is not None else None
+        if content is None:
+            return False
+        if len(content["chunks"]):
+            try:
+                self.db[OutputChunkModel.__name__].insert_many(content["chunks"], ordered=False)
+            except pymongo.errors.BulkWriteError:
+                pass # already restored by another request
+        self.db[JobModel.__name__].update_one({"_id": job_id, "archive": data["archive"]},
+                {"$set": {"input_data": content["input_data"], "output_data": content["output_data"],
+                          "restored": datetime.datetime.now(), "_version": new_version()},
+                 "$unset": {"archive": "", "archived_blobs": ""}})
+        self.__invalidate(JobModel, job_id)
+        self.archive.delete(data["archive"])
+        return True
+
+    # delete the archives of the jobs matching params (e.g before removing them)
+    def delete_archives(self, params):
+        if self.archive is None:
+            return
+        params = dict(params, archive={"$exists": True})
+        for data in self.db[JobModel.__name__].find(params, {"archive": True}):
+            self.archive.delete(data["archive"])
+
+    # delete the blobs referenced by no job nor archive of a job (e.g the jobs
+    # were dropped), stored at least min_age seconds ago (default : 
+    # config.BLOB_GC_MIN_AGE). Returns the number of deleted blobs
+    def delete_unreferenced_blobs(self, min_age=None):
+        if self.blob_store is None:
+            return 0
+        min_age = min_age if min_age is not None else config.BLOB_GC_MIN_AGE
+        keys = set(self.blob_store.iter_keys(min_age))
+        if len(keys) == 0:
+            return 0
+        cursor = self.db[JobModel.__name__].find({}, {"input_data": True, "output_data": True, 
+                                                      "archive": True, "archived_blobs": True})
+        for data in cursor:
+            if "archive" in data and "archived_blobs" not in data:
+                # archived before the keys were kept in the document
+                content = self.archive.read(data["archive"]) if self.archive is not None else None
+                if content is None:
+                    raise ValueError("the archive %s can not be read" % (data["archive"],))
+                data = content
+            keys.difference_update(data.get("archived_blobs", []))
+            keys.difference_update(get_blob_keys(data))
+        for key in keys:
+            self.blob_store.delete(key)
+        return len(keys)
+
+    # give back to the system the space freed by archive_job or remove
+    # (mongo does not shrink its files by itself)
+    def compact(self, model_cls):
+        assert issubclass(model_cls, Model)
+        return self.db.command("compact", model_cls.__name__)
+
+    # compress in place the fields (Model.COMPRESSED) of the documents stored 
+    # before compression was enabled. Returns the number of updated documents
+    def compress_documents(self, model_cls, batch_size=100):
+        assert issubclass(model_cls, Model)
+        if len(model_cls.COMPRESSED) == 0 or config.COMPRESSION is None:
+            return 0
+        collection = self.db[model_cls.__name__]
+        projection = dict((field, True) for field in model_cls.COMPRESSED)
+        nb_updated = 0
+        operations = []
+        for data in collection.find({}, projection):
+            to_set = {}
+            for field in model_cls.COMPRESSED:
+                if field in data:
+                    value = compress_field(data[field])
+                    if not is_same_value(data[field], value):
+                        to_set[field] = value
+            if len(to_set):
+                to_set["_version"] = new_version()
+                operations.append(UpdateOne({"_id": data["_id"]}, {"$set": to_set}))
+            if len(operations) >= batch_size:
+                nb_updated += collection.bulk_write(operations, ordered=False).modified_count
+                operations = []
+        if len(operations):
+            nb_updated += collection.bulk_write(operations, ordered=False).modified_count
+        self.__invalidate(model_cls)
+        return nb_updated
     
     
 
+# (spec, update) to remove job_id from the jobs waited for by its dependents
+def get_release_dependents_update(job_id):
+    return ({"depends_on": job_id, "waiting_on": job_id},
+            {"$pull": {"waiting_on": job_id}, "$set": {"_version": new_version()}})
+
+# the keys of the blobs referenced by the input/output data of a job document
+def get_blob_keys(data):
+    return [value["blob"] for field in ("input_data", "output_data") 
+            for value in data.get(field, {}).values() if is_blob_reference(value)]
+
+def get_chunk_spec(chunk):
+    return {"job_id": chunk.job_id, "stream": chunk.stream, "index": chunk.index}
+
+def get_truncate_output_spec(job_id, stream, start):
+    return {"job_id": ObjectId(job_id), "stream": stream, "index": {"$gte": start}}
+
+# each write of a document gives it a new _version, 
+# used to know if a document cached by the DocumentCache is up to date
+def new_version():
+    return ObjectId()
+
+def get_versioned_document(object):
+    document = object.to_db()
+    document["_version"] = new_version()
+    return document
+
+def get_versioned_update(update):
+    update = dict(update)
+    update["$set"] = dict(update.get("$set", {}))
+    update["$set"]["_version"] = new_version()
+    return update
+
+# LRU cache of documents by (collection name, _id), bounded by a number of 
+# entries and by their total size. The documents are kept encoded in BSON : 
+# each get returns a new copy that the caller can modify
+class DocumentCache(object):
+
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (version, BSON document), the most recent last
+        self.size = 0
+
+    # (version, document) or None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            self.entries[key] = entry
+        version, data = entry
+        return version, data.decode()
+
+    def put(self, key, version, document):
+        data = BSON.encode(document)
+        if self.max_bytes is not None and len(data) > self.max_bytes:
+            return
+        with self.lock:
+            self.__remove(key)
+            self.entries[key] = (version, data)
+            self.size += len(data)
+            while len(self.entries) > self.max_entries or \
+                    (self.max_bytes is not None and self.size > self.max_bytes):
+                self.__remove(next(iter(self.entries)))
+
+    def invalidate(self, key):
+        with self.lock:
+            self.__remove(key)
+
+    def invalidate_collection(self, collection_name):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == collection_name]:
+                self.__remove(key)
+
+    def __remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def __len__(self):
+        return len(self.entries)
+
+# compression of the fields of documents (see Model.COMPRESSED) : a compressed 
+# string is stored as {<algorithm>: <compressed bytes>, "size": <size>}
+COMPRESSORS = {
+    "zlib": (zlib.compress, zlib.decompress),
+    "bz2": (bz2.compress, bz2.decompress),
+}
+
+def is_compressed_value(value):
+    return isinstance(value, dict) and len(value) == 2 and "size" in value and \
+        any(algorithm in value for algorithm in COMPRESSORS)
+
+# strings smaller than config.COMPRESSION_MIN_SIZE are left as they are
+def compress_value(value, algorithm=None):
+    algorithm = default_value(algorithm, config.COMPRESSION)
+    if algorithm is None or not isinstance(value, basestring) or \
+            len(value) < config.COMPRESSION_MIN_SIZE:
+        return value
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    compress, decompress = COMPRESSORS[algorithm]
+    return {algorithm: Binary(compress(value)), "size": len(value)}
+
+# the value itself when it is not compressed
+def decompress_value(value):
+    if not is_compressed_value(value):
+        return value
+    for algorithm, (compress, decompress) in COMPRESSORS.items():
+        if algorithm in value:
+            return decompress(value[algorithm])
+
+# size of the value once decompressed
+def get_value_size(value):
+    if is_compressed_value(value):
+        return value["size"]
+    return len(value)
+
+# the output as bytes : the strings stored as mongo strings (see 
+# get_storable_string) are read as unicode
+def get_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+# mongo strings must be utf-8 : the other strings (e.g binary output) are stored as binary
+def get_storable_string(data):
+    if isinstance(data, str) and not isinstance(data, Binary):
+        try:
+            data.decode("utf-8")
+        except UnicodeDecodeError:
+            return Binary(data)
+    return data
+
+# a compressed field is either a string or a dict of strings (e.g output_data), 
+# the values which are not strings (e.g blob references) are left as they are
+def compress_field(value):
+    if isinstance(value, dict) and not is_compressed_value(value):
+        return dict((key, compress_value(element)) for key, element in value.items())
+    return compress_value(value)
+
+# iterate over the results of database.find(model_cls, *args, **kwargs), 
+# fetching them batch by batch : works with a Database or its Pyro proxy
+def iter_find(database, model_cls, *args, **kwargs):
+    batch_size = kwargs.pop("batch_size", 100)
+    cursor_id = database.open_cursor(model_cls, *args, **kwargs)
+    try:
+        while True:
+            models = database.next_batch(cursor_id, batch_size)
+            if len(models) == 0:
+                break
+            for model in models:
+                yield model
+    finally:
+        database.close_cursor(cursor_id)
+
+# group key of the hour of a date field
+def get_hour_key(field):
+    return {"year": {"$year": field}, "month": {"$month": field}, 
+            "day": {"$dayOfMonth": field}, "hour": {"$hour": field}}
+
+# (stage, index name) of the stages of a query plan, from the root
+def get_plan_stages(plan):
+    stages = [(plan.get("stage"), plan.get("indexName"))]
+    children = list(plan.get("inputStages", []))
+    for key in ("inputStage", "outerStage", "innerStage"):
+        if key in plan:
+            children.append(plan[key])
+    for child in children:
+        stages.extend(get_plan_stages(child))
+    return stages
+
+def get_explain_summary(explain):
+    if "queryPlanner" in explain:
+        stages = get_plan_stages(explain["queryPlanner"]["winningPlan"])
+        stats = explain.get("executionStats", {})
+        summary = {
+            "stages": [stage for stage, index in stages],
+            "indexes": [index for stage, index in stages if index is not None],
+            "returned": stats.get("nReturned"),
+            "keys_examined": stats.get("totalKeysExamined"),
+            "docs_examined": stats.get("totalDocsExamined"),
+            "time_ms": stats.get("executionTimeMillis"),
+        }
+    else: # mongo < 3.0
+        cursor = explain.get("cursor", "")
+        summary = {
+            "stages": [cursor],
+            "indexes": [cursor.split(" ", 1)[1]] if cursor.startswith("BtreeCursor") else [],
+            "returned": explain.get("n"),
+            "keys_examined": explain.get("nscanned"),
+            "docs_examined": explain.get("nscannedObjects"),
+            "time_ms": explain.get("millis"),
+        }
+    summary["uses_index"] = len(summary["indexes"]) > 0
+    # a sort not done with an index
+    summary["in_memory_sort"] = "SORT" in summary["stages"] or bool(explain.get("scanAndOrder"))
+    return summary
+
+# copy of the nested dicts and lists of a document, the other values
+# (strings, numbers, dates, ids) are immutable and shared
+def get_snapshot(value):
+    if isinstance(value, dict):
+        return dict((key, get_snapshot(element)) for key, element in value.items())
+    elif isinstance(value, list):
+        return [get_snapshot(element) for element in value]
+    else:
+        return value
+
+def is_same_value(old, new):
+    return old is new or (type(old) == type(new) and old == new)
+
+# paths (in mongo dot notation) to set and to unset to go from the document old to new
+def get_changes(old, new, prefix=""):
+    to_set, to_unset = {}, {}
+    for key, value in new.items():
+        path = prefix + key
+        if key == "_id" and prefix == "":
+            continue
+        if key not in old:
+            to_set[path] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            nested_to_set, nested_to_unset = get_changes(old[key], value, path + ".")
+            to_set.update(nested_to_set)
+            to_unset.update(nested_to_unset)
+        elif not is_same_value(old[key], value):
+            to_set[path] = value
+    for key in old:
+        if key not in new:
+            to_unset[prefix + key] = ""
+    return to_set, to_unset
+
+# Same write interface as Database (save, insert, append_output) but the 
+# writes are kept and sent by flush() with one bulk_write per collection.
+# The writes of the jobs fenced by their worker (see JobModel.get_save_spec) 
+# are sent first : the other writes of the jobs which did not match anymore
+# are dropped, their ids are in lost_job_ids. With a worker_id, the output 
+# of the jobs is fenced the same way, even if the jobs are not saved
+class WriteBatch(object):
+
+    def __init__(self, database, ordered=True, worker_id=None):
+        self.database = database
+        self.ordered = ordered
+        self.worker_id = worker_id
+        self.operations = OrderedDict() # collection name -> (job id, operation)
+        self.fenced_operations = [] # (job id, worker id, operation)
+        self.output_job_ids = set() # the jobs with output in the batch
+        self.lost_job_ids = set()
+        self.saved = [] # (collection name, _id) of the saved objects
+        # some jobs may be claimable after the flush (see release_dependents)
+        self.released_dependents = False
+        self.flush_callbacks = [] # called once the writes are done
+
+    def __add(self, collection_name, operation, job_id=None):
+        self.operations.setdefault(collection_name, []).append((job_id, operation))
+
+    def __add_output(self, chunk, operation):
+        self.__add(chunk.__class__.__name__, operation, chunk.job_id)
+        self.output_job_ids.add(chunk.job_id)
+
+    def save(self, object):
+        assert object._id is not None
+        spec = object.get_save_spec()
+        if object.has_snapshot():
+            update = object.get_update()
+            operation = UpdateOne(spec, get_versioned_update(update)) if len(update) else None
+        elif len(spec) > 1:
+            operation = ReplaceOne(spec, get_versioned_document(object))
+        else:
+            operation = ReplaceOne(spec, get_versioned_document(object), upsert=True)
+        if operation is None:
+            pass
+        elif isinstance(object, JobModel) and "worker_id" in spec:
+            self.fenced_operations.append((object._id, spec["worker_id"], operation))
+        else:
+            self.__add(object.__class__.__name__, operation)
+        self.saved.append((object.__class__.__name__, object._id))
+        object.mark_saved()
+        return object._id
+
+    def insert(self, object):
+        assert isinstance(object, Model)
+        operation = InsertOne(get_versioned_document(object))
+        if isinstance(object, (OutputChunkModel, SearchTermsModel)):
+            self.__add_output(object, operation)
+        else:
+            self.__add(object.__class__.__name__, operation)
+        object.mark_saved()
+
+    def append_output(self, chunk):
+        assert isinstance(chunk, OutputChunkModel)
+        self.insert(chunk)
+
+    def put_output(self, chunk):
+        assert isinstance(chunk, OutputChunkModel)
+        self.__add_output(chunk, ReplaceOne(get_chunk_spec(chunk), get_versioned_document(chunk), upsert=True))
+
+    def truncate_output(self, job_id, stream, start=0):
+        self.__add(OutputChunkModel.__name__, 
+                   DeleteMany(get_truncate_output_spec(job_id, stream, start)), job_id)
+        self.output_job_ids.add(job_id)
+
+    # sent with the other writes, after the update of the job itself : 
+    # its dependents can only be claimed once it is saved
+    def release_dependents(self, job_id):
+        spec, update = get_release_dependents_update(job_id)
+        self.__add(JobModel.__name__, UpdateMany(spec, update), job_id)
+        self.saved.append((JobModel.__name__, None))
+        self.released_dependents = True
+
+    # not delayed : the cancelled jobs are not claimable anyway
+    def cancel_dependents(self, job_id):
+        return self.database.cancel_dependents(job_id)
+
+    def __len__(self):
+        return len(self.fenced_operations) + sum(len(operations) for operations in self.operations.values())
+
+    def add_flush_callback(self, callback):
+        self.flush_callbacks.append(callback)
+
+    def flush(self):
+        if len(self) == 0:
+            self.__call_flush_callbacks()
+            return
+        self.__fence_output()
+        metrics = self.database.metrics
+        metrics.record("write_batch_size", len(self))
+        with Timer(metrics, "write_batch_flush_seconds"):
+            self.lost_job_ids = self.__write_fenced()
+            for collection_name, operations in self.operations.items():
+                operations = [operation for job_id, operation in operations
+                              if job_id is None or job_id not in self.lost_job_ids]
+                if len(operations):
+                    self.database.db[collection_name].bulk_write(operations, ordered=self.ordered)
+        if self.database.document_cache is not None:
+            for collection_name, id_ in self.saved:
+                if id_ is None: # many documents
+                    self.database.document_cache.invalidate_collection(collection_name)
+                else:
+                    self.database.document_cache.invalidate((collection_name, id_))
+        self.operations = OrderedDict()
+        self.fenced_operations = []
+        self.output_job_ids = set()
+        self.saved = []
+        self.__call_flush_callbacks()
+
+    # the output of a job not saved by the batch is only written if the 
+    # job is still owned by the worker : a no-op fenced update
+    def __fence_output(self):
+        if self.worker_id is None:
+            return
+        fenced_job_ids = set(job_id for job_id, _, _ in self.fenced_operations)
+        for job_id in self.output_job_ids - fenced_job_ids:
+            self.fenced_operations.append((job_id, self.worker_id, UpdateOne(
+                    {"_id": job_id, "worker_id": self.worker_id}, 
+                    {"$set": {"worker_id": self.worker_id}})))
+
+    # returns the ids of the jobs which were not owned by their worker anymore
+    def __write_fenced(self):
+        if len(self.fenced_operations) == 0:
+            return set()
+        collection = self.database.db[JobModel.__name__]
+        result = collection.bulk_write([operation for _, _, operation in self.fenced_operations],
+                                       ordered=self.ordered)
+        if result.matched_count == len(self.fenced_operations):
+            return set()
+        owners = dict((job_id, worker_id) for job_id, worker_id, _ in self.fenced_operations)
+        for data in collection.find({"_id": {"$in": owners.keys()}}, {"worker_id": True}):
+            if data.get("worker_id") == owners[data["_id"]]:
+                del owners[data["_id"]]
+        return set(owners)
+
+    def __call_flush_callbacks(self):
+        callbacks, self.flush_callbacks = self.flush_callbacks, []
+        for callback in callbacks:
+            callback()
+
 class Model(object):
 
+    # attributes which are not stored in the database, 
+    # _version is set by the Database at each write
+    TRANSIENT = ("_snapshot", "_version")
+
+    # indexes of the collection of the model, created by Database.ensure_indexes
+    INDEXES = []
+
+    # fields compressed in the database (see compress_field), they are 
+    # only decompressed when they are read (see decompress_value)
+    COMPRESSED = ()
+
     def __init__(self):
         self._id = None
 
-    def to_db(self):
-        d = deepcopy(self.__dict__)
+    # the document stored in the database, without copy : 
+    # the values are shared with the model
+    def db_fields(self):
+        d = dict((key, value) for key, value in self.__dict__.items()
+                 if key not in self.TRANSIENT)
         if "_id" in d and d["_id"] is None:
             del d["_id"]
+        # the model keeps the compressed values : a value is compressed 
+        # once, not at each save (see decompress_value to read them)
+        for field in self.COMPRESSED:
+            if field in d:
+                d[field] = self.__dict__[field] = compress_field(d[field])
         return d
 
+    def to_db(self):
+        return deepcopy(self.db_fields())
+
+    # remember the document as it is in the database, the changes made
+    # after that are given by get_update()
+    def mark_saved(self):
+        self._snapshot = get_snapshot(self.db_fields())
+
+    def has_snapshot(self):
+        return "_snapshot" in self.__dict__
+
+    # the filter of the writes of the model (see Database.save)
+    def get_save_spec(self):
+        return {"_id": self._id}
+
+    # the minimal mongo update ($set/$unset) from the last snapshot to the current state
+    def get_update(self):
+        assert self.has_snapshot()
+        to_set, to_unset = get_changes(self._snapshot, self.db_fields())
+        update = {}
+        if len(to_set):
+            update["$set"] = deepcopy(to_set)
+        if len(to_unset):
+            update["$unset"] = to_unset
+        return update
+
+    # the snapshot is not sent with the model (e.g through Pyro)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_snapshot", None)
+        return state
+
     @staticmethod 
     def from_db(cls_model, data):
         inst = cls_model.__new__(cls_model)
@@ -78,13 +1012,22 @@ class Model(object):
 
 class CommandModel(Model):
 
-    def __init__(self, args, input_files=None, output_files=None, cwd=".", categories=None):
+    INDEXES = [
+        [("categories", 1)],
+    ]
+
+    def __init__(self, args, input_files=None, output_files=None, cwd=".", categories=None,
+                 cores=None, memory=None):
         Model.__init__(self)
         self.args = args
         self.input_files = default_value(input_files, [])
         self.output_files = default_value(output_files, [])
         self.categories = default_value(categories, [])
         self.cwd = cwd
+        # resources needed by the jobs of the command (see Scheduler) : 
+        # number of cores and memory in bytes, None for not declared
+        self.cores = cores
+        self.memory = memory
 
     def __str__(self):
         return str(self.to_db())
@@ -92,11 +1035,26 @@ class CommandModel(Model):
 class CommandTemplateModel(CommandModel):
 
     def to_command_model(self, **values):
+        # %(jobid)s is only known when the job is created (see JobModel.format_str)
+        values.setdefault("jobid", "%(jobid)s")
         args = get_formatted_list(self.args, **values)
         input_files = get_formatted_list(self.input_files, **values)
         output_files = get_formatted_list(self.output_files, **values)
         cwd = get_formatted_element(self.cwd, **values)
-        return CommandModel(args, input_files, output_files, cwd)
+        return CommandModel(args, input_files, output_files, cwd, list(self.categories),
+                            getattr(self, "cores", None), getattr(self, "memory", None))
+
+    # one command model per dict of values
+    def to_command_models(self, values_list):
+        return [self.to_command_model(**values) for values in values_list]
+
+    @staticmethod
+    def from_command_model(command_model):
+        return CommandTemplateModel(command_model.args, command_model.input_files, 
+                                    command_model.output_files, command_model.cwd,
+                                    command_model.categories, 
+                                    getattr(command_model, "cores", None),
+                                    getattr(command_model, "memory", None))
 
 
 class JobModel(Model):
@@ -104,9 +1062,29 @@ class JobModel(Model):
     NOT_YET_STARTED, RUNNING, STOPPED = range(3)
     STATES = (NOT_YET_STARTED, RUNNING, STOPPED)
 
+    STDOUT_INLINE, STDOUT_CHUNKS = "inline", "chunks"
+
+    INDEXES = [
+        # curjobs/pastjobs
+        [("state", 1), ("datetime_from", 1), ("datetime_to", 1)],
+        [("command_model.categories", 1)],
+        # queue of the Scheduler
+        [("state", 1), ("priority", -1), ("_id", 1)],
+        # jobs of a worker
+        [("worker_id", 1), ("state", 1)],
+        # dependents of a job
+        [("depends_on", 1)],
+    ]
+
+    COMPRESSED = ("input_data", "output_data")
+
+    # projection of the fields needed to list jobs
+    SUMMARY_FIELDS = {"command_model.args": True, "state": True,
+                      "datetime_from": True, "datetime_to": True}
+
     def __init__(self, command_model, 
                        execution_datetime_range=None, state=NOT_YET_STARTED, 
-                       input_data=None, output_data=None):
+                       input_data=None, output_data=None, priority=0, depends_on=None):
         Model.__init__(self)
         self.command_model = command_model
         #self.execution_range_datetime = default_value(execution_datetime_range, (None, None))
@@ -115,40 +1093,85 @@ class JobModel(Model):
         self.datetime_from = default_value(execution_datetime_range[0], None)
         self.datetime_to = default_value(execution_datetime_range[1], None)
         self.state = state
+        # jobs with a higher priority are started first by the Scheduler
+        self.priority = priority
+        # the worker which claimed the job, None while it is in the queue
+        self.worker_id = None
+        # run the job even if the result of the same job is in the ResultCache
+        self.force_rerun = False
+        # exit code of the process, None while it is running
+        self.return_code = None
+        # ids of the jobs which must succeed before this job starts, the 
+        # job is claimable when waiting_on is empty. It is cancelled 
+        # (STOPPED without being run) if one of them fails
+        self.depends_on = default_value(depends_on, [])
+        self.waiting_on = list(self.depends_on)
         self.input_data = default_value(input_data, {})
         self.output_data = default_value(input_data, {})
         self.output_data["stdout"] = ""
+        self.stdout_storage = config.STDOUT_STORAGE
 
-    def store_input_data_from_command_model(self):
+    # a job is only written by the worker which claimed it : once requeued
+    # (e.g its worker was considered dead) the writes of the old worker
+    # do not match anymore
+    def get_save_spec(self):
+        spec = Model.get_save_spec(self)
+        if self.has_snapshot():
+            owner = self._snapshot.get("worker_id")
+        else:
+            owner = getattr(self, "worker_id", None)
+        if owner is not None:
+            spec["worker_id"] = owner
+        return spec
+
+    def store_input_data_from_command_model(self, blob_store=None):
         self.input_data.update(
-            self.get_name_content_mapping_from_filenames(map(self.format_str, self.command_model.input_files))
+            self.get_name_content_mapping_from_filenames(map(self.format_str, self.command_model.input_files), blob_store)
         )
 
-    def store_output_data_from_command_model(self):
+    def store_output_data_from_command_model(self, blob_store=None):
         self.output_data.update(
-            self.get_name_content_mapping_from_filenames(map(self.format_str, self.command_model.output_files))
+            self.get_name_content_mapping_from_filenames(map(self.format_str, self.command_model.output_files), blob_store)
         )
 
-    def get_name_content_mapping_from_filenames(self, filenames):
+    # without blob_store the content of the files is stored in the mapping,
+    # otherwise the files are put in the blob store and the mapping contains
+    # only references to them
+    def get_name_content_mapping_from_filenames(self, filenames, blob_store=None):
         mapping = {}
         for filename in filenames:
             abs_filename_path = os.path.join(self.command_model.cwd, filename)
-            filename = filename.replace(".", "__") # mongo does not support "."
+            name = filename.replace(".", "__") # mongo does not support "."
             try:
-                mapping[filename] = open(abs_filename_path, "r").read()
+                if blob_store is None:
+                    mapping[name] = open(abs_filename_path, "r").read()
+                else:
+                    mapping[name] = blob_store.put_file(abs_filename_path, filename)
             except:
                 pass
         return mapping
 
-    def to_db(self):
-        dict = Model.to_db(self)
-        dict['command_model'] = self.command_model.to_db()
-        return dict
+    # content of an input or output data (decompressed), None if there is
+    # no data with this name. Blob references are returned as they are
+    def get_data(self, name):
+        for data in (self.input_data, self.output_data):
+            if name in data:
+                return decompress_value(data[name])
+        return None
+
+    def db_fields(self):
+        d = Model.db_fields(self)
+        # command_model can be missing when only some fields are fetched
+        if "command_model" in d:
+            d['command_model'] = self.command_model.db_fields()
+        return d
 
     @staticmethod
     def from_db(cls_model, data):
         inst = Model.from_db(cls_model, data)
-        inst.command_model = Model.from_db(CommandModel, inst.command_model)
+        # command_model can be missing when only some fields are fetched
+        if "command_model" in data:
+            inst.command_model = Model.from_db(CommandModel, inst.command_model)
         return inst
 
     def __str__(self):
@@ -156,6 +1179,71 @@ class JobModel(Model):
 
     def format_str(self, s):
         return s % {"jobid": str(self._id)}
+
+    def has_succeeded(self):
+        return self.state == JobModel.STOPPED and getattr(self, "return_code", None) == 0
+
+    # the job whose stdout chunks are the stdout of this job : 
+    # another job when the result comes from the ResultCache
+    def get_stdout_job_id(self):
+        return getattr(self, "cached_from", None) or self._id
+
+    def has_chunked_stdout(self):
+        # jobs stored before the "chunks" mode existed have their stdout inline
+        return getattr(self, "stdout_storage", JobModel.STDOUT_INLINE) == JobModel.STDOUT_CHUNKS
+
+# a slice of the output of a job, in the order given by index
+class OutputChunkModel(Model):
+
+    INDEXES = [
+        [("job_id", 1), ("stream", 1), ("index", 1)],
+    ]
+
+    COMPRESSED = ("data",)
+
+    def __init__(self, job_id, index, data, stream="stdout"):
+        Model.__init__(self)
+        self.job_id = job_id
+        self.index = index
+        self.data = get_storable_string(data)
+        self.stream = stream
+
+# terms found in an input or output data of a job (see search.py), 
+# field is "input" or "output" and name the name of the data (e.g
+# "stdout" or a filename as in input_data/output_data). The terms of
+# the output of a process are stored by several models, as it is produced
+class SearchTermsModel(Model):
+
+    INDEXES = [
+        [("terms", 1), ("field", 1), ("name", 1)],
+        [("job_id", 1)],
+    ]
+
+    def __init__(self, job_id, field, name, terms):
+        Model.__init__(self)
+        self.job_id = job_id
+        self.field = field
+        self.name = name
+        self.terms = terms
+
+# a process running jobs (experiments_server.py or worker.py), 
+# its _id is the worker id
+class WorkerModel(Model):
+
+    INDEXES = [
+        [("heartbeat", 1)],
+    ]
+
+    def __init__(self, worker_id, hostname, pid):
+        Model.__init__(self)
+        self._id = worker_id
+        self.hostname = hostname
+        self.pid = pid
+        self.started = datetime.datetime.now()
+        self.heartbeat = self.started
+
+MODEL_CLASSES = (CommandModel, JobModel, OutputChunkModel, SearchTermsModel, WorkerModel)
+
 if __name__ == "__main__":
     tpl = CommandTemplateModel(["ls", "-l"])
     command_model = tpl.to_command_model(a=1, b=2) 
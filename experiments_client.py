@@ -1,79 +1,193 @@
 #!/usr/bin/env python
 
-import xmlrpclib
+import sys
+import json
+import shlex
 
-from db import Model, JobModel, CommandModel
-from bson.objectid import ObjectId
+from util import datetime_from_str, datetime_to_str, load_sweep_values, parse_size
 
-import json
-import Pyro4
+# the modules needed by an action (db, wire_client, Pyro4...) are imported by 
+# the action itself : a call of the client only loads what its action uses.
+# The listings and the details of the jobs do not need db (pymongo)
+
+# the states of the jobs, as JobModel.STATES
+NOT_YET_STARTED, RUNNING, STOPPED = range(3)
+STATE_NAMES = {NOT_YET_STARTED: "queued", RUNNING: "running", STOPPED: "stopped"}
+
+# summaries as sent by WireInterface.next_job_summaries
+def show_job_summary(summary):
+    from wire_client import timestamp_to_datetime
+    job_id, args, state, datetime_from, datetime_to = summary
+    print "ID:%s Command:'%s' Start:%s, Stop:%s" % (job_id,
+        " ".join(args), datetime_to_str(timestamp_to_datetime(datetime_from)),
+        datetime_to_str(timestamp_to_datetime(datetime_to)))
 
-from util import datetime_from_str, datetime_to_str
-import pymongo
-Pyro4.config.SERIALIZER = 'pickle'
-Pyro4.config.SERIALIZERS_ACCEPTED.add('pickle')
+# the chunks of the output are only fetched when needed, 
+# the stderr is always stored as chunks
+def show_stdout(wire, details, stream="stdout"):
+    from wire_client import iter_output
+    if details["chunked_stdout"] or stream != "stdout":
+        for chunk in iter_output(wire, details["stdout_job_id"], stream):
+            sys.stdout.write(chunk)
+    else:
+        # not sent if the job is archived (see Database.restore_job)
+        sys.stdout.write(details.get("stdout", ""))
+    sys.stdout.write("\n")
 
-def show_job_model_short(job_model):
-    print "ID:%s Command:'%s' Start:%s, Stop:%s" % (job_model._id,
-        " ".join(job_model.command_model.args), datetime_to_str(job_model.datetime_from),
-        datetime_to_str(job_model.datetime_to))
+# blobs are streamed block by block, they are never entirely in memory
+def show_data(wire, data):
+    from blobstore import is_blob_reference
+    from wire_client import iter_blob
+    if is_blob_reference(data):
+        for block in iter_blob(wire, data):
+            sys.stdout.write(block)
+    else:
+        print data
 
-def show_job_model_long(job_model):
-    print "ID:%s" % (job_model._id)
+def show_job_details(wire, details):
+    print "ID:%s" % (details["id"],)
+    if details["return_code"] is not None:
+        print "Exit code : %d" % (details["return_code"],)
+    if details["cpus"]:
+        print "Cores : %s" % (", ".join(map(str, details["cpus"])),)
+    if details["resources"] is not None:
+        print "Resources : %s" % (", ".join("%s=%s" % (name, value) 
+                                  for name, value in sorted(details["resources"].items())),)
+    if len(details["depends_on"]):
+        print "Depends on : %s (waiting on %s)" % (", ".join(details["depends_on"]), 
+                                                   ", ".join(details["waiting_on"]) or "none")
+    if details["error"] is not None:
+        print "Could not start : %s" % (details["error"],)
+    if details["archived"]:
+        print "Archived : the archive of the job is not on the host of the server"
+    if details["cancelled"]:
+        print "Cancelled : a job it depends on failed"
     print "Stdout:"
-    print job_model.output_data["stdout"]
-    print "inputs : %s" % (job_model.input_data.keys(),)
-    print "outputs : %s" % (job_model.output_data.keys(),)
+    show_stdout(wire, details)
+    print "inputs : %s" % (details["inputs"],)
+    print "outputs : %s" % (details["outputs"],)
+
+def show_explain(database, model_cls, params, sort=None):
+    summary = database.explain(model_cls, params, sort=sort if sort is not None else [])
+    print "Uses index : %s %s" % (summary["uses_index"], summary["indexes"])
+    print "Sort in memory : %s" % (summary["in_memory_sort"],)
+    print "Stages : %s" % (" <- ".join(map(str, summary["stages"])),)
+    print "Returned : %s, keys examined : %s, documents examined : %s, time : %s ms" % (
+        summary["returned"], summary["keys_examined"], summary["docs_examined"], summary["time_ms"])
+
+def show_metrics(metrics):
+    for name, value in sorted(metrics.items()):
+        if isinstance(value, dict):
+            value = ", ".join("%s=%.6g" % (key, v) for key, v in sorted(value.items()))
+        print "%s : %s" % (name, value)
+
+def get_state_counts_str(counts):
+    return ", ".join("%s=%d" % (STATE_NAMES.get(state, state), count) 
+                     for state, count in sorted(counts.items()))
 
-def show_job_models(job_models):
-    print "%d job(s)..." % (len(job_models))
-    for job_model in job_models:
-        show_job_model_short(job_model)
+def get_percentiles_str(percentiles):
+    if len(percentiles) == 0:
+        return "no stopped job"
+    return ", ".join("p%s=%.1fs" % (percentile, duration) 
+                     for percentile, duration in sorted(percentiles.items()))
 
-def find_jobs_params(database, state, categories, input_files_contains, output_file_contains, extra):
+# statistics computed by the server (Database.job_stats)
+def show_stats(stats):
+    print "Jobs : %s" % (get_state_counts_str(stats["states"]),)
+    for category, counts in sorted(stats["categories"].items()):
+        print "Category %s : %s" % (category, get_state_counts_str(counts))
+    print "Durations : %s" % (get_percentiles_str(stats["durations"][None]),)
+    for category, percentiles in sorted(stats["durations"].items()):
+        if category is not None:
+            print "Durations of category %s : %s" % (category, get_percentiles_str(percentiles))
+    print "Stopped jobs per hour :"
+    for hour, count in stats["throughput"]:
+        print "%s : %d" % (datetime_to_str(hour), count)
+
+# only the summaries of the jobs are sent by the server, 
+# batch by batch, whatever the number of jobs
+def show_job_models(wire, database, params, sort, explain=False):
+    from wire_client import iter_job_summaries
+    if explain:
+        from db import JobModel
+        show_explain(database, JobModel, params, sort)
+        return
+    print "%d job(s)..." % (wire.count_jobs(params),)
+    for summary in iter_job_summaries(wire, params, sort):
+        show_job_summary(summary)
+
+def find_jobs_params(wire, state, categories, input_files_contains, output_file_contains, extra):
     params = {"state": state}
     if categories is not None:
-        params["command_model"] = {"categories": {"$in": categories}}
-
-    for file_contains, type_file in (input_files_contains,"input"), (output_file_contains, "output"):
-
-        param_name = type_file + "_data"
-        if type(file_contains) == str:
-            params[param_name] = {"*": file_contains}
-        elif type(file_contains) == list:
-            params[param_name] = {"*": {"$in":file_contains } }
-        elif type(file_contains) == dict:
-            params[param_name] = {}
-            for filename, contains in file_contains.items():
-                if type(contains) == list:
-                    contains = {"$in": contains}
-                params[param_name][filename] = contains
+        params["command_model.categories"] = {"$in": categories}
+
+    # the jobs whose files contain the terms, found with the search index
+    job_ids = None
+    for file_contains, field in (input_files_contains, "input"), (output_file_contains, "output"):
+        if file_contains is None:
+            continue
+        ids = set(wire.find_job_ids(field, file_contains))
+        job_ids = ids if job_ids is None else job_ids & ids
+    if job_ids is not None:
+        params["_id"] = {"$in": list(job_ids)}
     if extra is not None:
         params.update(json.loads(extra))
     return params
 
 
-if __name__ == "__main__":
+def get_parser():
     import argparse
     parser = argparse.ArgumentParser(description='Process some integers.')
-    parser.add_argument('action', help="curjobs | pastjobs | commands | newcommand | new-job | dropalljobs | jobdetails | dropjob | jobdata")
-    parser.add_argument('--command-id', help="newjob | dropcommand", required=False)
-    parser.add_argument('--job-id', help="jobdetails | dropjob | jobdata ", required=False)
-    parser.add_argument('--input-files', help="newcommand ", required=False, nargs="*")
-    parser.add_argument('--output-files', help="newcommand", required=False, nargs="*")
+    parser.add_argument('action', help="curjobs | pastjobs | queuedjobs | commands | newcommand | newjob | sweep | metrics | stats | compress | archive | restore | compact | gcblobs | dropalljobs | jobdetails | dropjob | jobdata | jobstop | batch | shell")
+    parser.add_argument('--command-id', help="newjob | sweep | dropcommand", required=False)
+    parser.add_argument('--job-id', help="jobdetails | dropjob | jobdata | restore", required=False)
+    parser.add_argument('--input-files', help="newcommand | curjobs | pastjobs : for curjobs/pastjobs, the jobs with one of these terms (words) in their input files", required=False, nargs="*")
+    parser.add_argument('--output-files', help="newcommand | curjobs | pastjobs : for curjobs/pastjobs, the jobs with one of these terms (words) in their stdout, stderr or output files", required=False, nargs="*")
     parser.add_argument('--args', help="newcommand ", required=False)
     parser.add_argument('--cwd', help="newcommand", required=False)
-    parser.add_argument('--categories', help="newcommand | commands | curjobs | pastjobs", required=False, nargs="*")
-    parser.add_argument('--extra', help="commands | curjobs | pastjobs", required=False)
-    parser.add_argument('--date-from', help="curjobs | pastjobs", required=False)
-    parser.add_argument('--date-to', help="curjobs | pastjobs", required=False)
-    parser.add_argument('--date', help="curjobs | pastjobs", required=False)
+    parser.add_argument('--categories', help="newcommand | commands | curjobs | pastjobs | queuedjobs | stats", required=False, nargs="*")
+    parser.add_argument('--extra', help="commands | curjobs | pastjobs | stats", required=False)
+    parser.add_argument('--date-from', help="curjobs | pastjobs | stats", required=False)
+    parser.add_argument('--date-to', help="curjobs | pastjobs | stats | archive : for archive, the jobs stopped before this date (default : config.ARCHIVE_AFTER seconds ago on the server, required if it is None)", required=False)
+    parser.add_argument('--date', help="curjobs | pastjobs | stats", required=False)
+    parser.add_argument('--cores', help="newcommand : number of cores reserved for each job of the command, the job is pinned to them", required=False, type=int)
+    parser.add_argument('--memory', help="newcommand : memory reserved for each job of the command and its limit, e.g 512M or 4G", required=False)
     parser.add_argument('--data-name', help='jobdata', required=False)
+    parser.add_argument('--priority', help='newjob | sweep', required=False, type=int, default=0)
+    parser.add_argument('--values-file', help="sweep : json grid (dict of lists), json list of dicts or csv file of the values of the command parameters", required=False)
+    parser.add_argument('--force-rerun', help="newjob | sweep : run the jobs even if their result is in the result cache", action="store_true")
+    parser.add_argument('--depends-on', help="newjob | sweep : ids of the jobs which must succeed before the new jobs start, their output files are written in the working directory of the new jobs", required=False, nargs="*")
+    parser.add_argument('--explain', help="curjobs | pastjobs | queuedjobs | commands : show how the query is executed by mongo (indexes used) instead of its results", action="store_true")
+    parser.add_argument('--file', help="batch : file of the actions, one per line (same arguments as the command line), default stdin", required=False)
+    return parser
 
-    args = parser.parse_args()
-    server = "localhost:50490"
-    database = Pyro4.Proxy("PYRO:database@%s" % (server,))
-    interface = Pyro4.Proxy("PYRO:interface@%s" % (server,))
+# the proxies of the server, created when first used : the actions of a
+# batch or of a shell share the same connection
+class Connection(object):
+
+    def __init__(self, server="localhost:50490"):
+        self.server = server
+        self.proxies = {}
+
+    def get_proxy(self, name):
+        if name not in self.proxies:
+            import Pyro4
+            Pyro4.config.SERIALIZER = 'pickle'
+            Pyro4.config.SERIALIZERS_ACCEPTED.add('pickle')
+            self.proxies[name] = Pyro4.Proxy("PYRO:%s@%s" % (name, self.server))
+        return self.proxies[name]
+
+    database = property(lambda self: self.get_proxy("database"))
+    interface = property(lambda self: self.get_proxy("interface"))
+    wire = property(lambda self: self.get_proxy("wire"))
+
+    def close(self):
+        for proxy in self.proxies.values():
+            proxy._pyroRelease()
+        self.proxies = {}
+
+def run_action(connection, args):
+    database, interface, wire = connection.database, connection.interface, connection.wire
 
     params = {}
     if args.date is not None:
@@ -87,57 +201,198 @@ if __name__ == "__main__":
         date_to = datetime_from_str(args.date_to)
         params["datetime_to"] = {"$lte": date_to}
 
-
     if args.action == "curjobs":
-        input_file_contains, output_file_contains = None, None
-        params.update(find_jobs_params(database, JobModel.RUNNING, args.categories, input_file_contains, output_file_contains, args.extra))
-        job_models = database.find(JobModel, params, sort=[ ("datetime_from", 1), ("datetime_to", 2) ])
-        show_job_models(job_models)
+        input_file_contains, output_file_contains = args.input_files, args.output_files
+        params.update(find_jobs_params(wire, RUNNING, args.categories, input_file_contains, output_file_contains, args.extra))
+        show_job_models(wire, database, params, sort=[ ("datetime_from", 1), ("datetime_to", 1) ], explain=args.explain)
     elif args.action == "pastjobs":
+        input_file_contains, output_file_contains = args.input_files, args.output_files
+        params.update(find_jobs_params(wire, STOPPED, args.categories, input_file_contains, output_file_contains, args.extra))
+        show_job_models(wire, database, params, sort=[ ("datetime_from", 1), ("datetime_to", 1) ], explain=args.explain)
+    elif args.action == "queuedjobs":
         input_file_contains, output_file_contains = None, None
-        params.update(find_jobs_params(database, JobModel.STOPPED, args.categories, input_file_contains, output_file_contains, args.extra))
-        job_models = database.find(JobModel, params, sort=[ ("datetime_from", 1), ("datetime_to", 2) ])
-        show_job_models(job_models)
+        params.update(find_jobs_params(wire, NOT_YET_STARTED, args.categories, input_file_contains, output_file_contains, args.extra))
+        show_job_models(wire, database, params, sort=[ ("priority", -1), ("_id", 1) ], explain=args.explain)
     elif args.action == "commands":
+        from db import CommandModel
         params = {}
         if args.categories is not None:
             params["categories"] = {"$in": args.categories}
         if args.extra is not None:
             params.update(json.loads(args.extra))
-        command_models = database.find(CommandModel, params)
-        for command_model in command_models:
-            print str(command_model)
+        if args.explain:
+            show_explain(database, CommandModel, params)
+        else:
+            command_models = database.find(CommandModel, params)
+            for command_model in command_models:
+                print str(command_model)
     elif args.action == "newcommand":
+        from db import CommandModel
         if args.cwd is None: args.cwd = "."
+        memory = parse_size(args.memory) if args.memory is not None else None
         command_model = CommandModel(args.args.split(),
-            input_files=args.input_files, output_files=args.output_files, cwd=args.cwd, categories=args.categories)
+            input_files=args.input_files, output_files=args.output_files, cwd=args.cwd, categories=args.categories,
+            cores=args.cores, memory=memory)
         database.insert(command_model)
         print command_model
     elif args.action == "newjob":
+        from db import JobModel, CommandModel
+        from bson.objectid import ObjectId
         command_model_id = ObjectId(args.command_id)
         command_model = database.find_one(CommandModel, command_model_id)
-        job_model = JobModel(command_model)
+        depends_on = map(ObjectId, args.depends_on) if args.depends_on is not None else None
+        job_model = JobModel(command_model, priority=args.priority, depends_on=depends_on)
+        job_model.force_rerun = args.force_rerun
         job_model._id = database.insert(job_model)
+        if depends_on is not None:
+            database.resolve_dependencies(depends_on, [job_model._id])
         interface.new_process(job_model)
+        print job_model._id
+    elif args.action == "sweep":
+        from bson.objectid import ObjectId
+        values_list = load_sweep_values(args.values_file)
+        depends_on = map(ObjectId, args.depends_on) if args.depends_on is not None else None
+        job_ids = interface.new_sweep(ObjectId(args.command_id), values_list, args.priority, args.force_rerun,
+                                      depends_on)
+        print "%d job(s) queued" % (len(job_ids),)
+    elif args.action == "stats":
+        if args.categories is not None:
+            params["command_model.categories"] = {"$in": args.categories}
+        if args.extra is not None:
+            params.update(json.loads(args.extra))
+        show_stats(database.job_stats(params))
+    elif args.action == "metrics":
+        show_metrics(interface.metrics())
+    elif args.action == "compress":
+        from db import JobModel, OutputChunkModel
+        for model_cls in (JobModel, OutputChunkModel):
+            print "%s : %d document(s) compressed" % (model_cls.__name__, 
+                database.compress_documents(model_cls))
+    elif args.action == "archive":
+        before = datetime_from_str(args.date_to) if args.date_to is not None else None
+        nb_archived = 0
+        while True:
+            try:
+                nb = database.archive_old_jobs(before, 100)
+            except ValueError as e:
+                print "can not archive : %s" % (e,)
+                break
+            nb_archived += nb
+            if nb < 100:
+                break
+        print "%d job(s) archived" % (nb_archived,)
+    elif args.action == "restore":
+        from bson.objectid import ObjectId
+        if not database.restore_job(ObjectId(args.job_id)):
+            print "the archive of the job is not on the host of the server"
+    elif args.action == "compact":
+        from db import JobModel, OutputChunkModel
+        for model_cls in (JobModel, OutputChunkModel):
+            print "%s : %s" % (model_cls.__name__, database.compact(model_cls))
+    elif args.action == "gcblobs":
+        try:
+            print "%d blob(s) deleted" % (database.delete_unreferenced_blobs(),)
+        except ValueError as e:
+            print "can not delete the blobs : %s" % (e,)
     elif args.action == "dropalljobs":
+        from db import JobModel, OutputChunkModel, SearchTermsModel
+        database.delete_archives({})
         database.drop(JobModel)
+        database.drop(OutputChunkModel)
+        database.drop(SearchTermsModel)
     elif args.action == "dropallcommands":
+        from db import CommandModel
         database.drop(CommandModel)
     elif args.action == "dropjob":
+        from db import JobModel, OutputChunkModel, SearchTermsModel
+        from bson.objectid import ObjectId
         job_id = ObjectId(args.job_id)
+        database.delete_archives({"_id": job_id})
         database.remove(JobModel, job_id)
+        database.remove(OutputChunkModel, {"job_id": job_id})
+        database.remove(SearchTermsModel, {"job_id": job_id})
     elif args.action == "dropcommand":
+        from db import CommandModel
+        from bson.objectid import ObjectId
         command_id = ObjectId(args.command_id)
         database.remove(CommandModel, command_id)
     elif args.action == "jobdetails":
-        job_model = database.find_one(JobModel, ObjectId(args.job_id))
-        show_job_model_long(job_model)
+        from bson.objectid import ObjectId
+        from wire_client import decode
+        details = decode(wire.job_details(ObjectId(args.job_id)))
+        show_job_details(wire, details)
     elif args.action == "jobstop":
+        from bson.objectid import ObjectId
         interface.kill_process(ObjectId(args.job_id))
     elif args.action == "jobdata":
-        job_model = database.find_one(JobModel, ObjectId(args.job_id))
-        if args.data_name in job_model.input_data:
-            print job_model.input_data[args.data_name]
-        elif args.data_name in job_model.output_data:
-            print job_model.output_data[args.data_name]
+        from bson.objectid import ObjectId
+        from wire_client import decode
+        job_id = ObjectId(args.job_id)
+        if args.data_name in ("stdout", "stderr"):
+            show_stdout(wire, decode(wire.job_details(job_id)), args.data_name)
+        else:
+            data = wire.job_data(job_id, args.data_name)
+            if data is not None:
+                show_data(wire, decode(data))
+            else:
+                # the job is running : the last snapshot of the output file
+                from wire_client import iter_output
+                for chunk in iter_output(wire, job_id, "file:%s" % (args.data_name,)):
+                    sys.stdout.write(chunk)
+    else:
+        raise ValueError("unknown action %s" % (args.action,))
+
+# runs the actions of the lines (the arguments of the command line, # for 
+# comments), an action which fails does not stop the next ones.
+# Returns the number of failed actions
+def run_lines(connection, parser, lines, prompt=None):
+    nb_failed = 0
+    while True:
+        try:
+            line = raw_input(prompt) if prompt is not None else lines.next()
+        except (EOFError, StopIteration):
+            break
+        line = line.strip()
+        if line in ("quit", "exit"):
+            break
+        if len(line) == 0 or line.startswith("#"):
+            continue
+        try:
+            args = parser.parse_args(shlex.split(line))
+            if args.action in ("batch", "shell"):
+                raise ValueError("%s can not be nested" % (args.action,))
+            run_action(connection, args)
+        except SystemExit: # bad arguments, printed by argparse
+            nb_failed += 1
+        except Exception as e:
+            print >> sys.stderr, "error : %s : %s" % (line, e)
+            nb_failed += 1
+        sys.stdout.flush()
+    return nb_failed
 
+def main():
+    parser = get_parser()
+    args = parser.parse_args()
+    connection = Connection()
+    try:
+        if args.action == "batch":
+            if args.file is not None:
+                with open(args.file) as fd:
+                    nb_failed = run_lines(connection, parser, iter(fd))
+            else:
+                nb_failed = run_lines(connection, parser, iter(sys.stdin))
+            if nb_failed:
+                sys.exit(1)
+        elif args.action == "shell":
+            try:
+                import readline # history and line editing of raw_input
+            except ImportError:
+                pass
+            run_lines(connection, parser, None, prompt="experiments> ")
+        else:
+            run_action(connection, args)
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    main()
@@ -3,66 +3,200 @@
 import xmlrpclib
 from SimpleXMLRPCServer import SimpleXMLRPCServer
 from threading import Thread, Event
+from Queue import Queue, Empty as EmptyQueue
+from multiprocessing.pool import ThreadPool
 
-from process import MultipleProcessesManager, ProcessManager
+from process import MultipleProcessesManager, EventSource
+from scheduler import Scheduler
+from worker import Worker, connect, make_result_cache
+from cache import ResultCacheModel
+from wire import WireInterface
 import pymongo
+import config
 
-from db import Database, CommandModel
+from db import Database, CommandModel, CommandTemplateModel, JobModel, MODEL_CLASSES
 import time
 
 
 
 class Interface(object):
-    def __init__(self, database, multiple_processes_manager):
+    def __init__(self, database, multiple_processes_manager, scheduler=None):
         self.database = database
         self.multiple_processes_manager = multiple_processes_manager
+        self.scheduler = scheduler
 
+    # the job is already queued in the database, the scheduler 
+    # starts it as soon as there is a free slot
     def new_process(self, job_model):
         assert job_model._id is not None
-        process = ProcessManager(job_model)
-        self.multiple_processes_manager.add_process(process)
-        self.multiple_processes_manager.start_new_processes_and_update_states(self.database)
+        self.multiple_processes_manager.wakeup()
 
-    def kill_process(self, job_id):
-        self.multiple_processes_manager.kill_process_with_job_id(job_id, self.database)
+    # queue one job per dict of values, the arguments/files of the command 
+    # are formatted with the values (e.g "--lr=%(lr)s"), all the jobs are
+    # inserted at once. All the jobs depend on the jobs depends_on. 
+    # Returns the ids of the jobs
+    def new_sweep(self, command_id, values_list, priority=0, force_rerun=False, depends_on=None):
+        command_model = self.database.find_one(CommandModel, command_id)
+        assert command_model is not None
+        template = CommandTemplateModel.from_command_model(command_model)
+        job_models = [JobModel(command_model, priority=priority, depends_on=depends_on)
+                      for command_model in template.to_command_models(values_list)]
+        for job_model in job_models:
+            job_model.force_rerun = force_rerun
+        ids = self.database.insert_many(job_models)
+        if depends_on is not None:
+            self.database.resolve_dependencies(depends_on, ids)
+        self.multiple_processes_manager.wakeup()
+        return ids
 
+    def kill_process(self, job_id):
+        self.multiple_processes_manager.request_kill(job_id)
 
-Stop = False
-def multiple_processes_manager_poll(multiple_processes_manager, database, stop_event):
-    while not stop_event.is_set():
-        time.sleep(1)
-        multiple_processes_manager.processes_update_states(database)
-        multiple_processes_manager.add_available_output_to_job_model(database)
-        multiple_processes_manager.delete_finished_processes()
+    # timings and counters of the hot paths of the server
+    def metrics(self):
+        metrics = {}
+        metrics.update(self.multiple_processes_manager.metrics.summary())
+        metrics.update(self.database.metrics.summary())
+        metrics["running_jobs"] = len(self.multiple_processes_manager.processes)
+        if self.scheduler is not None:
+            metrics["queue_depth"] = self.scheduler.nb_queued_jobs(self.database)
+        return metrics
 
 
 import Pyro4
 Pyro4.config.SERIALIZER = 'pickle'
 Pyro4.config.SERIALIZERS_ACCEPTED.add('pickle')
-if __name__ == "__main__":
 
-    client = pymongo.MongoClient()
-    mongo_db = client["Test"]
-    database = Database(mongo_db)
-    multiple_processes_manager = MultipleProcessesManager()
-    interface = Interface(database, multiple_processes_manager)
+PORT = 50490
 
-    print "Staring MPM Poll thread..."
+# the SIGCHLD of a process can be missed when the event loop is not in the
+# main thread (see MultipleProcessesManager.__get_poll_timeout) : the states
+# of the processes are checked at least every THREADS_POLL_TIMEOUT seconds
+THREADS_POLL_TIMEOUT = 1
 
-    stop_event = Event()
-    multiple_processes_manager_poll_thread = (
-        Thread(target=multiple_processes_manager_poll,
-            args=(multiple_processes_manager, database, stop_event),
+# Pyro requests are handled by threads of Pyro, the event loop of the 
+# MultipleProcessesManager runs in its own thread
+def serve_threads(objects, multiple_processes_manager, database, stop_event, scheduler, worker):
+    print "Staring MPM event loop thread..."
+    multiple_processes_manager_thread = (
+        Thread(target=multiple_processes_manager.run_event_loop,
+            args=(database, stop_event),
+            kwargs={"timeout": THREADS_POLL_TIMEOUT, "scheduler": scheduler, "worker": worker},
             )
     )
-    multiple_processes_manager_poll_thread.daemon = True
-    multiple_processes_manager_poll_thread.start()
+    multiple_processes_manager_thread.daemon = True
+    multiple_processes_manager_thread.start()
+    try:
+        Pyro4.Daemon.serveSimple(objects, ns = False, port=PORT)
+    except KeyboardInterrupt:
+        pass
+    stop_event.set()
+    multiple_processes_manager.wakeup()
+    multiple_processes_manager_thread.join()
+
+# The requests of the clients of a Pyro daemon are handled by a pool of 
+# threads : a slow request (e.g stats, compact) does not block the event loop.
+# A connection is not watched by the loop while its request is handled. The 
+# sockets of the daemon are only changed by the loop (new connections, 
+# disconnected clients) : they are not thread safe
+class RequestPool(object):
+
+    def __init__(self, daemon, multiple_processes_manager, nb_threads):
+        self.daemon = daemon
+        self.server = daemon.transportServer
+        self.multiple_processes_manager = multiple_processes_manager
+        self.pool = ThreadPool(nb_threads)
+        self.busy = set()
+        self.disconnected = Queue()
+
+    def get_sockets(self):
+        while True:
+            try:
+                sock = self.disconnected.get(block=False)
+            except EmptyQueue:
+                break
+            try:
+                self.daemon._clientDisconnect(sock)
+            finally:
+                self.server.selector.unregister(sock)
+                sock.close()
+                self.busy.discard(sock)
+        return [sock for sock in self.daemon.sockets if sock not in self.busy]
+
+    def handle(self, sockets):
+        for sock in sockets:
+            if sock is self.server.sock: # new connection
+                self.daemon.events([sock])
+            else:
+                self.busy.add(sock)
+                self.pool.apply_async(self.__handle_request, (sock,))
+
+    def __handle_request(self, sock):
+        active = False
+        try:
+            active = self.server.handleRequest(sock)
+        finally:
+            if active:
+                self.busy.discard(sock)
+            else:
+                self.disconnected.put(sock)
+            self.multiple_processes_manager.wakeup()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+# The sockets of the Pyro daemon, the processes and the database writes are 
+# all watched by the event loop of the MultipleProcessesManager in the main 
+# thread. The requests are handled by a RequestPool, the writes of the loop 
+# are sent by another thread while the loop waits for the next events
+def serve_multiplex(objects, multiple_processes_manager, database, stop_event, scheduler, worker):
+    Pyro4.config.SERVERTYPE = "multiplex"
+    daemon = Pyro4.Daemon(port=PORT)
+    for obj, name in objects.items():
+        print "%s : %s" % (name, daemon.register(obj, name))
+    request_pool = RequestPool(daemon, multiple_processes_manager, config.SERVER_REQUEST_THREADS)
+    multiple_processes_manager.add_event_source(EventSource(request_pool.get_sockets, request_pool.handle))
+    flush_pool = ThreadPool(1)
     try:
-        Pyro4.Daemon.serveSimple(
-                {
-                    database: "database",
-                    interface: "interface"
-                },
-                ns = False, port=50490)
+        multiple_processes_manager.run_event_loop(database, stop_event, scheduler=scheduler,
+                                                  worker=worker, flush_pool=flush_pool)
     except KeyboardInterrupt:
-        stop_event.set()
+        pass
+    finally:
+        request_pool.close()
+        flush_pool.close()
+        flush_pool.join()
+        daemon.close()
+
+if __name__ == "__main__":
+
+    client, database = connect()
+    print "Creating indexes..."
+    database.ensure_indexes(MODEL_CLASSES + (ResultCacheModel,))
+    multiple_processes_manager = MultipleProcessesManager()
+    # the server is also a worker, other workers can be started with worker.py
+    worker = Worker(database, archive_jobs=True)
+    worker.register()
+    scheduler = Scheduler(multiple_processes_manager, worker.worker_id,
+                          max_concurrency=config.MAX_CONCURRENT_JOBS,
+                          category_limits=config.CATEGORY_LIMITS,
+                          result_cache=make_result_cache(database))
+    interface = Interface(database, multiple_processes_manager, scheduler)
+
+    objects = {
+        database: "database",
+        interface: "interface",
+        WireInterface(database): "wire"
+    }
+    stop_event = Event()
+    worker.start_archiving(stop_event)
+    multiple_processes_manager.install_sigchld_handler()
+    try:
+        if config.SERVER_MODE == "multiplex":
+            serve_multiplex(objects, multiple_processes_manager, database, stop_event, scheduler, worker)
+        else:
+            serve_threads(objects, multiple_processes_manager, database, stop_event, scheduler, worker)
+    finally:
+        multiple_processes_manager.abandon_processes()
+        worker.unregister()
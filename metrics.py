@@ -0,0 +1,83 @@
+import time
+import threading
+from collections import deque
+
+# number of seconds over which the rates of the counters are computed
+RATE_WINDOW = 60
+
+# count, total, min, max and last value of named measures (sizes, durations...)
+class Metrics(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        # name -> [total, deque of (second, count)]
+        self.counters = {}
+        self.start = time.time()
+
+    def record(self, name, value):
+        with self.lock:
+            if name not in self.values:
+                self.values[name] = {"count": 0, "total": 0, "min": value, "max": value, "last": value}
+            measure = self.values[name]
+            measure["count"] += 1
+            measure["total"] += value
+            measure["min"] = min(measure["min"], value)
+            measure["max"] = max(measure["max"], value)
+            measure["last"] = value
+
+    # add n to the counter name, e.g number of lines ingested
+    def count(self, name, n=1):
+        if n == 0:
+            return
+        second = int(time.time())
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = [0, deque()]
+            counter = self.counters[name]
+            counter[0] += n
+            if len(counter[1]) and counter[1][-1][0] == second:
+                counter[1][-1] = (second, counter[1][-1][1] + n)
+            else:
+                counter[1].append((second, n))
+            while counter[1][0][0] <= second - RATE_WINDOW:
+                counter[1].popleft()
+
+    def __rate(self, counter):
+        now = time.time()
+        window = min(RATE_WINDOW, now - self.start)
+        recent = sum(n for second, n in counter[1] if second > now - RATE_WINDOW)
+        return recent / window if window > 0 else 0.
+
+    # name -> dict of count, total, mean, min, max and last for the measures,
+    # name -> dict of total and rate_per_second (over RATE_WINDOW) for the counters
+    def summary(self):
+        with self.lock:
+            summary = {}
+            for name, measure in self.values.items():
+                summary[name] = dict(measure)
+                summary[name]["mean"] = float(measure["total"]) / measure["count"]
+            for name, counter in self.counters.items():
+                summary[name] = {"total": counter[0], "rate_per_second": self.__rate(counter)}
+            return summary
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+            self.counters = {}
+            self.start = time.time()
+
+# with Timer(metrics, "name"): ... records the duration in seconds of the block
+class Timer(object):
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.time() - self.start)
+        return False
@@ -1,43 +1,168 @@
-from multiprocessing import Process, Queue, Pipe, Value
 from subprocess import Popen, PIPE
 import sys, os
 import signal
-
-from db import JobModel
-
-from util import is_process_running
+import select
+import errno
+import time
+import hashlib
+
+import config
+from db import (JobModel, OutputChunkModel, SearchTermsModel, decompress_value, 
+    get_storable_string, get_bytes)
+
+from util import set_non_blocking
+from metrics import Metrics, Timer
+from cache import get_cache_key
+from search import TermExtractor, get_files_search_terms
+from blobstore import is_blob_reference
+from resources import Cgroup, is_cgroup_available, get_preexec_fn, remove_leftover_cgroups
+from copy import deepcopy
 from datetime import datetime
 
-from Queue import Empty as EmptyQueue
+from Queue import Queue, Empty as EmptyQueue
 
 class ProcessManager(object):
-    # job_model will be updated by ProcessManager
-    def __init__(self, job_model):
-        self.job_model = job_model
-        self.output_queue = Queue()
 
-        env = {}
-        env.update(os.environ)
-        env["jobid"] = str(self.job_model._id)
+    # the output streams of the process, each one is stored as chunks
+    # (see OutputChunkModel.stream) except stdout in "inline" mode
+    STREAMS = ("stdout", "stderr")
 
-        self.outer_process = Process(target=run_command, 
-            args=[self.job_model.command_model.args, 
-                  self.output_queue, self.job_model.command_model.cwd, env])
-        self.inner_process_pid = None
+    # job_model will be updated by ProcessManager, parent_job_models are 
+    # the jobs it depends on (JobModel.depends_on) with their output_data
+    def __init__(self, job_model, blob_store=None, result_cache=None, parent_job_models=None):
+        self.job_model = job_model
+        self.parent_job_models = parent_job_models if parent_job_models is not None else []
+        self.blob_store = blob_store
+        self.result_cache = result_cache
+        self.handle = None
+        self.closed_streams = set()
+        self.killed = False
+        self.result_to_cache = False
+        # cores of a job which does not reserve any : the cores not reserved
+        # by other jobs when it starts (see Scheduler.pin_shared_processes)
+        self.shared_cpus = None
+        self.nb_output_chunks = dict((stream, 0) for stream in self.STREAMS)
+        # chunks to store before the next ones (see __spill_inline_stdout)
+        self.pending_chunks = []
+        # the terms of the data of the job (see search.py), stored by 
+        # ProcessManagerDatabaseSync.sync_search_terms
+        self.search_terms = []
+        self.output_terms = dict((stream, TermExtractor()) for stream in self.STREAMS)
+        self.nb_output_bytes = 0
+        self.nb_output_lines = 0
+        # the output files of the running job (see OutputFileSnapshot)
+        self.output_file_snapshots = []
+        self.snapshot_time = None
 
         self.job_model.state = JobModel.NOT_YET_STARTED
 
+    # the job goes directly from NOT_YET_STARTED to STOPPED if its result is in the cache
     def start_and_update_state(self):
-        self.__start()
-        self.job_model.state = JobModel.RUNNING
         assert (self.job_model.datetime_from, self.job_model.datetime_to) == (None, None)
+        # killed before it was claimed by this worker, e.g requeued
+        if getattr(self.job_model, "kill_requested", False):
+            self.job_model.state = JobModel.STOPPED
+            now = datetime.now()
+            self.job_model.datetime_from, self.job_model.datetime_to = now, now
+            return
+        # before the input files are read : they can be output files of the parents
+        try:
+            for parent_job_model in self.parent_job_models:
+                write_output_files(parent_job_model, self.job_model.command_model.cwd, self.blob_store)
+        except Exception as e:
+            self.__start_failed(e)
+            return
+        self.job_model.store_input_data_from_command_model(self.blob_store)
+        if config.SEARCH_INDEX:
+            self.search_terms.extend(get_files_search_terms(
+                self.job_model, "input", self.job_model.command_model.input_files))
+        if self.result_cache is not None:
+            self.job_model.cache_key = get_cache_key(self.job_model)
+            if not getattr(self.job_model, "force_rerun", False):
+                cached_job_model = self.result_cache.lookup(self.job_model)
+                if cached_job_model is not None:
+                    self.__use_cached_result(cached_job_model)
+                    return
+        try:
+            self.__start()
+        except Exception as e:
+            # e.g the command does not exist or the cores can not be used : the job 
+            # failed. The exceptions of preexec_fn (IOError of the cgroup, ValueError
+            # of setrlimit...) are raised again here with their own type
+            self.__start_failed(e)
+            return
+        self.job_model.state = JobModel.RUNNING
         self.job_model.datetime_from, self.job_model.datetime_to = (datetime.now(), None)
 
+    # the job is stopped without return code : the jobs depending on it are cancelled
+    def __start_failed(self, e):
+        print "could not start job %s : %s" % (self.job_model._id, e)
+        self.__remove_cgroup()
+        self.handle = None
+        self.job_model.error = str(e)
+        self.job_model.state = JobModel.STOPPED
+        now = datetime.now()
+        self.job_model.datetime_from, self.job_model.datetime_to = now, now
+
+    def __use_cached_result(self, cached_job_model):
+        self.job_model.output_data = deepcopy(cached_job_model.output_data)
+        self.job_model.stdout_storage = getattr(cached_job_model, "stdout_storage", JobModel.STDOUT_INLINE)
+        self.job_model.cached_from = cached_job_model.get_stdout_job_id()
+        self.job_model.return_code = cached_job_model.return_code
+        self.job_model.state = JobModel.STOPPED
+        now = datetime.now()
+        self.job_model.datetime_from, self.job_model.datetime_to = now, now
+
     def __start(self):
-        assert self.inner_process_pid == None
-        self.job_model.store_input_data_from_command_model()
-        self.outer_process.start()
-        self.inner_process_pid = self.output_queue.get()
+        assert self.handle is None
+
+        env = {}
+        env.update(os.environ)
+        env["jobid"] = str(self.job_model._id)
+        # cores given by the Scheduler, memory declared by the command
+        cpus = getattr(self.job_model, "cpus", None)
+        memory = getattr(self.job_model.command_model, "memory", None)
+        self.cgroup = None
+        if (cpus or memory is not None) and is_cgroup_available():
+            cgroup = Cgroup("job-%s" % (self.job_model._id,))
+            try:
+                cgroup.create(cpus, memory)
+                self.cgroup = cgroup
+            except (IOError, OSError) as e:
+                print "could not create the cgroup of job %s (%s), using rlimits" % (self.job_model._id, e)
+                cgroup.remove()
+        self.start_time = time.time()
+        self.handle = run_command(self.job_model.command_model.args,
+                                  self.job_model.command_model.cwd, env,
+                                  get_preexec_fn(cpus or self.shared_cpus, memory, self.cgroup))
+        if config.OUTPUT_FILES_SNAPSHOT_INTERVAL is not None:
+            cwd = self.job_model.command_model.cwd
+            # named as in output_data
+            self.output_file_snapshots = [OutputFileSnapshot(name.replace(".", "__"), os.path.join(cwd, name)) 
+                for name in map(self.job_model.format_str, self.job_model.command_model.output_files)]
+            self.snapshot_time = self.start_time
+
+    @property
+    def pid(self):
+        return self.handle.pid
+
+    def get_stream(self, stream):
+        return getattr(self.handle, stream)
+
+    # file descriptors of the output streams not closed yet, 
+    # watched by the MultipleProcessesManager
+    def filenos(self):
+        return [self.get_stream(stream).fileno() for stream in self.STREAMS
+                if stream not in self.closed_streams]
+
+    def closed_filenos(self):
+        return [self.get_stream(stream).fileno() for stream in self.STREAMS
+                if stream in self.closed_streams]
+
+    # all the output of the process has been read
+    @property
+    def output_closed(self):
+        return len(self.closed_streams) == len(self.STREAMS)
 
     def kill_and_update_state(self):
         self.__kill()
@@ -49,78 +174,350 @@ class ProcessManager(object):
 
 
     def __kill(self):
-        assert self.inner_process_pid is not None
-        self.__kill_inner_process()
-        self.outer_process.terminate()
-
-    def __kill_inner_process(self):
+        assert self.handle is not None
+        self.killed = True
         try:
-            os.kill(self.inner_process_pid, signal.SIGKILL)
+            self.handle.kill()
         except OSError:
-            print "could not kill %d" % (self.inner_process_pid,)
+            print "could not kill %d" % (self.pid,)
+        self.__reap(block=True)
 
+    # non blocking, reaps the process if it has finished
     def is_alive(self):
-        if self.outer_process.is_alive():
-            assert self.inner_process_pid is not None
-            return self.__is_inner_process_alive()
+        if self.handle.returncode is None:
+            self.__reap(block=False)
+        return self.handle.returncode is None
+
+    # wait4 instead of waitpid (Popen.poll/wait) to get the resource usage of the process
+    def __reap(self, block):
+        if self.handle.returncode is not None:
+            return
+        while True:
+            try:
+                pid, status, rusage = os.wait4(self.pid, 0 if block else os.WNOHANG)
+                break
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD: # already reaped
+                    self.handle.returncode = self.handle.poll()
+                    self.__remove_cgroup()
+                    return
+                raise
+        if pid == 0:
+            return
+        if os.WIFSIGNALED(status):
+            self.handle.returncode = -os.WTERMSIG(status)
         else:
-            return False
+            self.handle.returncode = os.WEXITSTATUS(status)
+        self.job_model.resources = {
+            "cpu_user": rusage.ru_utime,
+            "cpu_sys": rusage.ru_stime,
+            "max_rss_kb": rusage.ru_maxrss,
+            "wall_time": time.time() - self.start_time,
+        }
+        self.__remove_cgroup()
+
+    def __remove_cgroup(self):
+        if getattr(self, "cgroup", None) is not None:
+            self.cgroup.remove()
+            self.cgroup = None
 
-    # If the inner process is alive and the outer process is not alive, kill the inner process
     def check_if_alive_and_update_state(self):
         if self.job_model.state != JobModel.RUNNING:
             return
-        #assert self.job_model.state ==  JobModel.RUNNING
         if not self.is_alive():
-            if self.__is_inner_process_alive():
-                self.__kill_inner_process()
             self.job_model.state = JobModel.STOPPED
             self.__stopped()
             started_datetime, stopped_datetime = self.job_model.datetime_from, self.job_model.datetime_to
             assert started_datetime is not None and stopped_datetime is None
             self.job_model.datetime_from, self.job_model.datetime_to = started_datetime, datetime.now()
 
-    def __is_inner_process_alive(self):
-        return is_process_running(self.inner_process_pid)
-
-    # get a list of available stdout output as a list of strings (lines)
-    # this procedure is not blocking, it returns only the available lines
-    def get_available_output(self):
+    # get a list of available output of the stream as a list of strings
+    # this procedure is not blocking, it returns only what can be read from the pipe.
+    # At most max_size bytes are read : what is not read stays in the pipe and 
+    # the process is blocked when the pipe is full, so the memory used does not
+    # depend on the output rate of the process
+    def get_available_output(self, stream="stdout", max_size=None):
+        max_size = max_size if max_size is not None else config.OUTPUT_BUFFER_SIZE
         output = []
-        while True:
+        size = 0
+        while self.handle is not None and stream not in self.closed_streams and size < max_size:
             try:
-                data =  self.output_queue.get(block=False)
-            except EmptyQueue:
-                break
-            else:
-                if data is not Finish:
-                    output.append(data)
-                else:
+                data = os.read(self.get_stream(stream).fileno(), min(READ_SIZE, max_size - size))
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
                     break
+                raise
+            if data:
+                output.append(data)
+                if config.SEARCH_INDEX:
+                    self.output_terms[stream].add(data)
+                size += len(data)
+                self.nb_output_bytes += len(data)
+                self.nb_output_lines += data.count("\n")
+            else:
+                self.closed_streams.add(stream)
+                if self.output_closed:
+                    self.output_closed_time = time.time()
         return output
 
+    # the stdout is concatenated to the job model until it is bigger than 
+    # config.INLINE_STDOUT_MAX_SIZE, then the job switches to "chunks" mode
     def add_available_output_to_job_model_and_get_nblines(self):
-        output = self.get_available_output()
-        self.job_model.output_data["stdout"] += "".join(output)
+        output = self.get_available_output("stdout")
+        if len(output) == 0:
+            return 0
+        stdout = get_bytes(decompress_value(self.job_model.output_data["stdout"])) + "".join(output)
+        if len(stdout) > config.INLINE_STDOUT_MAX_SIZE:
+            self.__spill_inline_stdout(stdout)
+        else:
+            self.job_model.output_data["stdout"] = get_storable_string(stdout)
         return len(output)
 
+    def __spill_inline_stdout(self, stdout):
+        self.job_model.stdout_storage = JobModel.STDOUT_CHUNKS
+        self.job_model.output_data["stdout"] = ""
+        self.pending_chunks.append(self.__new_chunk("stdout", stdout))
+
+    def __new_chunk(self, stream, data):
+        chunk = OutputChunkModel(self.job_model._id, self.nb_output_chunks[stream], data, stream)
+        self.nb_output_chunks[stream] += 1
+        return chunk
+
+    # the new output of the streams stored as chunks, as new OutputChunkModels
+    # (the stdout is not included in "inline" mode)
+    def get_available_output_chunks(self):
+        chunks, self.pending_chunks = self.pending_chunks, []
+        for stream in self.STREAMS:
+            if stream == "stdout" and not self.job_model.has_chunked_stdout():
+                continue
+            output = self.get_available_output(stream)
+            if len(output) > 0:
+                chunks.append(self.__new_chunk(stream, "".join(output)))
+        return chunks
+
+    # the SearchTermsModels not stored yet, including the new terms of the output
+    def pop_search_terms(self):
+        search_terms, self.search_terms = self.search_terms, []
+        for stream, extractor in self.output_terms.items():
+            terms = extractor.pop_new_terms(finished=self.job_model.state == JobModel.STOPPED)
+            if len(terms):
+                search_terms.append(SearchTermsModel(self.job_model._id, "output", stream, terms))
+        return search_terms
+
+    # when the output files have to be checked again, None if never
+    def next_snapshot_time(self):
+        if len(self.output_file_snapshots) == 0:
+            return None
+        # a snapshot in progress continues at the next iteration
+        if any(snapshot.is_in_progress() for snapshot in self.output_file_snapshots):
+            return self.snapshot_time
+        return self.snapshot_time + config.OUTPUT_FILES_SNAPSHOT_INTERVAL
+
+    # ([(stream, changed chunks, number of chunks or None)], number of bytes 
+    # read) of the output files which changed since the last snapshot, checked
+    # every OUTPUT_FILES_SNAPSHOT_INTERVAL seconds. At most about max_size bytes
+    # are read : a snapshot can take several calls, the number of chunks of a 
+    # file is only given at the end of its snapshot. Once the job is stopped 
+    # the files are in its output_data : the chunks of their snapshots are removed
+    def get_output_files_changes(self, now=None, max_size=None):
+        if self.job_model.state == JobModel.STOPPED:
+            snapshots, self.output_file_snapshots = self.output_file_snapshots, []
+            return [(snapshot.stream, [], 0) for snapshot in snapshots 
+                    if snapshot.stat is not None or snapshot.is_in_progress()], 0
+        now = now if now is not None else time.time()
+        max_size = max_size if max_size is not None else config.OUTPUT_FILES_SNAPSHOT_MAX_SIZE
+        if self.next_snapshot_time() is None or now < self.next_snapshot_time():
+            return [], 0
+        if not any(snapshot.is_in_progress() for snapshot in self.output_file_snapshots):
+            self.snapshot_time = now
+            for snapshot in self.output_file_snapshots:
+                snapshot.start()
+        changes, size = [], 0
+        for snapshot in self.output_file_snapshots:
+            if not snapshot.is_in_progress() or size >= max_size:
+                continue
+            blocks, nb_blocks, size_read = snapshot.next_changes(max_size - size)
+            size += size_read
+            chunks = [OutputChunkModel(self.job_model._id, index, data, snapshot.stream)
+                      for index, data in blocks]
+            changes.append((snapshot.stream, chunks, nb_blocks))
+        return changes, size
+
+    def close(self):
+        if self.handle is not None:
+            for stream in self.STREAMS:
+                self.get_stream(stream).close()
+
     # event when the start turn on stopped
     def __stopped(self):
-        self.job_model.store_output_data_from_command_model()
+        self.job_model.return_code = self.handle.returncode
+        self.job_model.store_output_data_from_command_model(self.blob_store)
+        if config.SEARCH_INDEX:
+            self.search_terms.extend(get_files_search_terms(
+                self.job_model, "output", self.job_model.command_model.output_files))
+        # stored by ProcessManagerDatabaseSync.sync, after the job itself
+        self.result_to_cache = (self.result_cache is not None and not self.killed 
+                                and self.job_model.return_code == 0)
+
+
+# the changes of an output file of a running job, found by polling its mtime 
+# and size. The file is cut in blocks of OUTPUT_FILES_SNAPSHOT_BLOCK_SIZE bytes,
+# only the blocks which changed since the last snapshot are stored, as the 
+# chunks of the stream "file:<name>" of the job
+class OutputFileSnapshot(object):
+
+    def __init__(self, name, path, block_size=None):
+        self.stream = "file:%s" % (name,)
+        self.path = path
+        self.block_size = block_size if block_size is not None else config.OUTPUT_FILES_SNAPSHOT_BLOCK_SIZE
+        self.stat = None # (mtime, size) of the file at the last complete snapshot
+        self.block_hashes = [] # md5 of the stored blocks
+        self.scan = None # [stat, offset of the next block] of the snapshot in progress
+
+    def is_in_progress(self):
+        return self.scan is not None
+
+    # a snapshot is started if the file changed. A file which grew is 
+    # usually appended to : only the blocks from its previous end are 
+    # read, unless its first block changed too
+    def start(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return
+        stat = (st.st_mtime, st.st_size)
+        if stat == self.stat:
+            return
+        offset = 0
+        try:
+            if self.stat is not None and stat[1] > self.stat[1] and self.__is_first_block_unchanged():
+                offset = self.stat[1] // self.block_size * self.block_size
+        except IOError:
+            return
+        self.scan = [stat, offset]
+
+    def __is_first_block_unchanged(self):
+        if len(self.block_hashes) == 0:
+            return False
+        with open(self.path, "rb") as fd:
+            return hashlib.md5(fd.read(self.block_size)).digest() == self.block_hashes[0]
+
+    # ([(index, data)] of the changed blocks among the next blocks of about 
+    # max_size bytes, number of blocks of the file at the end of the snapshot 
+    # or None, number of bytes read)
+    def next_changes(self, max_size):
+        stat, offset = self.scan
+        blocks, size = [], 0
+        finished = False
+        try:
+            with open(self.path, "rb") as fd:
+                fd.seek(offset)
+                while size < max_size:
+                    data = fd.read(self.block_size)
+                    if not data:
+                        finished = True
+                        break
+                    index = offset // self.block_size
+                    block_hash = hashlib.md5(data).digest()
+                    if index >= len(self.block_hashes):
+                        self.block_hashes.append(block_hash)
+                        blocks.append((index, data))
+                    elif self.block_hashes[index] != block_hash:
+                        self.block_hashes[index] = block_hash
+                        blocks.append((index, data))
+                    offset += len(data)
+                    size += len(data)
+        except (IOError, OSError): # removed : tried again at the next snapshot
+            self.scan = None
+            return blocks, None, size
+        if not finished:
+            self.scan[1] = offset
+            return blocks, None, size
+        nb_blocks = (offset + self.block_size - 1) // self.block_size
+        del self.block_hashes[nb_blocks:]
+        self.stat, self.scan = stat, None
+        return blocks, nb_blocks, size
+
+# the output files of a job are written in the directory cwd (e.g the working 
+# directory of a job depending on it), except the ones which already exist there
+# IOError if the job is archived on another host (see Database.restore_job)
+def write_output_files(job_model, cwd, blob_store=None):
+    if getattr(job_model, "archive", None) is not None:
+        raise IOError("the output files of job %s are archived on another host" % (job_model._id,))
+    for name, value in getattr(job_model, "output_data", {}).items():
+        if name in ProcessManager.STREAMS:
+            continue
+        if is_blob_reference(value):
+            filename = value["filename"]
+        else:
+            filename = name.replace("__", ".")
+        filename = os.path.join(cwd, filename)
+        if os.path.exists(filename):
+            continue
+        directory = os.path.dirname(filename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if is_blob_reference(value):
+            if blob_store is not None:
+                blob_store.get_file(value["blob"], filename)
+        else:
+            with open(filename, "wb") as fd:
+                fd.write(decompress_value(value))
+
+READ_SIZE = 65536
+# start the command, its stdout and stderr are non blocking pipes owned by the caller.
+# preexec_fn is called in the child process (see resources.get_preexec_fn)
+def run_command(args, cwd=".", env=None, preexec_fn=None):
+    handle = Popen(args, cwd=cwd, stdout=PIPE, stderr=PIPE, env=env, close_fds=True,
+                   preexec_fn=preexec_fn)
+    set_non_blocking(handle.stdout.fileno())
+    set_non_blocking(handle.stderr.fileno())
+    return handle
+
 
+# epoll when available, poll otherwise
+class Poller(object):
 
-Finish = None
-def run_command(args, output_queue, cwd=".", env=None):
-    handle = Popen(args, cwd=cwd, stdout=PIPE, universal_newlines=True, env=env)
-    output_queue.put(handle.pid)
-    while True:
-        line = handle.stdout.readline()
-        if line:
-            output_queue.put(line)
+    def __init__(self):
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.flags = select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR
+            self.timeout_scale = 1
         else:
-            break
-    output_queue.put(Finish)
-    print "finish"
+            self.poller = select.poll()
+            self.flags = select.POLLIN | select.POLLHUP | select.POLLERR
+            self.timeout_scale = 1000
+
+    def register(self, fd):
+        self.poller.register(fd, self.flags)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    # returns the list of ready file descriptors, empty on timeout or when interrupted by a signal
+    def poll(self, timeout):
+        try:
+            events = self.poller.poll(timeout * self.timeout_scale)
+        except (IOError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        return [fd for fd, event in events]
+
+
+# other sockets watched by the event loop than the outputs of the processes,
+# e.g the sockets of a Pyro daemon in "multiplex" mode : get_sockets() gives
+# the current sockets, handle(sockets) is called with the ready ones
+class EventSource(object):
+
+    def __init__(self, get_sockets, handle):
+        self.get_sockets = get_sockets
+        self.handle = handle
+        self.sockets = {} # fd -> socket
 
 
 class ProcessManagerDatabaseSync(object):
@@ -131,37 +528,117 @@ class ProcessManagerDatabaseSync(object):
 
     def sync(self):
         self.database.save(self.process_manager.job_model)
+        self.sync_result_cache()
+        self.sync_search_terms()
+
+    def sync_result_cache(self):
+        process_manager = self.process_manager
+        if process_manager.result_to_cache:
+            process_manager.result_to_cache = False
+            process_manager.result_cache.store(process_manager.job_model, 
+                                               process_manager.nb_output_bytes, self.database)
+
+    # the jobs depending on the stopped job can be started, or are cancelled if it failed
+    def sync_dependents(self):
+        job_model = self.process_manager.job_model
+        if job_model.has_succeeded():
+            self.database.release_dependents(job_model._id)
+        else:
+            self.database.cancel_dependents(job_model._id)
+
+    def sync_search_terms(self):
+        for search_terms in self.process_manager.pop_search_terms():
+            self.database.insert(search_terms)
+
+    # only send the new slice of output, not the whole job model
+    def sync_output(self, chunk):
+        self.database.append_output(chunk)
+
+    # the changed blocks of an output file, the blocks after its end are 
+    # removed at the end of the snapshot (nb_chunks)
+    def sync_output_file(self, stream, chunks, nb_chunks=None):
+        for chunk in chunks:
+            self.database.put_output(chunk)
+        if nb_chunks is not None:
+            self.database.truncate_output(self.process_manager.job_model._id, stream, nb_chunks)
 
 
+# after its output is closed, the exit of a process is checked every 
+# OUTPUT_CLOSED_CHECK_INTERVAL seconds during OUTPUT_CLOSED_CHECK_DURATION seconds
+OUTPUT_CLOSED_CHECK_INTERVAL = 0.05
+OUTPUT_CLOSED_CHECK_DURATION = 1
+
 # manage multiple ProcessManagers and update  sync with the database
 class MultipleProcessesManager(object):
 
-    def __init__(self):
+    def __init__(self, metrics=None):
         self.processes = []
+        # timings of the event loop, see Interface.metrics
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # requests coming from other threads, executed by the event loop
+        self.requests = Queue()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        set_non_blocking(self.wakeup_read)
+        set_non_blocking(self.wakeup_write)
+        self.poller = Poller()
+        self.poller.register(self.wakeup_read)
+        self.watched = {} # fd -> process or EventSource
+        self.event_sources = []
+        # the write batch being flushed by the flush pool (see run_event_loop)
+        self.pending_flush = None
+        # the jobs found not owned anymore by the last flushed batch
+        self.lost_job_ids = set()
 
     def add_process(self, process):
         self.processes.append(process)
-    
+
     def kill_process_with_job_id(self, job_id, database):
         found = False
         for process in self.processes:
             if process.job_model._id == job_id:
                 process.kill_and_update_state()
                 ProcessManagerDatabaseSync(process, database).sync()
+                ProcessManagerDatabaseSync(process, database).sync_dependents()
                 found = True
                 break
-        if not found:
-            job_model = database.find_one(JobModel, job_id)
-            if job_model:
-                job_model.state = JobModel.STOPPED
-                database.save(job_model)
+        # claimed by another worker, which will kill it, or stopped here
+        if not found and database.request_kill(job_id):
+            database.cancel_dependents(job_id)
+
+    # kill the processes without updating their jobs in the database,
+    # used when the jobs are not owned by this MultipleProcessesManager anymore
+    def abandon_processes(self):
+        for process in self.processes:
+            self.__abandon_process(process)
+        self.processes = []
+
+    # only the processes of the jobs found lost by the write batches 
+    # (e.g requeued by another worker), their last writes were dropped
+    def abandon_lost_processes(self):
+        lost_job_ids, self.lost_job_ids = self.lost_job_ids, set()
+        lost = [process for process in self.processes if process.job_model._id in lost_job_ids]
+        for process in lost:
+            print "job %s is not owned by this worker anymore, abandoning it" % (process.job_model._id,)
+            self.__abandon_process(process)
+            self.processes.remove(process)
+
+    def __abandon_process(self, process):
+        if process.handle is not None and process.is_alive():
+            process.handle.kill()
+            process.handle.wait()
+        self.unwatch(process)
+        process.close()
 
     def start_new_processes_and_update_states(self, database):
         for process in self.processes:
             if process.job_model.state == JobModel.NOT_YET_STARTED:
                 process.start_and_update_state()
-                assert process.job_model.state == JobModel.RUNNING
+                assert process.job_model.state != JobModel.NOT_YET_STARTED
                 ProcessManagerDatabaseSync(process, database).sync()
+                # the result was in the result cache, or it was not started
+                if process.job_model.state == JobModel.STOPPED:
+                    ProcessManagerDatabaseSync(process, database).sync_dependents()
 
     def processes_update_states(self, database):
         for process in self.processes:
@@ -170,18 +647,230 @@ class MultipleProcessesManager(object):
             # update only if state has changed
             if old_state != process.job_model.state:
                 ProcessManagerDatabaseSync(process, database).sync()
-
-    def add_available_output_to_job_model(self, database):
-        for process in self.processes:
+                ProcessManagerDatabaseSync(process, database).sync_dependents()
+
+    def add_available_output_to_job_model(self, database, processes=None):
+        if processes is None:
+            processes = self.processes
+        for process in processes:
+            nb_lines, nb_bytes = process.nb_output_lines, process.nb_output_bytes
+            self.__add_available_output_to_job_model(process, database)
+            self.metrics.count("output_lines", process.nb_output_lines - nb_lines)
+            self.metrics.count("output_bytes", process.nb_output_bytes - nb_bytes)
+
+    def __add_available_output_to_job_model(self, process, database):
+        if not process.job_model.has_chunked_stdout():
             nblines = process.add_available_output_to_job_model_and_get_nblines()
             # update only if there are new lines
             if nblines > 0:
                 ProcessManagerDatabaseSync(process, database).sync()
+        for chunk in process.get_available_output_chunks():
+            ProcessManagerDatabaseSync(process, database).sync_output(chunk)
+        ProcessManagerDatabaseSync(process, database).sync_search_terms()
+
+    # at most OUTPUT_FILES_SNAPSHOT_MAX_SIZE bytes of output files are read and 
+    # kept in the batch by an iteration, the snapshots continue at the next ones
+    def snapshot_output_files(self, database):
+        now = time.time()
+        max_size = config.OUTPUT_FILES_SNAPSHOT_MAX_SIZE
+        for process in self.processes:
+            changes, size = process.get_output_files_changes(now, max_size)
+            max_size -= size
+            for stream, chunks, nb_chunks in changes:
+                ProcessManagerDatabaseSync(process, database).sync_output_file(stream, chunks, nb_chunks)
 
-    # must be called AFTER processes_update_states and add_available_output_to_job_model
+    # must be called AFTER processes_update_states and add_available_output_to_job_model,
+    # the cgroups of the processes which left processes behind are removed once they exited
     def delete_finished_processes(self):
+        remove_leftover_cgroups()
+        finished = [process for process in self.processes
+                    if process.job_model.state == JobModel.STOPPED]
         self.processes = [process for process in self.processes
                           if process.job_model.state != JobModel.STOPPED]
+        for process in finished:
+            self.unwatch(process)
+            process.close()
+
+    # thread safe interface, used by the Interface exposed with Pyro
+    def submit_process(self, process):
+        self.requests.put(lambda database: self.add_process(process))
+        self.wakeup()
+
+    def request_kill(self, job_id):
+        self.requests.put(lambda database: self.kill_process_with_job_id(job_id, database))
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_write, "x")
+        except OSError as e:
+            # the pipe is full : the event loop will wake up anyway
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    # must be called from the main thread : the C level signal handler
+    # writes to the wakeup pipe whatever thread is running
+    def install_sigchld_handler(self):
+        signal.set_wakeup_fd(self.wakeup_write)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+        signal.siginterrupt(signal.SIGCHLD, False)
+
+    def watch(self, process):
+        if process.handle is None:
+            return
+        for fd in process.filenos():
+            if fd not in self.watched:
+                self.watched[fd] = process
+                self.poller.register(fd)
+
+    # by default all the file descriptors of the process
+    def unwatch(self, process, fds=None):
+        if process.handle is None:
+            return
+        if fds is None:
+            fds = process.filenos() + process.closed_filenos()
+        for fd in fds:
+            if self.watched.get(fd) is process:
+                self.poller.unregister(fd)
+                del self.watched[fd]
+
+    def add_event_source(self, event_source):
+        self.event_sources.append(event_source)
+        self.__watch_event_source(event_source)
+
+    # the sockets of an event source change (e.g new connections), the 
+    # closed ones are removed and the new ones added
+    def __watch_event_source(self, event_source):
+        sockets = dict((sock.fileno(), sock) for sock in event_source.get_sockets())
+        for fd in event_source.sockets.keys():
+            if fd not in sockets and self.watched.get(fd) is event_source:
+                del self.watched[fd]
+                try:
+                    self.poller.unregister(fd)
+                except (IOError, OSError): # already closed
+                    pass
+        for fd in sockets:
+            if fd not in self.watched:
+                self.watched[fd] = event_source
+                self.poller.register(fd)
+        event_source.sockets = sockets
+
+    def __drain_wakeup_pipe(self):
+        try:
+            while os.read(self.wakeup_read, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def __execute_requests(self, database):
+        while True:
+            try:
+                request = self.requests.get(block=False)
+            except EmptyQueue:
+                break
+            request(database)
+
+    # react to the termination of processes (SIGCHLD), new output and requests
+    # as soon as they happen, timeout is only a safety net.
+    # If a scheduler is given, the slots freed by finished processes are 
+    # filled again with queued jobs in the same iteration. If a worker is
+    # given, its heartbeats are sent by the loop.
+    # If a flush_pool (a ThreadPool) is given, the writes of an iteration are
+    # sent by the pool while the loop waits for the next events and handles
+    # the event sources, the next iteration waits for them before going on
+    def run_event_loop(self, database, stop_event, timeout=5, scheduler=None, worker=None, flush_pool=None):
+        try:
+            while not stop_event.is_set():
+                ready = self.poller.poll(self.__get_poll_timeout(timeout))
+                with Timer(self.metrics, "event_loop_iteration_seconds"):
+                    self.__run_iteration(ready, database, scheduler, worker, flush_pool)
+        finally:
+            self.__wait_pending_flush()
+
+    # The SIGCHLD of a process can be missed : python only writes to the wakeup 
+    # pipe again once the main thread has handled the previous signal, which
+    # can take long if the main thread is blocked (e.g in the "threads" server
+    # mode). The processes whose output has just been closed are checked soon.
+    # The output files of the processes are checked at their next snapshot time
+    def __get_poll_timeout(self, timeout):
+        now = time.time()
+        for process in self.processes:
+            if process.job_model.state == JobModel.RUNNING and process.output_closed and \
+                    now - process.output_closed_time < OUTPUT_CLOSED_CHECK_DURATION:
+                return min(timeout, OUTPUT_CLOSED_CHECK_INTERVAL)
+            next_snapshot_time = process.next_snapshot_time()
+            if next_snapshot_time is not None:
+                timeout = min(timeout, max(next_snapshot_time - now, 0))
+        return timeout
+
+    # the jobs released by the batch can be claimed now : another iteration is needed
+    # and the processes of the lost jobs are abandoned by the next one
+    def __flushed(self, batch):
+        self.lost_job_ids.update(batch.lost_job_ids)
+        if batch.released_dependents or len(batch.lost_job_ids):
+            self.wakeup()
+
+    def __wait_pending_flush(self):
+        if self.pending_flush is not None:
+            pending_flush, self.pending_flush = self.pending_flush, None
+            pending_flush.get()
+
+    def __run_iteration(self, ready, database, scheduler, worker, flush_pool):
+        check_states = (len(ready) == 0)
+        with_output = []
+        ready_sockets = {} # event source -> ready sockets
+        for fd in ready:
+            if fd == self.wakeup_read:
+                self.__drain_wakeup_pipe()
+                check_states = True
+            elif fd in self.watched:
+                watched = self.watched[fd]
+                if isinstance(watched, EventSource):
+                    ready_sockets.setdefault(watched, []).append(watched.sockets[fd])
+                else:
+                    with_output.append(watched)
+        for event_source, sockets in ready_sockets.items():
+            event_source.handle(sockets)
+        for event_source in self.event_sources:
+            self.__watch_event_source(event_source)
+
+        self.__wait_pending_flush()
+        self.abandon_lost_processes()
+        # all the state and output updates of the iteration are sent together,
+        # fenced by the worker (see WriteBatch)
+        batch = database.new_write_batch(worker_id=worker.worker_id if worker is not None else None)
+        if worker is not None:
+            worker.tick(self)
+        self.add_available_output_to_job_model(batch, with_output)
+        # a process has usually exited when its output is closed
+        if any(process.output_closed for process in with_output):
+            check_states = True
+        if check_states:
+            self.__execute_requests(database)
+            self.processes_update_states(batch)
+            # the remaining output of the stopped processes
+            stopped = [process for process in self.processes
+                       if process.job_model.state == JobModel.STOPPED]
+            self.add_available_output_to_job_model(batch, stopped)
+            with_output.extend(stopped)
+        for process in with_output:
+            self.unwatch(process, process.closed_filenos())
+        self.snapshot_output_files(batch)
+        self.delete_finished_processes()
+        if check_states:
+            if scheduler is not None:
+                scheduler.fill_slots(database)
+            self.start_new_processes_and_update_states(batch)
+        if flush_pool is None:
+            batch.flush()
+            self.__flushed(batch)
+        else:
+            self.pending_flush = flush_pool.apply_async(batch.flush,
+                                                        callback=lambda result: self.__flushed(batch))
+        for process in self.processes:
+            self.watch(process)
+
 
 if __name__ == "__main__":
     from db import CommandModel
@@ -193,11 +882,10 @@ if __name__ == "__main__":
     p = ProcessManager(job_model)
     p.start_and_update_state()
 
-    while True:
-        data =  p.output_queue.get()
-        if data is not Finish:
-            print data
-        else:
-            break
+    while p.is_alive() or not p.output_closed:
+        for stream in p.STREAMS:
+            for data in p.get_available_output(stream):
+                print stream, data
+        select.select(p.filenos(), [], [], 1)
     p.check_if_alive_and_update_state()
     print job_model.output_data
@@ -0,0 +1,154 @@
+import os
+import errno
+import signal
+import ctypes
+import ctypes.util
+import resource
+import multiprocessing
+
+import config
+
+# cores and memory of the host given to the jobs : each job which declares
+# cores (CommandModel.cores) is pinned to its own cores and each job which
+# declares memory (CommandModel.memory, in bytes) is limited to it, with a
+# cgroup v2 when config.CGROUP_ROOT can be used and a rlimit otherwise
+
+CPU_SETSIZE = 1024
+ULONG_BITS = 8 * ctypes.sizeof(ctypes.c_ulong)
+CpuSet = ctypes.c_ulong * (CPU_SETSIZE / ULONG_BITS)
+
+_libc = None
+def get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    return _libc
+
+# os.sched_getaffinity/os.sched_setaffinity do not exist in python 2
+def get_cpu_affinity(pid=0):
+    mask = CpuSet()
+    if get_libc().sched_getaffinity(pid, ctypes.sizeof(mask), mask) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return [cpu for cpu in range(CPU_SETSIZE) if mask[cpu // ULONG_BITS] & (1 << (cpu % ULONG_BITS))]
+
+def set_cpu_affinity(cpus, pid=0):
+    mask = CpuSet()
+    for cpu in cpus:
+        mask[cpu // ULONG_BITS] |= 1 << (cpu % ULONG_BITS)
+    if get_libc().sched_setaffinity(pid, ctypes.sizeof(mask), mask) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+# the cores the jobs can use : config.RESOURCE_CPUS or the cores of the server
+def get_available_cpus():
+    if config.RESOURCE_CPUS is not None:
+        return list(config.RESOURCE_CPUS)
+    try:
+        return get_cpu_affinity()
+    except (OSError, AttributeError):
+        return range(multiprocessing.cpu_count())
+
+# the memory (bytes) the jobs can use : config.RESOURCE_MEMORY or the memory of the host
+def get_available_memory():
+    if config.RESOURCE_MEMORY is not None:
+        return config.RESOURCE_MEMORY
+    with open("/proc/meminfo") as fd:
+        for line in fd:
+            if line.startswith("MemTotal:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+def is_cgroup_available():
+    root = config.CGROUP_ROOT
+    return root is not None and os.path.isdir(root) and os.access(root, os.W_OK)
+
+# a cgroup v2 per job, created in config.CGROUP_ROOT
+class Cgroup(object):
+
+    def __init__(self, name):
+        self.path = os.path.join(config.CGROUP_ROOT, name)
+
+    def create(self, cpus=None, memory=None):
+        # the controllers must be enabled for the children of the root
+        try:
+            with open(os.path.join(config.CGROUP_ROOT, "cgroup.subtree_control"), "w") as fd:
+                fd.write("+memory +cpuset")
+        except (IOError, OSError):
+            pass
+        os.mkdir(self.path)
+        if memory is not None:
+            self.write("memory.max", str(memory))
+            # no swap : the job is killed when it uses more than memory
+            if os.path.exists(os.path.join(self.path, "memory.swap.max")):
+                self.write("memory.swap.max", "0")
+        if cpus is not None and os.path.exists(os.path.join(self.path, "cpuset.cpus")):
+            self.write("cpuset.cpus", ",".join(map(str, cpus)))
+
+    def write(self, filename, value):
+        with open(os.path.join(self.path, filename), "w") as fd:
+            fd.write(value)
+
+    # called in the process itself (see get_preexec_fn)
+    def add_current_process(self):
+        self.write("cgroup.procs", str(os.getpid()))
+
+    # the processes left in the cgroup (e.g started in the background by the job)
+    def kill(self):
+        if os.path.exists(os.path.join(self.path, "cgroup.kill")):
+            self.write("cgroup.kill", "1")
+            return
+        with open(os.path.join(self.path, "cgroup.procs")) as fd:
+            pids = [int(pid) for pid in fd.read().split()]
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    # True once removed. While processes are left in the cgroup they are 
+    # killed and False is returned : they take some time to exit
+    def try_remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return True
+            if e.errno != errno.EBUSY:
+                print "could not remove the cgroup %s : %s" % (self.path, e)
+                return True
+            try:
+                self.kill()
+            except (IOError, OSError) as e:
+                print "could not kill the processes of the cgroup %s : %s" % (self.path, e)
+            return False
+        return True
+
+    # once the process of the job has exited, the removal of a cgroup with 
+    # processes left is done later by remove_leftover_cgroups
+    def remove(self):
+        if not self.try_remove():
+            leftover_cgroups.append(self)
+
+# the cgroups which still had processes when they were removed
+leftover_cgroups = []
+
+def remove_leftover_cgroups():
+    for cgroup in list(leftover_cgroups):
+        if cgroup.try_remove():
+            leftover_cgroups.remove(cgroup)
+
+# the function called in the child process before the command is executed,
+# None if there is nothing to limit
+def get_preexec_fn(cpus=None, memory=None, cgroup=None):
+    if not cpus and memory is None and cgroup is None:
+        return None
+    def preexec_fn():
+        if cgroup is not None:
+            cgroup.add_current_process()
+        elif memory is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+        if cpus:
+            set_cpu_affinity(cpus)
+    return preexec_fn
@@ -0,0 +1,127 @@
+import multiprocessing
+from collections import defaultdict
+
+import config
+from db import JobModel
+from process import ProcessManager
+from resources import get_available_cpus, get_available_memory, set_cpu_affinity
+
+# The queue of jobs is the set of NOT_YET_STARTED jobs in the database which
+# are not claimed by a worker, it survives restarts of the server. The scheduler
+# starts them by decreasing priority (then by submission order) as long as there
+# are free slots. Jobs waiting for other jobs (JobModel.waiting_on) are not 
+# started.
+# Only the jobs whose resources (CommandModel.cores/memory) fit in the free 
+# resources of the host are claimed. A job declaring cores gets its own
+# cores (JobModel.cpus), the jobs declaring nothing share the other ones :
+# they are pinned to the cores not reserved, again each time the reserved
+# cores change (only their main process, its children keep their cores).
+class Scheduler(object):
+
+    def __init__(self, multiple_processes_manager, worker_id, max_concurrency=None, category_limits=None,
+                 result_cache=None, cpus=None, memory=None):
+        self.multiple_processes_manager = multiple_processes_manager
+        self.result_cache = result_cache
+        # recorded in the claimed jobs
+        self.worker_id = worker_id
+        if max_concurrency is None:
+            max_concurrency = multiprocessing.cpu_count()
+        self.max_concurrency = max_concurrency
+        self.category_limits = category_limits if category_limits is not None else {}
+        # the cores (ids) and memory (bytes, None for no limit) given to the jobs
+        self.cpus = cpus if cpus is not None else get_available_cpus()
+        self.memory = memory if memory is not None else get_available_memory()
+
+    def nb_running_per_category(self):
+        nb = defaultdict(int)
+        for process in self.multiple_processes_manager.processes:
+            for category in process.job_model.command_model.categories:
+                nb[category] += 1
+        return nb
+
+    # the cores not given to a running job and the memory not reserved by one
+    def free_resources(self):
+        used_cpus, used_memory = set(), 0
+        for process in self.multiple_processes_manager.processes:
+            used_cpus.update(getattr(process.job_model, "cpus", None) or [])
+            used_memory += getattr(process.job_model.command_model, "memory", None) or 0
+        free_cpus = [cpu for cpu in self.cpus if cpu not in used_cpus]
+        free_memory = self.memory - used_memory if self.memory is not None else None
+        return free_cpus, free_memory
+
+    # a job without cores/memory (missing or None) always fits
+    def resources_params(self, free_cpus, free_memory):
+        params = {"command_model.cores": {"$not": {"$gt": len(free_cpus)}}}
+        if free_memory is not None:
+            params["command_model.memory"] = {"$not": {"$gt": free_memory}}
+        return params
+
+    def nb_free_slots(self):
+        return self.max_concurrency - len(self.multiple_processes_manager.processes)
+
+    def full_categories(self, nb_running_per_category):
+        return [category for category, limit in self.category_limits.items()
+                if nb_running_per_category[category] >= limit]
+
+    # add ProcessManagers for the next jobs of the queue to the 
+    # MultipleProcessesManager, returns the number of added processes.
+    # Jobs are claimed one by one and atomically, several schedulers 
+    # (workers) can share the same queue
+    def fill_slots(self, database):
+        nb_added = 0
+        while self.nb_free_slots() > 0:
+            params = {"waiting_on.0": {"$exists": False}}
+            full_categories = self.full_categories(self.nb_running_per_category())
+            if len(full_categories):
+                params["command_model.categories"] = {"$nin": full_categories}
+            free_cpus, free_memory = self.free_resources()
+            # all the cores are reserved : no job can run
+            if len(free_cpus) == 0:
+                break
+            params.update(self.resources_params(free_cpus, free_memory))
+            job_model = database.claim_job(self.worker_id, params,
+                                           sort=[("priority", -1), ("_id", 1)])
+            if job_model is None:
+                break
+            process = ProcessManager(job_model, database.blob_store, self.result_cache,
+                                     self.get_parent_job_models(database, job_model))
+            cores = getattr(job_model.command_model, "cores", None)
+            if cores:
+                job_model.cpus = free_cpus[:cores]
+            self.multiple_processes_manager.add_process(process)
+            nb_added += 1
+        self.pin_shared_processes()
+        return nb_added
+
+    # the processes which do not reserve cores run on the cores not reserved
+    def pin_shared_processes(self):
+        free_cpus = self.free_resources()[0]
+        for process in self.multiple_processes_manager.processes:
+            if getattr(process.job_model, "cpus", None) or process.shared_cpus == free_cpus:
+                continue
+            process.shared_cpus = free_cpus
+            if process.handle is not None and process.job_model.state == JobModel.RUNNING:
+                try:
+                    set_cpu_affinity(free_cpus, process.pid)
+                except OSError: # it has just exited
+                    pass
+
+    # the jobs the job depends on, with their output files
+    def get_parent_job_models(self, database, job_model):
+        depends_on = getattr(job_model, "depends_on", [])
+        if len(depends_on) == 0:
+            return []
+        projection = {"output_data": True, "archive": True}
+        parent_job_models = database.find(JobModel, {"_id": {"$in": depends_on}}, projection)
+        # their output files are needed : the archived ones are restored
+        archived = [job_model._id for job_model in parent_job_models 
+                    if getattr(job_model, "archive", None) is not None]
+        if len(archived) == 0:
+            return parent_job_models
+        for job_id in archived:
+            database.restore_job(job_id)
+        return database.find(JobModel, {"_id": {"$in": depends_on}}, projection)
+
+    def nb_queued_jobs(self, database):
+        return database.count(JobModel, {"state": JobModel.NOT_YET_STARTED, "worker_id": None,
+                                         "waiting_on.0": {"$exists": False}})
@@ -0,0 +1,111 @@
+import os
+import re
+import string
+
+import config
+from db import SearchTermsModel
+
+# the terms of a content are its words : letters, digits, "_", "-" and "."
+TERM_REGEX = re.compile(r"[\w.\-]+")
+TERM_CHARS = frozenset(string.ascii_letters + string.digits + "_.-")
+MIN_TERM_LENGTH, MAX_TERM_LENGTH = 2, 64
+
+READ_SIZE = 65536
+
+def normalize_term(term):
+    return term.strip(".-").lower()
+
+# terms of a content given block by block (e.g the output of a process),
+# a term cut between two blocks is kept whole. At most max_terms terms and
+# max_size bytes of content are taken into account
+class TermExtractor(object):
+
+    def __init__(self, max_terms=None, max_size=None):
+        self.max_terms = max_terms if max_terms is not None else config.SEARCH_INDEX_MAX_TERMS
+        self.max_size = max_size if max_size is not None else config.SEARCH_INDEX_MAX_SIZE
+        self.terms = set()
+        self.new_terms = set() # terms not returned yet by pop_new_terms
+        self.rest = "" # end of the last block, the beginning of a term
+        self.size = 0
+
+    def is_full(self):
+        return len(self.terms) >= self.max_terms or self.size >= self.max_size
+
+    def add(self, data):
+        if self.is_full():
+            return
+        data = data[:self.max_size - self.size]
+        self.size += len(data)
+        data = self.rest + data
+        # the term at the end of the block can continue in the next one
+        start = len(data)
+        while start > 0 and len(data) - start <= MAX_TERM_LENGTH and data[start - 1] in TERM_CHARS:
+            start -= 1
+        data, self.rest = data[:start], data[start:]
+        self.__add_terms(TERM_REGEX.findall(data))
+
+    def __add_terms(self, words):
+        for word in words:
+            term = normalize_term(word)
+            if MIN_TERM_LENGTH <= len(term) <= MAX_TERM_LENGTH and term not in self.terms:
+                if len(self.terms) >= self.max_terms:
+                    break
+                self.terms.add(term)
+                self.new_terms.add(term)
+
+    # the terms found since the last call, the end of the content is
+    # taken into account if finished
+    def pop_new_terms(self, finished=False):
+        if finished and self.rest:
+            self.__add_terms([self.rest])
+            self.rest = ""
+        new_terms, self.new_terms = self.new_terms, set()
+        return sorted(new_terms)
+
+def get_file_terms(filename):
+    extractor = TermExtractor()
+    with open(filename, "rb") as fd:
+        while not extractor.is_full():
+            data = fd.read(READ_SIZE)
+            if not data:
+                break
+            extractor.add(data)
+    return extractor.pop_new_terms(finished=True)
+
+# SearchTermsModels of the files of the job (names as in input_data/output_data)
+def get_files_search_terms(job_model, field, filenames):
+    models = []
+    for filename in filenames:
+        filename = job_model.format_str(filename)
+        try:
+            terms = get_file_terms(os.path.join(job_model.command_model.cwd, filename))
+        except (IOError, OSError):
+            continue
+        name = filename.replace(".", "__")
+        models.append(SearchTermsModel(job_model._id, field, name, terms))
+    return models
+
+def get_query_terms(contains):
+    return [normalize_term(term) for term in contains]
+
+# ids of the jobs whose data of field ("input" or "output") contains the terms :
+#   a string          : the term is in one of the data
+#   a list of strings : one of the terms is in one of the data
+#   a dict            : for each name of data (e.g a filename), the term or
+#                       one of the terms (list) is in the data
+# works with a Database or its Pyro proxy
+def find_job_ids(database, field, contains):
+    if isinstance(contains, dict):
+        job_ids = None
+        for filename, terms in contains.items():
+            if isinstance(terms, basestring):
+                terms = [terms]
+            ids = set(database.distinct(SearchTermsModel, "job_id",
+                {"field": field, "name": filename.replace(".", "__"),
+                 "terms": {"$in": get_query_terms(terms)}}))
+            job_ids = ids if job_ids is None else job_ids & ids
+        return job_ids if job_ids is not None else set()
+    if isinstance(contains, basestring):
+        contains = [contains]
+    return set(database.distinct(SearchTermsModel, "job_id",
+        {"field": field, "terms": {"$in": get_query_terms(contains)}}))
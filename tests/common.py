@@ -0,0 +1,15 @@
+import uuid
+
+import mongomock
+
+import db
+
+# the tests use an in memory mongo, as benchmark.py --in-process
+if mongomock.Database not in db.DATABASE_TYPES:
+    db.DATABASE_TYPES += (mongomock.Database,)
+
+def make_mongo_db():
+    return mongomock.MongoClient()["test_%s" % (uuid.uuid4().hex,)]
+
+def make_database(blob_store=None, archive=None):
+    return db.Database(make_mongo_db(), blob_store, archive)
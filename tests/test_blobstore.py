@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import common
+from blobstore import LocalBlobStore, hash_file
+from db import JobModel, CommandModel
+
+
+class BlobStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.blob_store = LocalBlobStore(os.path.join(self.directory, "blobs"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_file(self, name, content):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "wb") as fd:
+            fd.write(content)
+        return filename
+
+
+class LocalBlobStoreTest(BlobStoreTestCase):
+
+    # the same content is stored once
+    def test_dedup(self):
+        first = self.blob_store.put_file(self.write_file("a.txt", "content"), "a.txt")
+        second = self.blob_store.put_file(self.write_file("b.txt", "content"), "b.txt")
+        other = self.blob_store.put_file(self.write_file("c.txt", "other"), "c.txt")
+        self.assertEqual(first["blob"], second["blob"])
+        self.assertEqual((first["filename"], second["filename"]), ("a.txt", "b.txt"))
+        self.assertEqual(first["size"], len("content"))
+        self.assertNotEqual(first["blob"], other["blob"])
+        self.assertEqual(sorted(self.blob_store.iter_keys()), sorted([first["blob"], other["blob"]]))
+
+    def test_read(self):
+        content = "".join(chr(i % 256) for i in range(5000))
+        reference = self.blob_store.put_file(self.write_file("a.bin", content))
+        self.assertEqual(reference["blob"], hash_file(os.path.join(self.directory, "a.bin"))[0])
+        self.assertEqual(self.blob_store.read(reference["blob"], 4000, 2000), content[4000:])
+        filename = os.path.join(self.directory, "copy.bin")
+        self.blob_store.get_file(reference["blob"], filename)
+        self.assertEqual(open(filename, "rb").read(), content)
+
+    def test_min_age(self):
+        key = self.blob_store.put_file(self.write_file("a.txt", "content"))["blob"]
+        self.assertEqual(list(self.blob_store.iter_keys(3600)), [])
+        os.utime(self.blob_store.path(key), (0, 0))
+        self.assertEqual(list(self.blob_store.iter_keys(3600)), [key])
+
+
+class DeleteUnreferencedBlobsTest(BlobStoreTestCase):
+
+    # only the blobs no job nor archive of a job references are deleted
+    def test_gc(self):
+        database = common.make_database(self.blob_store)
+        input_ref = self.blob_store.put_file(self.write_file("in.txt", "input"), "in.txt")
+        output_ref = self.blob_store.put_file(self.write_file("out.txt", "output"), "out.txt")
+        archived_key = self.blob_store.put_file(self.write_file("old.txt", "archived"))["blob"]
+        unreferenced_key = self.blob_store.put_file(self.write_file("gone.txt", "gone"))["blob"]
+        job_model = JobModel(CommandModel(["true"]))
+        job_model.input_data = {"in__txt": input_ref}
+        job_model.output_data = {"stdout": "", "out__txt": output_ref}
+        database.insert(job_model)
+        database.db[JobModel.__name__].insert({"archive": "old.pkl.gz", "archived_blobs": [archived_key]})
+        self.assertEqual(database.delete_unreferenced_blobs(min_age=0), 1)
+        self.assertFalse(self.blob_store.exists(unreferenced_key))
+        for key in (input_ref["blob"], output_ref["blob"], archived_key):
+            self.assertTrue(self.blob_store.exists(key))
+        # the blobs stored recently can be referenced by a job not inserted yet
+        self.blob_store.put_file(self.write_file("new.txt", "new"))
+        self.assertEqual(database.delete_unreferenced_blobs(min_age=3600), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,291 @@
+import shutil
+import datetime
+import tempfile
+import unittest
+
+from bson import BSON, ObjectId
+
+import common
+from archive import JobArchive
+from db import get_changes, DocumentCache, JobModel, CommandModel, OutputChunkModel, \
+    compress_value, decompress_value, compress_field, get_value_size
+
+
+class GetChangesTest(unittest.TestCase):
+
+    def test_same_document(self):
+        document = {"_id": 1, "a": 1, "b": {"c": [1, 2]}}
+        self.assertEqual(get_changes(document, dict(document)), ({}, {}))
+
+    def test_top_level_set_and_unset(self):
+        self.assertEqual(get_changes({"a": 1, "b": 2}, {"a": 3, "c": 4}),
+                         ({"a": 3, "c": 4}, {"b": ""}))
+
+    def test_nested_set(self):
+        old = {"a": {"b": 1, "c": {"d": 2}}}
+        new = {"a": {"b": 1, "c": {"d": 3, "e": 4}}}
+        self.assertEqual(get_changes(old, new), ({"a.c.d": 3, "a.c.e": 4}, {}))
+
+    def test_nested_unset(self):
+        old = {"a": {"b": 1, "c": {"d": 2, "e": 3}}}
+        new = {"a": {"c": {"d": 2}}}
+        self.assertEqual(get_changes(old, new), ({}, {"a.b": "", "a.c.e": ""}))
+
+    def test_new_nested_document(self):
+        self.assertEqual(get_changes({"a": {"b": 1}}, {"a": {"b": 1, "c": {"d": 1}}}),
+                         ({"a.c": {"d": 1}}, {}))
+
+    # the whole value is set, nothing is unset under the old path
+    def test_dict_to_scalar(self):
+        self.assertEqual(get_changes({"a": {"b": 1, "c": 2}}, {"a": 5}), ({"a": 5}, {}))
+
+    def test_scalar_to_dict(self):
+        self.assertEqual(get_changes({"a": 5}, {"a": {"b": 1}}), ({"a": {"b": 1}}, {}))
+
+    def test_dict_to_empty_dict(self):
+        self.assertEqual(get_changes({"a": {"b": 1}}, {"a": {}}), ({}, {"a.b": ""}))
+
+    # equal values of different types are different (e.g 1 and True)
+    def test_type_change(self):
+        self.assertEqual(get_changes({"a": 1, "b": "x"}, {"a": True, "b": u"x"}),
+                         ({"a": True, "b": u"x"}, {}))
+
+    def test_list_change(self):
+        self.assertEqual(get_changes({"a": [1, 2]}, {"a": [1, 2, 3]}), ({"a": [1, 2, 3]}, {}))
+
+    # only the _id of the document itself is ignored
+    def test_id(self):
+        self.assertEqual(get_changes({"_id": 1, "a": {"_id": 1}}, {"_id": 2, "a": {"_id": 2}}),
+                         ({"a._id": 2}, {}))
+
+
+def get_size(document):
+    return len(BSON.encode(document))
+
+class DocumentCacheTest(unittest.TestCase):
+
+    def test_get(self):
+        cache = DocumentCache(10)
+        cache.put(("Job", 1), "v1", {"a": 1})
+        self.assertEqual(cache.get(("Job", 1)), ("v1", {"a": 1}))
+        self.assertEqual(cache.get(("Job", 2)), None)
+
+    # a copy of the document is returned
+    def test_get_copy(self):
+        cache = DocumentCache(10)
+        cache.put(("Job", 1), "v1", {"a": [1]})
+        cache.get(("Job", 1))[1]["a"].append(2)
+        self.assertEqual(cache.get(("Job", 1)), ("v1", {"a": [1]}))
+
+    def test_entries_eviction(self):
+        cache = DocumentCache(2)
+        cache.put(("Job", 1), "v", {"a": 1})
+        cache.put(("Job", 2), "v", {"a": 2})
+        cache.get(("Job", 1)) # 2 is now the least recently used
+        cache.put(("Job", 3), "v", {"a": 3})
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get(("Job", 2)), None)
+        self.assertNotEqual(cache.get(("Job", 1)), None)
+        self.assertNotEqual(cache.get(("Job", 3)), None)
+
+    def test_bytes_eviction(self):
+        documents = [{"data": "x" * 100, "i": i} for i in range(3)]
+        size = get_size(documents[0])
+        cache = DocumentCache(10, max_bytes=2 * size)
+        for i, document in enumerate(documents[:2]):
+            cache.put(("Job", i), "v", document)
+        self.assertEqual(cache.size, 2 * size)
+        cache.get(("Job", 0)) # 1 is now the least recently used
+        cache.put(("Job", 2), "v", documents[2])
+        self.assertEqual(cache.size, 2 * size)
+        self.assertEqual(cache.get(("Job", 1)), None)
+        self.assertNotEqual(cache.get(("Job", 0)), None)
+        self.assertNotEqual(cache.get(("Job", 2)), None)
+
+    # the entries are evicted until the new one fits
+    def test_bytes_eviction_several_entries(self):
+        small, big = {"data": "x" * 10}, {"data": "x" * 100}
+        cache = DocumentCache(10, max_bytes=get_size(big) + get_size(small))
+        for i in range(3):
+            cache.put(("Job", i), "v", small)
+        cache.put(("Job", 3), "v", big)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, get_size(big) + get_size(small))
+        self.assertNotEqual(cache.get(("Job", 2)), None)
+
+    # a document bigger than the cache is not kept and evicts nothing
+    def test_too_big(self):
+        small = {"data": "x"}
+        cache = DocumentCache(10, max_bytes=2 * get_size(small))
+        cache.put(("Job", 1), "v", small)
+        cache.put(("Job", 2), "v", {"data": "x" * 1000})
+        self.assertEqual(cache.get(("Job", 2)), None)
+        self.assertNotEqual(cache.get(("Job", 1)), None)
+        self.assertEqual(cache.size, get_size(small))
+
+    # the size of the replaced entry is not counted anymore
+    def test_replace(self):
+        cache = DocumentCache(10, max_bytes=1000)
+        cache.put(("Job", 1), "v1", {"data": "x" * 100})
+        cache.put(("Job", 1), "v2", {"data": "x"})
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, get_size({"data": "x"}))
+        self.assertEqual(cache.get(("Job", 1)), ("v2", {"data": "x"}))
+
+    def test_invalidate(self):
+        cache = DocumentCache(10, max_bytes=1000)
+        cache.put(("Job", 1), "v", {"a": 1})
+        cache.put(("Job", 2), "v", {"a": 2})
+        cache.put(("Command", 1), "v", {"a": 3})
+        cache.invalidate(("Job", 1))
+        self.assertEqual(cache.get(("Job", 1)), None)
+        cache.invalidate_collection("Job")
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, get_size({"a": 3}))
+        self.assertNotEqual(cache.get(("Command", 1)), None)
+
+
+class CompressionTest(unittest.TestCase):
+
+    DATA = "line of output\n" * 100
+
+    def test_round_trip(self):
+        for algorithm in ("zlib", "bz2"):
+            value = compress_value(self.DATA, algorithm)
+            self.assertIn(algorithm, value)
+            self.assertTrue(len(value[algorithm]) < len(self.DATA))
+            self.assertEqual(decompress_value(value), self.DATA)
+            self.assertEqual(get_value_size(value), len(self.DATA))
+
+    # the small strings and the values which are not strings are left as they are
+    def test_not_compressed(self):
+        self.assertEqual(compress_value("small", "zlib"), "small")
+        self.assertEqual(compress_value(12, "zlib"), 12)
+        self.assertEqual(decompress_value("small"), "small")
+
+    def test_unicode(self):
+        data = u"caf\xe9 " * 100
+        self.assertEqual(decompress_value(compress_value(data, "zlib")), data.encode("utf-8"))
+
+    def test_field(self):
+        blob = {"blob": "key", "filename": "out.txt"}
+        field = compress_field({"stdout": self.DATA, "out__txt": blob, "small": "x"})
+        self.assertIn("zlib", field["stdout"])
+        self.assertEqual(field["out__txt"], blob)
+        self.assertEqual(field["small"], "x")
+        # already compressed
+        self.assertEqual(compress_field(field["stdout"]), field["stdout"])
+
+    # compressed in mongo, as they were once read
+    def test_database(self):
+        database = common.make_database()
+        job_model = JobModel(CommandModel(["true"]))
+        job_model.output_data["stdout"] = self.DATA
+        job_id = database.insert(job_model)
+        database.append_output(OutputChunkModel(job_id, 0, self.DATA, "stderr"))
+        data = database.db[JobModel.__name__].find_one({"_id": job_id})
+        self.assertIn("zlib", data["output_data"]["stdout"])
+        self.assertIn("zlib", database.db[OutputChunkModel.__name__].find_one()["data"])
+        self.assertEqual(database.find_one(JobModel, job_id).get_data("stdout"), self.DATA)
+        self.assertEqual(database.find_output(job_id, "stderr"), [self.DATA])
+
+    # the documents stored before the compression was enabled
+    def test_compress_documents(self):
+        database = common.make_database()
+        job_id = database.db[JobModel.__name__].insert({"output_data": {"stdout": self.DATA}})
+        self.assertEqual(database.compress_documents(JobModel), 1)
+        self.assertEqual(database.compress_documents(JobModel), 0)
+        data = database.db[JobModel.__name__].find_one({"_id": job_id})
+        self.assertEqual(decompress_value(data["output_data"]["stdout"]), self.DATA)
+
+
+class ResolveDependenciesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.database = common.make_database()
+
+    def insert_job(self, state=JobModel.NOT_YET_STARTED, return_code=None, depends_on=None):
+        job_model = JobModel(CommandModel(["true"]), state=state, depends_on=depends_on)
+        job_model.return_code = return_code
+        job_model._id = self.database.insert(job_model)
+        return job_model._id
+
+    def resolve(self, depends_on):
+        job_id = self.insert_job(depends_on=depends_on)
+        self.database.resolve_dependencies(depends_on, [job_id])
+        return self.database.find_one(JobModel, job_id)
+
+    # the parents which already succeeded are not waited for
+    def test_succeeded(self):
+        succeeded = self.insert_job(JobModel.STOPPED, 0)
+        running = self.insert_job(JobModel.RUNNING)
+        job_model = self.resolve([succeeded, running])
+        self.assertEqual(job_model.state, JobModel.NOT_YET_STARTED)
+        self.assertEqual(job_model.waiting_on, [running])
+
+    def test_failed(self):
+        failed = self.insert_job(JobModel.STOPPED, 1)
+        job_model = self.resolve([self.insert_job(JobModel.RUNNING), failed])
+        self.assertEqual(job_model.state, JobModel.STOPPED)
+        self.assertTrue(job_model.cancelled)
+
+    # e.g a typo : the job would wait forever
+    def test_unknown(self):
+        unknown = ObjectId()
+        job_model = self.resolve([self.insert_job(JobModel.STOPPED, 0), unknown])
+        self.assertEqual(job_model.state, JobModel.STOPPED)
+        self.assertTrue(job_model.cancelled)
+        self.assertIn(str(unknown), job_model.error)
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = common.make_database(archive=JobArchive(self.directory))
+        job_model = JobModel(CommandModel(["true"]), state=JobModel.STOPPED,
+                             input_data={"in__txt": "input"}, output_data={"stdout": "out"})
+        job_model.datetime_to = datetime.datetime.now() - datetime.timedelta(days=1)
+        self.job_id = self.database.insert(job_model)
+        self.database.append_output(OutputChunkModel(self.job_id, 0, "chunk", "stdout"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_archive_and_restore(self):
+        before = self.database.find_one(JobModel, self.job_id)
+        self.assertTrue(self.database.archive_job(self.job_id))
+        job_model = self.database.find_one(JobModel, self.job_id)
+        self.assertFalse(hasattr(job_model, "output_data"))
+        self.assertEqual(self.database.find_output(self.job_id), [])
+        self.assertFalse(self.database.archive_job(self.job_id))
+        self.assertTrue(self.database.restore_job(self.job_id))
+        job_model = self.database.find_one(JobModel, self.job_id)
+        self.assertFalse(hasattr(job_model, "archive"))
+        self.assertEqual(job_model.input_data, before.input_data)
+        self.assertEqual(job_model.output_data, before.output_data)
+        self.assertEqual(self.database.find_output(self.job_id), ["chunk"])
+
+    # e.g restored by a worker on another host
+    def test_restore_without_archive(self):
+        self.database.archive_job(self.job_id)
+        other_directory = tempfile.mkdtemp()
+        try:
+            self.database.archive = JobArchive(other_directory)
+            self.assertFalse(self.database.restore_job(self.job_id))
+        finally:
+            shutil.rmtree(other_directory)
+        job_model = self.database.find_one(JobModel, self.job_id)
+        self.assertNotEqual(getattr(job_model, "archive", None), None)
+
+    def test_archive_old_jobs(self):
+        before = datetime.datetime.now() - datetime.timedelta(days=2)
+        self.assertEqual(self.database.archive_old_jobs(before), 0)
+        self.assertEqual(self.database.archive_old_jobs(datetime.datetime.now()), 1)
+        # not archived again once restored
+        self.database.restore_job(self.job_id)
+        self.assertEqual(self.database.archive_old_jobs(datetime.datetime.now() - datetime.timedelta(hours=1)), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import errno
+import shutil
+import select
+import tempfile
+import unittest
+
+import common
+import config
+import resources
+from db import JobModel, CommandModel, OutputChunkModel, decompress_value
+from process import ProcessManager, OutputFileSnapshot
+
+
+def make_job_model(program, **kwargs):
+    return JobModel(CommandModel([sys.executable, "-c", program], **kwargs))
+
+# run the process until its output is closed, as MultipleProcessesManager
+def run(process):
+    process.start_and_update_state()
+    while not process.output_closed:
+        select.select(process.filenos(), [], [], 1)
+        process.add_available_output_to_job_model_and_get_nblines()
+        process.get_available_output_chunks()
+    process.handle.wait()
+    process.check_if_alive_and_update_state()
+    return process
+
+
+class InlineOutputTest(unittest.TestCase):
+
+    PROGRAM = "import sys; sys.stdout.write('caf\\xc3\\xa9 \\xff\\n'); sys.stderr.write('\\xe9')"
+
+    # the stdout of a job read by pymongo is unicode
+    def test_non_ascii_inline_stdout(self):
+        job_model = make_job_model(self.PROGRAM)
+        job_model.stdout_storage = JobModel.STDOUT_INLINE
+        job_model.output_data["stdout"] = u""
+        run(ProcessManager(job_model))
+        self.assertEqual(job_model.state, JobModel.STOPPED)
+        self.assertEqual(str(decompress_value(job_model.output_data["stdout"])), "caf\xc3\xa9 \xff\n")
+
+    # stored before stdout_storage existed : inline
+    def test_non_ascii_legacy_stdout(self):
+        job_model = make_job_model(self.PROGRAM)
+        del job_model.stdout_storage
+        job_model.output_data["stdout"] = u"d\xe9j\xe0 "
+        run(ProcessManager(job_model))
+        self.assertEqual(str(decompress_value(job_model.output_data["stdout"])), 
+                         "d\xc3\xa9j\xc3\xa0 caf\xc3\xa9 \xff\n")
+
+
+class FindOutputTest(unittest.TestCase):
+
+    # utf-8 chunks are read as unicode, the others as Binary
+    def test_bytes(self):
+        database = common.make_database()
+        job_model = make_job_model("pass")
+        job_model._id = database.insert(job_model)
+        database.append_output(OutputChunkModel(job_model._id, 0, "caf\xc3\xa9 ", "stderr"))
+        database.append_output(OutputChunkModel(job_model._id, 1, "\xff", "stderr"))
+        database.db[OutputChunkModel.__name__].update_one({"index": 0}, {"$set": {"data": u"caf\xe9 "}})
+        chunks = database.find_output(job_model._id, "stderr")
+        self.assertTrue(all(isinstance(chunk, str) for chunk in chunks))
+        self.assertEqual("".join(chunks), "caf\xc3\xa9 \xff")
+
+
+class ParentOutputFilesTest(unittest.TestCase):
+
+    # the job fails to start instead of raising in the event loop
+    def test_not_writable(self):
+        directory = tempfile.mkdtemp()
+        try:
+            parent_job_model = make_job_model("pass")
+            parent_job_model.output_data["out__txt"] = "data"
+            job_model = make_job_model("pass")
+            job_model.command_model.cwd = os.path.join(directory, "missing", "cwd")
+            open(os.path.join(directory, "missing"), "w").close()
+            process = ProcessManager(job_model, parent_job_models=[parent_job_model])
+            process.start_and_update_state()
+            self.assertEqual(job_model.state, JobModel.STOPPED)
+            self.assertEqual(process.handle, None)
+            self.assertNotEqual(job_model.error, None)
+            self.assertFalse(job_model.has_succeeded())
+        finally:
+            shutil.rmtree(directory)
+
+    # archived on another host : the job can not get its input files
+    def test_archived(self):
+        parent_job_model = make_job_model("pass")
+        parent_job_model.archive = "parent.pkl.gz"
+        del parent_job_model.output_data
+        job_model = make_job_model("pass")
+        process = ProcessManager(job_model, parent_job_models=[parent_job_model])
+        process.start_and_update_state()
+        self.assertEqual(job_model.state, JobModel.STOPPED)
+        self.assertIn("archived on another host", job_model.error)
+
+
+class OutputFileSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "out.txt")
+        self.snapshot = OutputFileSnapshot("out.txt", self.path, block_size=4)
+        self.mtime = 1000000
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # a new mtime each time : the changes are seen even within the same second
+    def write(self, data, mode="wb"):
+        with open(self.path, mode) as fd:
+            fd.write(data)
+        self.mtime += 1
+        os.utime(self.path, (self.mtime, self.mtime))
+
+    # (changed blocks, number of blocks) of a complete snapshot
+    def take(self, max_size=1000):
+        self.snapshot.start()
+        if not self.snapshot.is_in_progress():
+            return None
+        changes = []
+        while True:
+            blocks, nb_blocks, size = self.snapshot.next_changes(max_size)
+            changes.extend(blocks)
+            if nb_blocks is not None:
+                return changes, nb_blocks
+
+    def test_missing_file(self):
+        self.assertEqual(self.take(), None)
+
+    def test_unchanged(self):
+        self.write("0123456789")
+        self.assertEqual(self.take(), ([(0, "0123"), (1, "4567"), (2, "89")], 3))
+        self.assertEqual(self.take(), None)
+
+    # only the blocks from the previous end are read
+    def test_append(self):
+        self.write("0123456789")
+        self.take()
+        self.write("ab", "ab")
+        self.assertEqual(self.snapshot.start(), None)
+        self.assertEqual(self.snapshot.scan[1], 8)
+        self.assertEqual(self.take(), ([(2, "89ab")], 3))
+
+    def test_rewritten_block(self):
+        self.write("0123456789")
+        self.take()
+        self.write("0123xxxx89")
+        self.assertEqual(self.take(), ([(1, "xxxx")], 3))
+
+    def test_truncated(self):
+        self.write("0123456789")
+        self.take()
+        self.write("0123")
+        self.assertEqual(self.take(), ([], 1))
+        self.write("01234")
+        self.assertEqual(self.take(), ([(1, "4")], 2))
+
+    # at most about max_size bytes are read at a time
+    def test_max_size(self):
+        self.write("0123456789")
+        self.snapshot.start()
+        self.assertEqual(self.snapshot.next_changes(4), ([(0, "0123")], None, 4))
+        self.assertEqual(self.snapshot.next_changes(4), ([(1, "4567")], None, 4))
+        self.assertEqual(self.snapshot.next_changes(4), ([(2, "89")], 3, 2))
+        self.assertFalse(self.snapshot.is_in_progress())
+
+
+def is_running(pid):
+    try:
+        with open("/proc/%d/stat" % pid) as fd:
+            return fd.read().split(")")[-1].split()[0] != "Z"
+    except IOError:
+        return False
+
+def wait_for(condition, timeout=10):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError("timeout")
+        time.sleep(0.05)
+
+
+# a directory instead of the cgroup v2 : its removal fails with EBUSY while
+# a process written to its cgroup.procs is running, as the kernel
+class CgroupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cgroup_root, config.CGROUP_ROOT = config.CGROUP_ROOT, self.root
+        self.rmdir = os.rmdir
+        os.rmdir = self.fake_rmdir
+
+    def tearDown(self):
+        os.rmdir = self.rmdir
+        config.CGROUP_ROOT = self.cgroup_root
+        del resources.leftover_cgroups[:]
+        shutil.rmtree(self.root)
+
+    def fake_rmdir(self, path):
+        if not path.startswith(self.root):
+            return self.rmdir(path)
+        with open(os.path.join(path, "cgroup.procs")) as fd:
+            if any(is_running(int(pid)) for pid in fd.read().split()):
+                raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+        for filename in os.listdir(path):
+            os.remove(os.path.join(path, filename))
+        self.rmdir(path)
+
+    # the job is stopped, the process left in the background is killed and
+    # the cgroup removed once it exited
+    def test_background_process(self):
+        pid_path = os.path.join(self.root, "sleep.pid")
+        job_model = JobModel(CommandModel(["sh", "-c", "sleep 100 & echo $! > %s" % pid_path],
+                                          memory=2 ** 30))
+        job_model._id = 1
+        process = ProcessManager(job_model)
+        process.start_and_update_state()
+        cgroup_path = os.path.join(self.root, "job-1")
+        self.assertEqual(process.cgroup.path, cgroup_path)
+        wait_for(lambda: os.path.exists(pid_path) and open(pid_path).read().endswith("\n"))
+        pid = int(open(pid_path).read())
+        with open(os.path.join(cgroup_path, "cgroup.procs"), "a") as fd:
+            fd.write("\n%d" % pid)
+
+        def stopped():
+            process.check_if_alive_and_update_state()
+            return job_model.state == JobModel.STOPPED
+        wait_for(stopped)
+        self.assertEqual(process.handle.returncode, 0)
+        self.assertEqual(process.cgroup, None)
+        self.assertEqual(len(resources.leftover_cgroups), 1)
+        wait_for(lambda: not is_running(pid))
+
+        def removed():
+            resources.remove_leftover_cgroups()
+            return not os.path.exists(cgroup_path)
+        wait_for(removed)
+        self.assertEqual(resources.leftover_cgroups, [])
+        process.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
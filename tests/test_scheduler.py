@@ -0,0 +1,90 @@
+import unittest
+
+import common
+from db import JobModel, CommandModel
+from scheduler import Scheduler
+
+
+# only what the Scheduler uses of the MultipleProcessesManager
+class Processes(object):
+
+    def __init__(self):
+        self.processes = []
+
+    def add_process(self, process):
+        self.processes.append(process)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.database = common.make_database()
+        self.processes = Processes()
+        self.scheduler = Scheduler(self.processes, "worker", max_concurrency=10,
+                                   cpus=[0, 1, 2, 3], memory=4 * 2 ** 30)
+
+    def submit(self, **kwargs):
+        job_model = JobModel(CommandModel(["true"], **kwargs))
+        job_model._id = self.database.insert(job_model)
+        return job_model._id
+
+    def started(self):
+        return [process.job_model._id for process in self.processes.processes]
+
+    # the jobs which do not fit in the free cores are left in the queue
+    def test_cores(self):
+        two = self.submit(cores=2)
+        three = self.submit(cores=3)
+        shared = self.submit()
+        self.assertEqual(self.scheduler.fill_slots(self.database), 2)
+        self.assertEqual(self.started(), [two, shared])
+        two_process, shared_process = self.processes.processes
+        self.assertEqual(two_process.job_model.cpus, [0, 1])
+        self.assertEqual(two_process.job_model.worker_id, "worker")
+        # the jobs declaring no cores run on the cores not reserved
+        self.assertEqual(shared_process.shared_cpus, [2, 3])
+        self.assertEqual(self.database.find_one(JobModel, three).worker_id, None)
+        # the cores are given back when the job is stopped
+        del self.processes.processes[0]
+        self.assertEqual(self.scheduler.fill_slots(self.database), 1)
+        self.assertEqual(self.processes.processes[1].job_model.cpus, [0, 1, 2])
+        self.assertEqual(shared_process.shared_cpus, [3])
+
+    # a job is not started when all the cores are reserved
+    def test_all_cores_reserved(self):
+        self.submit(cores=4)
+        self.submit()
+        self.assertEqual(self.scheduler.fill_slots(self.database), 1)
+
+    def test_memory(self):
+        big = self.submit(memory=3 * 2 ** 30)
+        self.submit(memory=2 * 2 ** 30)
+        small = self.submit(memory=2 ** 30)
+        self.assertEqual(self.scheduler.fill_slots(self.database), 2)
+        self.assertEqual(self.started(), [big, small])
+
+    def test_priority_and_concurrency(self):
+        self.scheduler.max_concurrency = 2
+        first = self.submit()
+        self.submit()
+        high = JobModel(CommandModel(["true"]), priority=1)
+        high_id = self.database.insert(high)
+        self.assertEqual(self.scheduler.fill_slots(self.database), 2)
+        self.assertEqual(self.started(), [high_id, first])
+        self.assertEqual(self.scheduler.nb_queued_jobs(self.database), 1)
+
+    # at most category_limits[category] running jobs per category
+    def test_category_limits(self):
+        self.scheduler.category_limits = {"gpu": 1}
+        gpu = self.submit(categories=["gpu"])
+        self.submit(categories=["gpu", "big"])
+        other = self.submit(categories=["big"])
+        self.assertEqual(self.scheduler.fill_slots(self.database), 2)
+        self.assertEqual(self.started(), [gpu, other])
+        self.assertEqual(self.scheduler.fill_slots(self.database), 0)
+        del self.processes.processes[0]
+        self.assertEqual(self.scheduler.fill_slots(self.database), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+from search import TermExtractor
+
+
+class TermExtractorTest(unittest.TestCase):
+
+    def test_terms(self):
+        extractor = TermExtractor()
+        extractor.add("Epoch 1: loss=0.25, model_v2.pt saved.\n")
+        self.assertEqual(extractor.pop_new_terms(finished=True),
+                         ["0.25", "epoch", "loss", "model_v2.pt", "saved"])
+
+    # a term cut between two blocks is kept whole
+    def test_term_split_across_blocks(self):
+        extractor = TermExtractor()
+        extractor.add("hello wor")
+        self.assertEqual(extractor.pop_new_terms(), ["hello"])
+        extractor.add("ld again")
+        self.assertEqual(extractor.pop_new_terms(), ["world"])
+        self.assertEqual(extractor.pop_new_terms(finished=True), ["again"])
+
+    def test_term_split_across_many_blocks(self):
+        extractor = TermExtractor()
+        for block in ("learn", "ing_", "rate", " x"):
+            extractor.add(block)
+        self.assertEqual(extractor.pop_new_terms(finished=True), ["learning_rate"])
+
+    # the separator is at the beginning of the next block
+    def test_block_ending_with_a_term(self):
+        extractor = TermExtractor()
+        extractor.add("foo")
+        extractor.add(" bar")
+        self.assertEqual(extractor.pop_new_terms(finished=True), ["bar", "foo"])
+
+    def test_terms_returned_once(self):
+        extractor = TermExtractor()
+        extractor.add("foo bar ")
+        self.assertEqual(extractor.pop_new_terms(), ["bar", "foo"])
+        extractor.add("foo baz ")
+        self.assertEqual(extractor.pop_new_terms(), ["baz"])
+
+    def test_short_terms(self):
+        extractor = TermExtractor()
+        extractor.add("a b cd -e- .. ")
+        self.assertEqual(extractor.pop_new_terms(finished=True), ["cd"])
+
+    def test_max_terms(self):
+        extractor = TermExtractor(max_terms=2)
+        extractor.add("aa bb cc ")
+        self.assertTrue(extractor.is_full())
+        extractor.add("dd ")
+        self.assertEqual(len(extractor.pop_new_terms(finished=True)), 2)
+
+    def test_max_size(self):
+        extractor = TermExtractor(max_size=8)
+        extractor.add("abc def")
+        extractor.add("ghi jkl")
+        self.assertTrue(extractor.is_full())
+        self.assertEqual(extractor.pop_new_terms(finished=True), ["abc", "defg"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+
+from util import parse_size
+
+
+class ParseSizeTest(unittest.TestCase):
+
+    def test_bytes(self):
+        self.assertEqual(parse_size("1000"), 1000)
+        self.assertEqual(parse_size(" 1000B "), 1000)
+
+    def test_units(self):
+        self.assertEqual(parse_size("512K"), 512 * 1024)
+        self.assertEqual(parse_size("512m"), 512 * 1024 ** 2)
+        self.assertEqual(parse_size("4GB"), 4 * 1024 ** 3)
+        self.assertEqual(parse_size("1.5G"), 3 * 1024 ** 3 / 2)
+        self.assertEqual(parse_size("2T"), 2 * 1024 ** 4)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, parse_size, "4X")
+        self.assertRaises(ValueError, parse_size, "")
+
+
+if __name__ == "__main__":
+    unittest.main()
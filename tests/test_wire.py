@@ -0,0 +1,101 @@
+import os
+import shutil
+import datetime
+import tempfile
+import unittest
+
+from bson import ObjectId
+
+import common
+import wire_client
+from wire_client import (compress, decompress, encode, decode, datetime_to_timestamp, 
+                         timestamp_to_datetime, iter_job_summaries, iter_output, iter_blob)
+from wire import WireInterface
+from blobstore import LocalBlobStore
+from db import JobModel, CommandModel, OutputChunkModel
+
+
+class EncodingTest(unittest.TestCase):
+
+    VALUE = [("id", ["ls", "-l"], 2, 1.5, None), {"stdout": "caf\xc3\xa9 \xff", "n": 10 ** 12}]
+
+    def test_compress(self):
+        self.assertEqual(compress("small"), "-small")
+        data = "x" * 10000
+        payload = compress(data)
+        self.assertEqual(payload[0], "z")
+        self.assertTrue(len(payload) < 100)
+        self.assertEqual(decompress(payload), data)
+        self.assertEqual(decompress(compress("")), "")
+
+    def test_marshal(self):
+        msgpack, wire_client.msgpack = wire_client.msgpack, None
+        try:
+            self.assertEqual(decode(encode(self.VALUE)), self.VALUE)
+            self.assertEqual(decode(encode(self.VALUE * 1000)), self.VALUE * 1000)
+        finally:
+            wire_client.msgpack = msgpack
+
+    # the tuples are decoded as lists
+    @unittest.skipIf(wire_client.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        self.assertEqual(decode(encode(self.VALUE)), [list(self.VALUE[0]), self.VALUE[1]])
+
+    def test_datetime(self):
+        dt = datetime.datetime(2020, 1, 2, 3, 4, 5, 678000)
+        self.assertEqual(timestamp_to_datetime(datetime_to_timestamp(dt)), dt)
+        self.assertEqual(datetime_to_timestamp(None), None)
+        self.assertEqual(timestamp_to_datetime(None), None)
+
+
+class WireInterfaceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = common.make_database(LocalBlobStore(os.path.join(self.directory, "blobs")))
+        self.wire = WireInterface(self.database)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def insert_job(self, args, stdout=""):
+        job_model = JobModel(CommandModel(args), state=JobModel.STOPPED)
+        job_model.stdout_storage = JobModel.STDOUT_INLINE
+        job_model.output_data["stdout"] = stdout
+        job_model.datetime_from = datetime.datetime(2020, 1, 2, 3, 4, 5)
+        job_model._id = self.database.insert(job_model)
+        return job_model._id
+
+    def test_summaries(self):
+        ids = [self.insert_job(["echo", str(i)]) for i in range(5)]
+        summaries = list(iter_job_summaries(self.wire, {}, [("_id", 1)], batch_size=2))
+        self.assertEqual([summary[0] for summary in summaries], map(str, ids))
+        self.assertEqual(summaries[3][1:], (["echo", "3"], JobModel.STOPPED,
+                                            datetime_to_timestamp(datetime.datetime(2020, 1, 2, 3, 4, 5)), None))
+
+    # the stdout read as unicode is sent as bytes
+    def test_details(self):
+        job_id = self.insert_job(["ls"], u"caf\xe9 ")
+        details = decode(self.wire.job_details(job_id))
+        self.assertEqual((details["id"], details["args"], details["stdout"]), 
+                         (str(job_id), ["ls"], "caf\xc3\xa9 "))
+        self.assertEqual(self.wire.job_details(ObjectId()), None)
+
+    def test_output(self):
+        job_id = self.insert_job(["ls"])
+        chunks = ["chunk %d\n" % (i,) for i in range(5)]
+        for i, chunk in enumerate(chunks):
+            self.database.append_output(OutputChunkModel(job_id, i, chunk, "stderr"))
+        self.assertEqual(list(iter_output(self.wire, job_id, "stderr", batch_size=2)), chunks)
+
+    def test_blob(self):
+        filename = os.path.join(self.directory, "data.bin")
+        content = os.urandom(300000)
+        with open(filename, "wb") as fd:
+            fd.write(content)
+        reference = self.database.blob_store.put_file(filename)
+        self.assertEqual("".join(iter_blob(self.wire, reference)), content)
+
+
+if __name__ == "__main__":
+    unittest.main()
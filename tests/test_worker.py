@@ -0,0 +1,168 @@
+import time
+import shutil
+import datetime
+import tempfile
+import unittest
+from threading import Event
+
+import common
+import config
+from archive import JobArchive
+from db import JobModel, CommandModel, OutputChunkModel, WorkerModel
+from process import ProcessManager
+from worker import Worker
+
+
+class WorkerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.database = common.make_database()
+
+    def submit(self, **kwargs):
+        job_model = JobModel(CommandModel(["true"]), **kwargs)
+        job_model._id = self.database.insert(job_model)
+        return job_model._id
+
+    def get(self, job_id):
+        return self.database.find_one(JobModel, job_id)
+
+    def register(self, worker_id, seconds_ago=0):
+        worker_model = WorkerModel(worker_id, "host", 1)
+        worker_model.heartbeat -= datetime.timedelta(seconds=seconds_ago)
+        self.database.insert(worker_model)
+        return Worker(self.database, worker_id, dead_after=60)
+
+
+class ClaimTest(WorkerTestCase):
+
+    # a job is claimed by one worker only
+    def test_claim(self):
+        first, second = self.submit(), self.submit()
+        self.assertEqual(self.database.claim_job("a", sort=[("_id", 1)])._id, first)
+        self.assertEqual(self.database.claim_job("b", sort=[("_id", 1)])._id, second)
+        self.assertEqual(self.database.claim_job("a"), None)
+        self.assertEqual(self.get(first).worker_id, "a")
+        self.assertEqual(self.get(second).worker_id, "b")
+
+    # the unfinished jobs of the worker go back to the queue without their output
+    def test_requeue_dead_worker(self):
+        self.register("dead", seconds_ago=120)
+        alive = self.register("alive")
+        self.submit()
+        self.submit()
+        running = self.database.claim_job("dead")
+        self.database.claim_job("alive")
+        running.state = JobModel.RUNNING
+        self.database.save(running)
+        self.database.append_output(OutputChunkModel(running._id, 0, "partial", "stdout"))
+        alive.requeue_jobs_of_dead_workers()
+        job_model = self.get(running._id)
+        self.assertEqual((job_model.state, job_model.worker_id), (JobModel.NOT_YET_STARTED, None))
+        self.assertEqual(self.database.find_output(running._id), [])
+        self.assertEqual(self.database.find(WorkerModel, {"_id": "dead"}), [])
+        self.assertEqual(self.database.count(JobModel, {"worker_id": "alive"}), 1)
+
+
+class WriteBatchFenceTest(WorkerTestCase):
+
+    # the writes of a worker whose job has been requeued and claimed by 
+    # another worker are dropped
+    def test_lost_job(self):
+        job_id = self.submit()
+        job_model = self.database.claim_job("a")
+        self.database.requeue_jobs_of_worker("a")
+        self.database.claim_job("b")
+        batch = self.database.new_write_batch(worker_id="a")
+        job_model.state = JobModel.RUNNING
+        batch.save(job_model)
+        batch.append_output(OutputChunkModel(job_id, 0, "lost", "stdout"))
+        batch.flush()
+        self.assertEqual(batch.lost_job_ids, set([job_id]))
+        self.assertEqual(self.get(job_id).state, JobModel.NOT_YET_STARTED)
+        self.assertEqual(self.get(job_id).worker_id, "b")
+        self.assertEqual(self.database.find_output(job_id), [])
+
+    def test_owned_job(self):
+        job_id = self.submit()
+        job_model = self.database.claim_job("a")
+        batch = self.database.new_write_batch(worker_id="a")
+        job_model.state = JobModel.RUNNING
+        batch.save(job_model)
+        batch.append_output(OutputChunkModel(job_id, 0, "out", "stdout"))
+        batch.flush()
+        self.assertEqual(batch.lost_job_ids, set())
+        self.assertEqual(self.get(job_id).state, JobModel.RUNNING)
+        self.assertEqual(self.database.find_output(job_id), ["out"])
+
+
+class KillTest(WorkerTestCase):
+
+    def test_not_claimed(self):
+        job_id = self.submit()
+        self.assertTrue(self.database.request_kill(job_id))
+        self.assertEqual(self.get(job_id).state, JobModel.STOPPED)
+        self.assertEqual(self.database.claim_job("a"), None)
+
+    # the state is written by the worker which claimed the job
+    def test_claimed(self):
+        job_id = self.submit()
+        worker = self.register("a")
+        self.database.claim_job("a")
+        self.assertFalse(self.database.request_kill(job_id))
+        job_model = self.get(job_id)
+        self.assertEqual(job_model.state, JobModel.NOT_YET_STARTED)
+        self.assertTrue(job_model.kill_requested)
+        self.assertEqual(worker.find_kill_requests(), [job_id])
+
+    def test_stopped(self):
+        job_id = self.submit(state=JobModel.STOPPED)
+        self.assertFalse(self.database.request_kill(job_id))
+        self.assertFalse(hasattr(self.get(job_id), "kill_requested"))
+
+    # the kill request of a dead worker is kept : the job is not started
+    # by the worker which claims it next
+    def test_requeued(self):
+        job_id = self.submit()
+        self.database.claim_job("a")
+        self.database.request_kill(job_id)
+        self.database.requeue_jobs_of_worker("a")
+        process = ProcessManager(self.database.claim_job("b"))
+        process.start_and_update_state()
+        self.assertEqual(process.job_model.state, JobModel.STOPPED)
+        self.assertEqual(process.handle, None)
+
+
+class ArchivingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = common.make_database(archive=JobArchive(self.directory))
+        self.archive_after, config.ARCHIVE_AFTER = config.ARCHIVE_AFTER, 3600
+        self.batch_size, config.ARCHIVE_BATCH_SIZE = config.ARCHIVE_BATCH_SIZE, 2
+
+    def tearDown(self):
+        config.ARCHIVE_AFTER, config.ARCHIVE_BATCH_SIZE = self.archive_after, self.batch_size
+        shutil.rmtree(self.directory)
+
+    # all the old jobs are archived by the thread, batch after batch
+    def test_thread(self):
+        old = datetime.datetime.now() - datetime.timedelta(days=1)
+        for i in range(5):
+            job_model = JobModel(CommandModel(["true"]), state=JobModel.STOPPED)
+            job_model.datetime_to = old
+            self.database.insert(job_model)
+        self.assertEqual(Worker(self.database).start_archiving(Event()), None)
+        stop_event = Event()
+        thread = Worker(self.database, archive_jobs=True).start_archiving(stop_event)
+        try:
+            end = time.time() + 10
+            while self.database.count(JobModel, {"archive": {"$exists": True}}) < 5:
+                self.assertTrue(time.time() < end)
+                time.sleep(0.01)
+        finally:
+            stop_event.set()
+            thread.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -47,3 +47,47 @@ def is_process_running(pid):
         return True
     except OSError:
         return False
+
+import fcntl
+def set_non_blocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+import itertools
+# {"a": [1, 2], "b": [3, 4]} -> [{"a": 1, "b": 3}, {"a": 1, "b": 4}, {"a": 2, "b": 3}, {"a": 2, "b": 4}]
+def get_grid_values(grid):
+    names = sorted(grid.keys())
+    return [dict(zip(names, values)) 
+            for values in itertools.product(*[grid[name] for name in names])]
+
+def parse_value(s):
+    for type_ in (int, float):
+        try:
+            return type_(s)
+        except ValueError:
+            pass
+    return s
+
+import json
+import csv
+# values of a parameter sweep, from :
+#   - a json file containing a grid (dict of lists) or a list of dicts
+#   - a csv file, one dict of values per row
+def load_sweep_values(filename):
+    if filename.endswith(".csv"):
+        with open(filename, "r") as fd:
+            return [dict((name, parse_value(value)) for name, value in row.items())
+                    for row in csv.DictReader(fd)]
+    with open(filename, "r") as fd:
+        values = json.load(fd)
+    if isinstance(values, dict):
+        return get_grid_values(values)
+    return values
+
+SIZE_UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+# "512M", "4G" or a number of bytes -> number of bytes
+def parse_size(s):
+    s = s.strip().upper().rstrip("B")
+    if s and s[-1] in SIZE_UNITS:
+        return int(float(s[:-1]) * SIZE_UNITS[s[-1]])
+    return int(s)
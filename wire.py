@@ -0,0 +1,98 @@
+# Compact encoding of what the client needs from the server : listings are
+# sent as tuples of summary fields and large payloads (stdout, blobs) are
+# compressed. WireInterface is exposed with Pyro next to the Database, the
+# encoding and the client side helpers are in wire_client.py.
+
+from db import JobModel, get_bytes
+from blobstore import BLOCK_SIZE
+from search import find_job_ids
+from wire_client import (compress, encode, datetime_to_timestamp)
+
+# (id, args, state, datetime_from, datetime_to) for the listings
+def get_job_summary(job_model):
+    return (str(job_model._id), job_model.command_model.args, job_model.state,
+            datetime_to_timestamp(job_model.datetime_from),
+            datetime_to_timestamp(job_model.datetime_to))
+
+# everything about a job except the content of its data
+def get_job_details(job_model):
+    details = {
+        "id": str(job_model._id),
+        "args": job_model.command_model.args,
+        "state": job_model.state,
+        "datetime_from": datetime_to_timestamp(job_model.datetime_from),
+        "datetime_to": datetime_to_timestamp(job_model.datetime_to),
+        "return_code": getattr(job_model, "return_code", None),
+        "resources": getattr(job_model, "resources", None),
+        "cpus": getattr(job_model, "cpus", None),
+        "inputs": sorted(getattr(job_model, "input_data", {}).keys()),
+        "outputs": sorted(name for name in getattr(job_model, "output_data", {}).keys() if name != "stdout"),
+        "chunked_stdout": job_model.has_chunked_stdout(),
+        "stdout_job_id": str(job_model.get_stdout_job_id()),
+        "depends_on": map(str, getattr(job_model, "depends_on", [])),
+        "waiting_on": map(str, getattr(job_model, "waiting_on", [])),
+        "cancelled": getattr(job_model, "cancelled", False),
+        "error": getattr(job_model, "error", None),
+        # the archive could not be restored (see Database.restore_job)
+        "archived": getattr(job_model, "archive", None) is not None,
+    }
+    if not job_model.has_chunked_stdout() and not details["archived"]:
+        details["stdout"] = get_bytes(job_model.get_data("stdout") or "")
+    return details
+
+
+class WireInterface(object):
+
+    def __init__(self, database):
+        self.database = database
+
+    def count_jobs(self, params):
+        return self.database.count(JobModel, params)
+
+    def open_job_summaries(self, params, sort):
+        return self.database.open_cursor(JobModel, params, JobModel.SUMMARY_FIELDS, sort=sort)
+
+    # encoded list of job summaries, empty when there are no more jobs
+    def next_job_summaries(self, cursor_id, size=1000):
+        return encode([get_job_summary(job_model) 
+                       for job_model in self.database.next_batch(cursor_id, size)])
+
+    def close_job_summaries(self, cursor_id):
+        self.database.close_cursor(cursor_id)
+
+    # the archived jobs (see Database.archive_job) are restored when they are read
+    def __find_job(self, job_id):
+        job_model = self.database.find_one(JobModel, job_id)
+        if job_model is not None and getattr(job_model, "archive", None) is not None:
+            if self.database.restore_job(job_model._id):
+                job_model = self.database.find_one(JobModel, job_id)
+        return job_model
+
+    def job_details(self, job_id):
+        job_model = self.__find_job(job_id)
+        if job_model is None:
+            return None
+        return encode(get_job_details(job_model))
+
+    # encoded list of at most limit chunks of output, from the chunk of index start
+    def read_output(self, job_id, stream="stdout", start=0, limit=100):
+        if start == 0:
+            self.__find_job(job_id)
+        return encode(self.database.find_output(job_id, stream, start, limit))
+
+    # encoded blob reference or content of the data name of the job
+    def job_data(self, job_id, name):
+        job_model = self.__find_job(job_id)
+        if job_model is None or getattr(job_model, "archive", None) is not None:
+            return None
+        data = job_model.get_data(name)
+        if data is None:
+            return None
+        return encode(data)
+
+    # ids of the jobs whose input or output data contain the terms (see search.find_job_ids)
+    def find_job_ids(self, field, contains):
+        return list(find_job_ids(self.database, field, contains))
+
+    def read_blob(self, key, offset, size=BLOCK_SIZE):
+        return compress(self.database.read_blob(key, offset, size))
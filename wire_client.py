@@ -0,0 +1,84 @@
+# The encoding of what is sent between the server (WireInterface) and the
+# client, and the client side helpers. Nothing here imports db (pymongo) : 
+# the client only loads it when an action needs the models.
+
+import zlib
+import time
+import marshal
+import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from blobstore import BLOCK_SIZE
+
+# payloads smaller than this are not compressed
+COMPRESSION_THRESHOLD = 1024
+
+def compress(data):
+    if len(data) < COMPRESSION_THRESHOLD:
+        return "-" + data
+    return "z" + zlib.compress(data, 1)
+
+def decompress(payload):
+    if payload[0] == "z":
+        return zlib.decompress(payload[1:])
+    return payload[1:]
+
+# msgpack when available, marshal otherwise : the values must be made of 
+# None, numbers, strings, lists/tuples and dicts
+def encode(value):
+    if msgpack is not None:
+        data = "p" + msgpack.packb(value)
+    else:
+        data = "m" + marshal.dumps(value)
+    return compress(data)
+
+def decode(payload):
+    data = decompress(payload)
+    if data[0] == "p":
+        return msgpack.unpackb(data[1:])
+    return marshal.loads(data[1:])
+
+def datetime_to_timestamp(dt):
+    if dt is None:
+        return None
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
+
+def timestamp_to_datetime(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(timestamp)
+
+def iter_job_summaries(wire, params, sort, batch_size=1000):
+    cursor_id = wire.open_job_summaries(params, sort)
+    try:
+        while True:
+            summaries = decode(wire.next_job_summaries(cursor_id, batch_size))
+            if len(summaries) == 0:
+                break
+            for summary in summaries:
+                yield summary
+    finally:
+        wire.close_job_summaries(cursor_id)
+
+def iter_output(wire, job_id, stream="stdout", batch_size=100):
+    start = 0
+    while True:
+        chunks = decode(wire.read_output(job_id, stream, start, batch_size))
+        for chunk in chunks:
+            yield chunk
+        if len(chunks) < batch_size:
+            break
+        start += len(chunks)
+
+def iter_blob(wire, reference):
+    offset = 0
+    while offset < reference["size"]:
+        block = decompress(wire.read_blob(reference["blob"], offset, BLOCK_SIZE))
+        if not block:
+            break
+        yield block
+        offset += len(block)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import os
+import uuid
+import socket
+import datetime
+from threading import Event, Thread
+
+import pymongo
+
+import config
+from db import Database, JobModel, WorkerModel, MODEL_CLASSES
+from blobstore import make_blob_store
+from archive import make_job_archive
+from cache import ResultCache, ResultCacheModel
+
+def make_worker_id():
+    return "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[0:8])
+
+# Registration, heartbeats of a process running jobs and detection of the dead
+# ones. tick() is called by MultipleProcessesManager.run_event_loop.
+class Worker(object):
+
+    def __init__(self, database, worker_id=None,
+                 heartbeat_interval=None, dead_after=None, archive_jobs=False):
+        self.database = database
+        self.worker_id = worker_id if worker_id is not None else make_worker_id()
+        self.heartbeat_interval = (heartbeat_interval if heartbeat_interval is not None 
+                                   else config.WORKER_HEARTBEAT_INTERVAL)
+        self.dead_after = dead_after if dead_after is not None else config.WORKER_DEAD_AFTER
+        self.last_heartbeat = None
+        # only the server archives the old jobs : the archives are local files
+        self.archive_jobs = archive_jobs and config.ARCHIVE_AFTER is not None and database.archive is not None
+
+    def register(self):
+        hostname, pid = socket.gethostname(), os.getpid()
+        self.database.insert(WorkerModel(self.worker_id, hostname, pid))
+        self.last_heartbeat = datetime.datetime.now()
+
+    # the jobs of the worker go back to the queue
+    def unregister(self):
+        self.database.remove(WorkerModel, {"_id": self.worker_id})
+        self.database.requeue_jobs_of_worker(self.worker_id)
+
+    # returns False if the worker has been considered dead by another worker 
+    # (e.g network partition) : its jobs are not its own anymore
+    def heartbeat(self):
+        self.last_heartbeat = datetime.datetime.now()
+        return self.database.update_heartbeat(self.worker_id, self.last_heartbeat)
+
+    def requeue_jobs_of_dead_workers(self):
+        limit = datetime.datetime.now() - datetime.timedelta(seconds=self.dead_after)
+        dead_workers = self.database.find(WorkerModel, {"heartbeat": {"$lt": limit}})
+        for dead_worker in dead_workers:
+            nb_jobs = self.database.requeue_jobs_of_worker(dead_worker._id)
+            self.database.remove(WorkerModel, {"_id": dead_worker._id})
+            print "worker %s is dead, %d job(s) requeued" % (dead_worker._id, nb_jobs)
+
+    # ids of the jobs claimed by the worker that a client asked to stop, 
+    # still NOT_YET_STARTED in the database when their start is not written yet
+    def find_kill_requests(self):
+        job_models = self.database.find(JobModel,
+                {"worker_id": self.worker_id, "kill_requested": True,
+                 "state": {"$in": [JobModel.NOT_YET_STARTED, JobModel.RUNNING]}},
+                {"_id": True})
+        return [job_model._id for job_model in job_models]
+
+    def tick(self, multiple_processes_manager):
+        now = datetime.datetime.now()
+        if (now - self.last_heartbeat).total_seconds() < self.heartbeat_interval:
+            return
+        if not self.heartbeat():
+            print "worker %s has been considered dead, abandoning its jobs" % (self.worker_id,)
+            multiple_processes_manager.abandon_processes()
+            self.register()
+        for job_id in self.find_kill_requests():
+            multiple_processes_manager.kill_process_with_job_id(job_id, self.database)
+        self.requeue_jobs_of_dead_workers()
+
+    # a pass every ARCHIVE_INTERVAL seconds by batches of ARCHIVE_BATCH_SIZE 
+    # jobs, until stop_event is set. The archives are written by this thread 
+    # (see start_archiving) : the event loop is not blocked by the file I/O
+    def run_archiving(self, stop_event):
+        while not stop_event.is_set():
+            try:
+                nb_archived = self.database.archive_old_jobs(limit=config.ARCHIVE_BATCH_SIZE)
+            except Exception as e:
+                print "could not archive the old jobs : %s" % (e,)
+                nb_archived = 0
+            if nb_archived:
+                print "%d job(s) archived" % (nb_archived,)
+            if nb_archived < config.ARCHIVE_BATCH_SIZE:
+                stop_event.wait(config.ARCHIVE_INTERVAL)
+
+    # the thread of run_archiving, None if the worker does not archive
+    def start_archiving(self, stop_event):
+        if not self.archive_jobs:
+            return None
+        thread = Thread(target=self.run_archiving, args=(stop_event,))
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def make_result_cache(database):
+    if config.RESULT_CACHE:
+        return ResultCache(database)
+    return None
+
+def connect(host=None, port=None):
+    client = pymongo.MongoClient(host if host is not None else config.MONGO_HOST,
+                                 port if port is not None else config.MONGO_PORT)
+    mongo_db = client[config.MONGO_DATABASE]
+    database = Database(mongo_db, blob_store=make_blob_store(mongo_db), archive=make_job_archive())
+    return client, database
+
+# a worker without Pyro interface, any number of them can run on any number of hosts
+if __name__ == "__main__":
+    import argparse
+    from process import MultipleProcessesManager
+    from scheduler import Scheduler
+
+    parser = argparse.ArgumentParser(description='Run the queued jobs')
+    parser.add_argument('--mongo-host', required=False)
+    parser.add_argument('--mongo-port', required=False, type=int)
+    parser.add_argument('--max-concurrency', required=False, type=int, default=config.MAX_CONCURRENT_JOBS)
+    args = parser.parse_args()
+
+    client, database = connect(args.mongo_host, args.mongo_port)
+    database.ensure_indexes(MODEL_CLASSES + (ResultCacheModel,))
+
+    multiple_processes_manager = MultipleProcessesManager()
+    worker = Worker(database)
+    scheduler = Scheduler(multiple_processes_manager, worker.worker_id,
+                          max_concurrency=args.max_concurrency,
+                          category_limits=config.CATEGORY_LIMITS,
+                          result_cache=make_result_cache(database))
+    worker.register()
+    print "Worker %s started" % (worker.worker_id,)
+
+    multiple_processes_manager.install_sigchld_handler()
+    stop_event = Event()
+    try:
+        multiple_processes_manager.run_event_loop(database, stop_event,
+                                                  scheduler=scheduler, worker=worker)
+    except KeyboardInterrupt:
+        stop_event.set()
+    finally:
+        multiple_processes_manager.abandon_processes()
+        worker.unregister()
+        client.close()